@@ -0,0 +1,41 @@
+"""
+Analyze a bus log: a capture file (recorded by the application) or a raw RS-485 dump.
+
+Usage: python analyze_bus_log.py [--raw] [--json] [--baud-rate BAUD_RATE] filename
+"""
+
+import argparse
+import json
+import time
+
+from models.bus_capture import BusCaptureReader
+from models.bus_log_analyzer import BusLogAnalyzer
+from models.rs485_driver import RS485Driver
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze a bus log (capture file or raw RS-485 dump)")
+    parser.add_argument("filename", help="capture file or raw dump")
+    parser.add_argument("--raw", action="store_true", help="the file is a raw dump (no timestamps)")
+    parser.add_argument("--json", action="store_true", help="output the report as JSON")
+    parser.add_argument("--baud-rate", type=int, default=RS485Driver.BAUD_RATE, help="baud rate of the bus")
+    arguments = parser.parse_args()
+
+    analyzer = BusLogAnalyzer(arguments.baud_rate)
+    start = time.perf_counter()
+    if arguments.raw:
+        analyzer.analyze_raw_file(arguments.filename)
+    else:
+        with BusCaptureReader(arguments.filename) as reader:
+            analyzer.analyze_capture(reader)
+    report = analyzer.get_report()
+    if arguments.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print(BusLogAnalyzer.format_report(report))
+        print(f"\nAnalyzed in {time.perf_counter() - start:.2f} seconds")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -1,12 +1,37 @@
 """
 Start the application
+
+The main window is shown first, the Lily System (ports, simulators, module detection) is started after that.
+Startup timing mode (--startup-timing or LILY_STARTUP_TIMING=1): the time of each startup phase is printed
+after the first module detection.
 """
 
-import wx
+import sys
+import threading
+
+# Import the startup timer first, the times are relative to its import
+from models.startup_timer import StartupTimer
+
+with StartupTimer.phase("import wx"):
+    import wx
+
+with StartupTimer.phase("import controllers and views"):
+    from app_info import AppInfo
+    from controllers.controller_main import ControllerMain
+
+_STARTUP_TIMING_TIMEOUT = 10
+
+
+def _show_startup_timing():
+    # Also shown if there are no modules (time out)
+    StartupTimer.wait_for_mark("first module detection", _STARTUP_TIMING_TIMEOUT)
+    print(StartupTimer.format_report())
 
-from app_info import AppInfo
-from controllers.controller_main import ControllerMain
 
-app = wx.App(redirect=False)
-ControllerMain(f"{AppInfo.NAME} V{AppInfo.VERSION}")
+with StartupTimer.phase("create application"):
+    app = wx.App(redirect=False)
+with StartupTimer.phase("create main window"):
+    ControllerMain(f"{AppInfo.NAME} V{AppInfo.VERSION}")
+if StartupTimer.is_enabled(sys.argv[1:]):
+    threading.Thread(target=_show_startup_timing, daemon=True).start()
 app.MainLoop()
@@ -1,34 +1,82 @@
 """
 Main controller
+
+Rack updates are received from the detection thread and passed to the view in the GUI thread.
+Multiple updates are combined, the view is refreshed at most once per refresh interval.
+The modules found in a previous session are shown directly from the module cache.
+
+The Lily System is imported and started after the main window is shown (the window appears as soon as possible).
 """
 
+import os
+import threading
+import time
 import wx
 
-from models.lily_system import LilySystem
+from models.startup_timer import StartupTimer
 from views.view_main import ViewMain
 
 
 class ControllerMain:
 
+    _REFRESH_INTERVAL = 0.2
+    _MODULE_CACHE_FILENAME = os.path.join(os.path.expanduser("~"), ".lily_system", "module_cache.json")
+
     def __init__(self, window_title):
+        self._lock = threading.Lock()
+        self._racks = None
+        self._refresh_pending = False
+        self._last_refresh = 0
+
         self._view = ViewMain(window_title)
         self._view.Show()
 
         self._view.Bind(wx.EVT_TREE_ITEM_ACTIVATED, self._on_tree_item_activate, id=self._view.ID_TREE)
 
-        self._lily_system = LilySystem(self._on_lily_system_event)
+        self._lily_system = None
+        wx.CallAfter(self._start_lily_system)
+
+    def _start_lily_system(self):
+        # Called from the event loop, the main window is shown
+        StartupTimer.mark("main window shown")
+        with StartupTimer.phase("import models"):
+            from models.lily_system import LilySystem
+        with StartupTimer.phase("create Lily System"):
+            self._lily_system = LilySystem(self._on_lily_system_event, self._MODULE_CACHE_FILENAME, True)
+        self._lily_system.start()
 
     def _on_lily_system_event(self, racks):
+        # Called from the detection thread, only the latest racks are shown
+        with self._lock:
+            self._racks = racks
+            if self._refresh_pending:
+                return
+            self._refresh_pending = True
+        wx.CallAfter(self._schedule_refresh)
+
+    def _schedule_refresh(self):
+        delay = self._last_refresh + self._REFRESH_INTERVAL - time.monotonic()
+        if delay > 0:
+            wx.CallLater(int(1000 * delay), self._refresh_view)
+        else:
+            self._refresh_view()
+
+    def _refresh_view(self):
+        with self._lock:
+            racks = self._racks
+            self._refresh_pending = False
+        self._last_refresh = time.monotonic()
+        topology = []
         for rack in sorted(racks, key=lambda r: r["port"]):
-            rack_id = f"Rack [{rack["port"]}]"
-            self._view.add_rack(rack_id)
+            modules = []
             for module in sorted(rack["modules"], key=lambda m: m["slot"]):
-                module_id = f"{module["slot"]} - {module["name"]}"
-                self._view.add_module(rack_id, module_id, (rack["port"], module["slot"]))
+                modules.append((f"{module["slot"]} - {module["name"]}", (rack["port"], module["slot"])))
+            topology.append((f"Rack [{rack["port"]}]", modules))
+        self._view.apply_topology(topology)
 
     def _on_tree_item_activate(self, event):
         location = self._view.get_item_data(event.GetItem())
-        if location is not None:
+        if location is not None and self._lily_system is not None:
             matches = list(filter(lambda r: r["port"] == location[0], self._lily_system.get_racks()))
             if len(matches) == 1:
                 matches = list(filter(lambda m: m["slot"] == location[1], matches[0]["modules"]))
@@ -0,0 +1,246 @@
+"""
+Capture of the raw bus traffic, for debugging and reproducing performance issues with real traffic.
+
+Capture file format (append only, little endian):
+- header: magic (8 bytes) and version (uint16)
+- records: timestamp (perf_counter_ns, uint64), direction (uint8), port index (uint8), length (uint16), data
+Direction is TX (PC to modules), RX (modules to PC) or PORT (data is the name of the port with the port index).
+A port record is written before the first TX or RX record of that port.
+
+Index file (<capture file>.idx, append only, little endian):
+- header: magic (8 bytes) and version (uint16)
+- the offset of every record in the capture file (uint64), written after the records
+The records have a variable length, the index is used to find all records at once (see the bus log analyzer).
+
+Writer: recording only appends a tuple to a deque, a thread writes the records to the file every flush interval.
+This keeps the overhead in the transmit and receive thread of the driver negligible.
+Stop recording in all drivers before closing the writer: RS485Driver.set_capture(None) waits until the driver is not
+recording anymore, so no records are added after the last flush.
+
+Reader: the file is memory mapped and the frames are read lazily (one at a time, a broken last record is ignored).
+The memory mapped file and the index are also available for bulk decoding (see the bus log analyzer).
+
+Replayer: feeds the frames to a handler with the original timing (speed 1), N times faster (speed N)
+or as fast as possible (speed 0). For example, send the TX frames to a simulator through a driver.
+"""
+
+import array
+import collections
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+
+CaptureFrame = collections.namedtuple("CaptureFrame", ["timestamp", "direction", "port_name", "data"])
+
+
+class BusCapture:
+
+    MAGIC = b"LILYCAP\x00"
+    INDEX_MAGIC = b"LILYIDX\x00"
+    VERSION = 1
+
+    DIRECTION_TX = 0
+    DIRECTION_RX = 1
+    DIRECTION_PORT = 2
+
+    HEADER = struct.Struct("<8sH")
+    RECORD = struct.Struct("<QBBH")
+    INDEX_ENTRY_SIZE = 8
+
+    @staticmethod
+    def get_index_filename(filename):
+        return f"{filename}.idx"
+
+
+class CaptureRecorder:
+
+    def __init__(self, append, port_index):
+        self._append = append
+        self._port_index = port_index
+
+    def record(self, direction, timestamp, data):
+        # The data must not be modified after recording (bytes)
+        self._append((timestamp, direction, self._port_index, data))
+
+
+class BusCaptureWriter:
+
+    FLUSH_INTERVAL = 0.1
+
+    def __init__(self, filename):
+        self._file = open(filename, "wb")
+        self._file.write(BusCapture.HEADER.pack(BusCapture.MAGIC, BusCapture.VERSION))
+        self._index_file = open(BusCapture.get_index_filename(filename), "wb")
+        self._index_file.write(BusCapture.HEADER.pack(BusCapture.INDEX_MAGIC, BusCapture.VERSION))
+        self._offset = BusCapture.HEADER.size
+        self._records = collections.deque()
+        self._ports = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._write_records)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _flush(self):
+        records = self._records
+        buffer = bytearray()
+        offsets = array.array("Q")
+        pack = BusCapture.RECORD.pack
+        while len(records) > 0:
+            timestamp, direction, port_index, data = records.popleft()
+            offsets.append(self._offset + len(buffer))
+            buffer += pack(timestamp, direction, port_index, len(data))
+            buffer += data
+        if len(buffer) > 0:
+            self._file.write(buffer)
+            self._file.flush()
+            self._offset += len(buffer)
+            # The index is written after the records, so it never points to records that are not written
+            if sys.byteorder != "little":
+                offsets.byteswap()
+            self._index_file.write(offsets.tobytes())
+            self._index_file.flush()
+
+    def _write_records(self):
+        while not self._stop_event.wait(self.FLUSH_INTERVAL):
+            self._flush()
+
+    def get_recorder(self, port_name):
+        # Returns the recorder for the port (one recorder per port)
+        with self._lock:
+            if port_name not in self._ports:
+                if len(self._ports) > 255:
+                    raise ValueError("Too many ports in the capture (max 256)")
+                self._ports[port_name] = len(self._ports)
+                self._records.append((time.perf_counter_ns(), BusCapture.DIRECTION_PORT, self._ports[port_name],
+                                      port_name.encode()))
+            return CaptureRecorder(self._records.append, self._ports[port_name])
+
+    def close(self):
+        if self._thread.is_alive():
+            self._stop_event.set()
+            self._thread.join()
+        self._flush()
+        self._file.close()
+        self._index_file.close()
+
+
+class BusCaptureReader:
+
+    def __init__(self, filename):
+        self._index_filename = BusCapture.get_index_filename(filename)
+        self._index_file = None
+        self._index_map = None
+        self._file = open(filename, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            self._file.close()
+            raise ValueError(f"Not a capture file: {filename}")
+        if (len(self._map) < BusCapture.HEADER.size or
+                BusCapture.HEADER.unpack_from(self._map)[0] != BusCapture.MAGIC):
+            self.close()
+            raise ValueError(f"Not a capture file: {filename}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self.get_frames()
+
+    def get_frames(self, directions=(BusCapture.DIRECTION_TX, BusCapture.DIRECTION_RX)):
+        # Generator with the frames of the given directions, port records are only used for the port names
+        ports = {}
+        record = BusCapture.RECORD
+        data_map = self._map
+        size = len(data_map)
+        offset = BusCapture.HEADER.size
+        while offset + record.size <= size:
+            timestamp, direction, port_index, length = record.unpack_from(data_map, offset)
+            offset += record.size
+            if offset + length > size:
+                # Record not completely written
+                break
+            data = data_map[offset:offset + length]
+            offset += length
+            if direction == BusCapture.DIRECTION_PORT:
+                ports[port_index] = data.decode()
+            if direction in directions:
+                yield CaptureFrame(timestamp, direction, ports.get(port_index, ""), data)
+
+    def get_ports(self):
+        return [frame.data.decode() for frame in self.get_frames((BusCapture.DIRECTION_PORT, ))]
+
+    def get_buffer(self):
+        # The memory mapped file, only valid until the reader is closed
+        return self._map
+
+    def get_index(self):
+        # The record offsets of the index file (memory mapped, only valid until the reader is closed)
+        # None if there is no index (older captures), the offsets must be checked against the capture
+        if self._index_file is None and os.path.isfile(self._index_filename):
+            self._index_file = open(self._index_filename, "rb")
+            size = os.path.getsize(self._index_filename)
+            if size >= BusCapture.HEADER.size + BusCapture.INDEX_ENTRY_SIZE:
+                self._index_map = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if BusCapture.HEADER.unpack_from(self._index_map)[0] != BusCapture.INDEX_MAGIC:
+                    self._index_map.close()
+                    self._index_map = None
+        if self._index_map is None:
+            return None
+        n_entries = (len(self._index_map) - BusCapture.HEADER.size) // BusCapture.INDEX_ENTRY_SIZE
+        return memoryview(self._index_map)[BusCapture.HEADER.size:
+                                           BusCapture.HEADER.size + n_entries * BusCapture.INDEX_ENTRY_SIZE]
+
+    def close(self):
+        if self._index_map is not None:
+            self._index_map.close()
+        if self._index_file is not None:
+            self._index_file.close()
+        self._map.close()
+        self._file.close()
+
+
+class BusCaptureReplayer:
+
+    def __init__(self, reader, speed=1.0):
+        # Speed: 1 is the original timing, N is N times faster, 0 is as fast as possible
+        self._reader = reader
+        self._speed = speed
+
+    def replay(self, handler, directions=(BusCapture.DIRECTION_TX, ), port_name=None):
+        # Calls the handler with each frame at its (scaled) time, returns the number of frames
+        n_frames = 0
+        start_capture = None
+        start = time.perf_counter_ns()
+        for frame in self._reader.get_frames(directions):
+            if port_name is not None and frame.port_name != port_name:
+                continue
+            if start_capture is None:
+                start_capture = frame.timestamp
+            if self._speed > 0:
+                delay = (frame.timestamp - start_capture) / self._speed - (time.perf_counter_ns() - start)
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+            handler(frame)
+            n_frames += 1
+        return n_frames
+
+    def replay_to_driver(self, driver, port_name=None):
+        # Sends the TX frames to the driver (for example connected to a simulator)
+        return self.replay(lambda frame: driver.send_data(frame.data), (BusCapture.DIRECTION_TX, ), port_name)
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_bus_capture import TestBusCapture
+
+    TestBusCapture().run()
@@ -0,0 +1,373 @@
+"""
+Offline analyzer for bus logs: raw RS-485 dumps or capture files (see bus_capture).
+
+The frames are found in large blocks of data at once with NumPy, using the framing rules of the data packet:
+- the start of a frame is the last STX before an ETX
+- every DLE escapes the next byte (inverted), a DLE before the ETX or two DLEs in a row are invalid
+- the unstuffed frame size must be between the minimum and maximum packet size
+The CRCs of all frames are calculated at the same time with the lookup table (one table lookup per byte position).
+The frames are right aligned (zero padded at the start), padding with zeros does not change the CRC.
+
+Report:
+- frames, CRC errors and framing errors (frames dropped by the frame decoder or the data packet)
+- per slot: requests, responses, requests without response and the latency distribution (capture files only)
+- bus utilization (capture files only, the raw dumps have no timestamps)
+Requests and responses are paired by PID: a response belongs to the last request with the same PID before it.
+
+Data is processed in chunks, the frame that is not complete at the end of a chunk is added to the next chunk.
+
+Capture files are decoded in bulk from the memory mapped file: the offsets of the records are read from the index
+of the capture, the headers are read with a NumPy structured array over the file and the data of every stream
+(port and direction) is gathered at once, there is no loop per record.
+The index is checked against the capture (every record must end where the next one starts). Records after the last
+valid index entry (captures without index or an index that was not completely written) are found by walking the
+headers one by one, this is much slower (a few million records per second).
+"""
+
+import array
+import mmap
+import numpy
+import struct
+
+from application.models.bus_capture import BusCapture
+from application.models.crc8 import CRC_TABLE
+from application.models.data_packet import DataPacket
+from application.models.rs485_driver import RS485Driver
+
+
+_RECORD_DTYPE = numpy.dtype([("timestamp", "<u8"), ("direction", "u1"), ("port_index", "u1"), ("length", "<u2")])
+_RECORD_LENGTH = struct.Struct("<H")
+
+
+def _create_crc_table_2d(size):
+    # CRC of every byte value followed by 0 to size - 1 zero bytes
+    table = numpy.zeros((size, 256), numpy.uint8)
+    table[0] = numpy.frombuffer(CRC_TABLE, numpy.uint8)
+    for distance in range(1, size):
+        table[distance] = numpy.frombuffer(CRC_TABLE, numpy.uint8)[table[distance - 1]]
+    return table
+
+
+def _get_record_offsets(buffer, offset, end):
+    # Returns the offsets of the complete records from offset up to end and the offset of the next record
+    unpack_length = _RECORD_LENGTH.unpack_from
+    header_size = BusCapture.RECORD.size
+    length_offset = header_size - _RECORD_LENGTH.size
+    size = len(buffer)
+    end = min(end, size - header_size + 1)
+    offsets = array.array("q")
+    append = offsets.append
+    while offset < end:
+        next_offset = offset + header_size + unpack_length(buffer, offset + length_offset)[0]
+        if next_offset > size:
+            # Record not completely written
+            break
+        append(offset)
+        offset = next_offset
+    return numpy.frombuffer(offsets, numpy.int64), offset
+
+
+class _StreamDecoder:
+
+    # Unstuffed frame without STX and ETX
+    _MIN_SIZE = DataPacket.MIN_PACKET_SIZE - 2
+    _MAX_SIZE = DataPacket.MAX_PACKET_SIZE - 2
+    _CRC_TABLE_2D = _create_crc_table_2d(_MAX_SIZE).reshape(-1)
+
+    def __init__(self, analyzer, port_name):
+        self._analyzer = analyzer
+        self._port_name = port_name
+        self._rest = numpy.zeros(0, numpy.uint8)
+        self._rest_times = numpy.zeros(0, numpy.int64)
+        self._position = 0
+
+    def feed(self, data, times=None, final=False):
+        # Data: uint8 array, times: time of every byte (None: the position of the byte in the stream)
+        if times is None:
+            times = numpy.arange(self._position, self._position + len(data), dtype=numpy.int64)
+        self._position += len(data)
+        if len(self._rest) > 0:
+            data = numpy.concatenate((self._rest, data))
+            times = numpy.concatenate((self._rest_times, times))
+        end = len(data)
+        if not final:
+            # Keep the data after the last ETX for the next chunk (if not too long to be a frame)
+            etx = numpy.flatnonzero(data == DataPacket.ETX)
+            end = etx[-1] + 1 if len(etx) > 0 else 0
+            if len(data) - end > 2 * DataPacket.MAX_PACKET_SIZE:
+                end = len(data) - 2 * DataPacket.MAX_PACKET_SIZE
+        self._rest = data[end:].copy()
+        self._rest_times = times[end:].copy()
+        self._decode(data[:end], times[:end])
+
+    def _decode(self, data, times):
+        stx = numpy.flatnonzero(data == DataPacket.STX)
+        etx = numpy.flatnonzero(data == DataPacket.ETX)
+        if len(stx) == 0:
+            return
+        # Start of the frame: last STX before the ETX, there may not be an ETX between the STX and the ETX
+        index = numpy.searchsorted(stx, etx) - 1
+        previous_etx = numpy.concatenate(([-1], etx[:-1]))
+        valid = index >= 0
+        start = stx[numpy.maximum(index, 0)]
+        valid &= start > previous_etx
+        start = start[valid]
+        end = etx[valid]
+        # STXs that are not the start of a frame are framing errors
+        n_errors = len(stx) - len(start)
+
+        # Byte stuffing, the positions of the DLEs are used to count them per frame
+        is_dle = data == DataPacket.DLE
+        dle = numpy.flatnonzero(is_dle)
+        double_dle = dle[1:][numpy.diff(dle) == 1]
+        # The STX is not a DLE, so the number of DLEs before the STX is also the number before the first byte
+        dle_start = numpy.searchsorted(dle, start)
+        size = end - start - 1 - (numpy.searchsorted(dle, end) - dle_start)
+        valid = ((size >= self._MIN_SIZE) & (size <= self._MAX_SIZE) & (data[end - 1] != DataPacket.DLE) &
+                 (numpy.searchsorted(double_dle, end) == numpy.searchsorted(double_dle, start)))
+        n_errors += int(numpy.count_nonzero(~valid))
+        start = start[valid]
+        end = end[valid]
+        size = size[valid]
+        dle_start = dle_start[valid]
+        n_frames = len(start)
+        if n_frames == 0:
+            self._analyzer.add_frames(self._port_name, n_errors=n_errors)
+            return
+
+        # Remove the byte stuffing of all data at once, the frames stay in one piece
+        # The byte after the n-th DLE (n = 0, 1, ...) moves n + 1 positions when the DLEs are removed
+        values = data[~is_dle]
+        escaped = dle - numpy.arange(len(dle))
+        values[escaped[escaped < len(values)]] ^= 0xFF
+        first = start + 1 - dle_start
+        last = first + size
+
+        # The CRC is linear: the CRC of a frame is the XOR of the CRCs of each byte followed by the remaining bytes
+        # as zeros, so the CRC of every byte is looked up by distance to the end of its frame and XORed per frame
+        gaps = numpy.diff(numpy.concatenate(([0], last, [len(values)])))
+        distance = (numpy.repeat(numpy.concatenate((last, [len(values)])).astype(numpy.int32), gaps) -
+                    numpy.arange(1, len(values) + 1, dtype=numpy.int32))
+        numpy.minimum(distance, self._MAX_SIZE - 1, out=distance)
+        distance <<= 8
+        distance |= values
+        crc_values = self._CRC_TABLE_2D[distance]
+        bounds = numpy.empty(2 * n_frames, numpy.int64)
+        bounds[0::2] = first
+        bounds[1::2] = last
+        crc = numpy.bitwise_xor.reduceat(crc_values, bounds[:-1] if last[-1] == len(values) else bounds)[0::2]
+        self._analyzer.add_frames(
+            self._port_name,
+            times[end],
+            values[first],
+            values[first + 1],
+            (values[first + 2].astype(numpy.uint16) << 8) | values[first + 3],
+            crc == 0,
+            n_errors
+        )
+
+
+class BusLogAnalyzer:
+
+    CHUNK_SIZE = 1 << 24
+
+    def __init__(self, baud_rate=RS485Driver.BAUD_RATE):
+        self._baud_rate = baud_rate
+        self._frames = []
+        self._port_names = {}
+        self._n_framing_errors = 0
+        self._n_bytes = 0
+        self._time_range = None
+
+    def add_frames(self, port_name, times=None, dsn=None, ssn=None, pid=None, crc_ok=None, n_errors=0):
+        self._n_framing_errors += n_errors
+        if times is not None:
+            port_index = self._port_names.setdefault(port_name, len(self._port_names))
+            self._frames.append((numpy.full(len(times), port_index, numpy.uint8), times, dsn, ssn, pid, crc_ok))
+
+    def analyze_raw(self, data, port_name="raw"):
+        # Raw dump (bytes, bytearray, mmap or memoryview), the requests and responses are in one stream
+        data = numpy.frombuffer(data, numpy.uint8)
+        decoder = _StreamDecoder(self, port_name)
+        for start in range(0, len(data), self.CHUNK_SIZE):
+            decoder.feed(data[start:start + self.CHUNK_SIZE])
+        decoder.feed(numpy.zeros(0, numpy.uint8), final=True)
+        self._n_bytes += len(data)
+
+    def analyze_raw_file(self, filename):
+        with open(filename, "rb") as fp:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data_map:
+                self.analyze_raw(data_map, filename)
+
+    def _get_offset_chunks(self, index, buffer, headers):
+        # Yields the offsets of the complete records per chunk, from the index (if any) and the records after it
+        header_size = BusCapture.RECORD.size
+        max_offset = len(buffer) - header_size
+        offset = BusCapture.HEADER.size
+        if index is not None:
+            indexed = numpy.frombuffer(index, "<u8")
+            n_records = max(self.CHUNK_SIZE // header_size, 1)
+            for start in range(0, len(indexed), n_records):
+                offsets = indexed[start:start + n_records]
+                in_file = offsets <= max_offset
+                n_valid = len(offsets) if in_file.all() else int(numpy.argmin(in_file))
+                offsets = offsets[:n_valid].astype(numpy.int64)
+                ends = offsets + header_size + headers["length"][offsets]
+                valid = (numpy.concatenate(([offset], ends[:-1])) == offsets) & (ends <= len(buffer))
+                if not valid.all():
+                    n_valid = int(numpy.argmin(valid))
+                if n_valid > 0:
+                    yield offsets[:n_valid]
+                    offset = int(ends[n_valid - 1])
+                if n_valid < min(n_records, len(indexed) - start):
+                    break
+        while True:
+            offsets, offset = _get_record_offsets(buffer, offset, offset + self.CHUNK_SIZE)
+            if len(offsets) == 0:
+                return
+            yield offsets
+
+    def analyze_capture(self, reader):
+        # The TX and RX data of every port are decoded as separate streams, every byte gets the time of its record
+        buffer = reader.get_buffer()
+        header_size = BusCapture.RECORD.size
+        if len(buffer) < BusCapture.HEADER.size + header_size:
+            return
+        data = numpy.frombuffer(buffer, numpy.uint8)
+        # A record header at every byte position of the file, the offsets select the real records
+        headers = numpy.ndarray((len(buffer) - header_size + 1, ), _RECORD_DTYPE, buffer, 0, (1, ))
+        ports = {}
+        decoders = {}
+        for offsets in self._get_offset_chunks(reader.get_index(), buffer, headers):
+            records = headers[offsets]
+            for index in numpy.flatnonzero(records["direction"] == BusCapture.DIRECTION_PORT):
+                start = int(offsets[index]) + header_size
+                ports[int(records["port_index"][index])] = bytes(buffer[start:start + int(records["length"][index])])
+            is_frame = ((records["direction"] == BusCapture.DIRECTION_TX) |
+                        (records["direction"] == BusCapture.DIRECTION_RX))
+            offsets, records = offsets[is_frame], records[is_frame]
+            if len(records) == 0:
+                continue
+            timestamps = records["timestamp"].astype(numpy.int64)
+            first, last = int(timestamps.min()), int(timestamps.max())
+            if self._time_range is not None:
+                first, last = min(first, self._time_range[0]), max(last, self._time_range[1])
+            self._time_range = (first, last)
+            keys = records["port_index"].astype(numpy.int32) << 8 | records["direction"]
+            for key in numpy.unique(keys):
+                selection = keys == key
+                if key not in decoders:
+                    decoders[key] = _StreamDecoder(self, ports.get(int(key) >> 8, b"").decode())
+                self._feed_records(decoders[key], data, offsets[selection] + header_size,
+                                   records["length"][selection].astype(numpy.int64), timestamps[selection])
+        for decoder in decoders.values():
+            decoder.feed(numpy.zeros(0, numpy.uint8), numpy.zeros(0, numpy.int64), True)
+
+    def _feed_records(self, decoder, data, starts, lengths, timestamps):
+        # Gathers the data of the records (start and length in the file) of one stream
+        n_bytes = int(lengths.sum())
+        self._n_bytes += n_bytes
+        indices = numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+        indices += numpy.arange(n_bytes)
+        decoder.feed(data[indices], numpy.repeat(timestamps, lengths))
+
+    def _get_slot_statistics(self, times, dsn, ssn, pid):
+        # Statistics per slot of the frames of one port (with a valid CRC)
+        is_request = dsn != 0
+        slot = numpy.where(is_request, dsn, ssn)
+        # Pair requests and responses: sort by PID and time, a response belongs to the last request before it
+        order = numpy.lexsort((times, pid))
+        positions = numpy.arange(len(order))
+        last_request = numpy.maximum.accumulate(numpy.where(is_request[order], positions, -1))
+        responses = positions[~is_request[order]]
+        requests = last_request[responses]
+        response_index = order[responses[requests >= 0]]
+        request_index = order[requests[requests >= 0]]
+        paired = ((pid[response_index] == pid[request_index]) &
+                  ((slot[request_index] == slot[response_index]) | (slot[request_index] == 0xFF)))
+        response_index, request_index = response_index[paired], request_index[paired]
+        answered = numpy.zeros(len(times), bool)
+        answered[request_index] = True
+        latency = (times[response_index] - times[request_index]) / 1e3
+
+        slots = {}
+        for value in numpy.unique(slot):
+            slot_requests = is_request & (slot == value)
+            statistics = {
+                "requests": int(numpy.count_nonzero(slot_requests)),
+                "responses": int(numpy.count_nonzero(~is_request & (slot == value))),
+                "unanswered": int(numpy.count_nonzero(slot_requests & ~answered)) if value != 0xFF else 0,
+                "latency_us": None
+            }
+            slot_latency = latency[slot[response_index] == value]
+            if self._time_range is not None and len(slot_latency) > 0:
+                statistics["latency_us"] = {
+                    "mean": float(slot_latency.mean()),
+                    "p50": float(numpy.percentile(slot_latency, 50)),
+                    "p90": float(numpy.percentile(slot_latency, 90)),
+                    "p99": float(numpy.percentile(slot_latency, 99)),
+                    "max": float(slot_latency.max())
+                }
+            slots[int(value)] = statistics
+        return slots
+
+    def get_report(self):
+        report = {
+            "frames": 0,
+            "crc_errors": 0,
+            "framing_errors": self._n_framing_errors,
+            "error_rate": 0.0,
+            "bytes": self._n_bytes,
+            "duration": None,
+            "bus_utilization": None,
+            "ports": {}
+        }
+        if self._time_range is not None and self._time_range[1] > self._time_range[0]:
+            duration = (self._time_range[1] - self._time_range[0]) / 1e9
+            report["duration"] = duration
+            # 10 bits per byte (start and stop bit), average of the ports (every port is a bus)
+            report["bus_utilization"] = 10 * self._n_bytes / self._baud_rate / duration / max(len(self._port_names), 1)
+        if len(self._frames) == 0:
+            return report
+        port, times, dsn, ssn, pid, crc_ok = (numpy.concatenate(values) for values in zip(*self._frames))
+        report["frames"] = len(times)
+        report["crc_errors"] = int(numpy.count_nonzero(~crc_ok))
+        report["error_rate"] = ((report["crc_errors"] + self._n_framing_errors) /
+                                (report["frames"] + self._n_framing_errors))
+        for port_name, port_index in self._port_names.items():
+            selection = crc_ok & (port == port_index)
+            report["ports"][port_name] = self._get_slot_statistics(times[selection], dsn[selection], ssn[selection],
+                                                                   pid[selection])
+        return report
+
+    @staticmethod
+    def format_report(report):
+        lines = [
+            f"Frames          : {report['frames']}",
+            f"CRC errors      : {report['crc_errors']}",
+            f"Framing errors  : {report['framing_errors']}",
+            f"Error rate      : {100 * report['error_rate']:.3f}%",
+            f"Bytes           : {report['bytes']}"
+        ]
+        if report["duration"] is not None:
+            lines.append(f"Duration        : {report['duration']:.3f} s")
+            lines.append(f"Bus utilization : {100 * report['bus_utilization']:.1f}%")
+        for port_name, slots in report["ports"].items():
+            lines.append("")
+            lines.append(f"Port: {port_name}")
+            lines.append("Slot  Requests  Responses  Unanswered    Mean(us)     P50(us)     P99(us)     Max(us)")
+            for slot, statistics in sorted(slots.items()):
+                line = (f"{'all' if slot == 0xFF else slot:>4}  {statistics['requests']:>8}"
+                        f"  {statistics['responses']:>9}  {statistics['unanswered']:>10}")
+                latency = statistics["latency_us"]
+                if latency is not None:
+                    line += "".join(f"  {latency[name]:>10.1f}" for name in ("mean", "p50", "p99", "max"))
+                lines.append(line)
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_bus_log_analyzer import TestBusLogAnalyzer
+
+    TestBusLogAnalyzer().run()
@@ -0,0 +1,268 @@
+"""
+Bus scheduler, one per port.
+Keeps multiple requests in flight to different slots (pipelining) instead of waiting for each response.
+
+- At most one request per slot and at most 'window' requests in flight.
+- A broadcast (DSN 0xFF) is only sent when nothing else is in flight, because all modules respond.
+- PIDs are assigned when the request is sent, from the normal or the detection range.
+- The bus is half duplex: after sending a request, the bus is reserved for the request, the response time of the
+  module and the response (time calculated from the frame length and baud rate, maximum response length).
+  The next request is sent when the bus is free, this prevents collisions with module responses as long as the
+  modules start their response within the response time (response_time_us, set it to the slowest module).
+  When the response is received, the bus is released immediately.
+- A request that is cancelled by the caller while it is queued is not sent. Once sent, it cannot be cancelled.
+
+Requests are sent using the TX queue of the RS485 driver.
+Responses are matched by the request table, the LilySystem passes the received packets to the request table.
+
+With a retry policy, a request that timed out is queued again after a backoff time (not for broadcasts).
+A retry gets a new PID, so a late response for the previous attempt is not taken as response for the retry.
+With a circuit breaker, requests for a slot that stopped responding are rejected directly (CircuitOpenError).
+The breaker state is kept per slot (the broadcast has its own state), a slot without a module does not block the
+other slots. Only a request that failed after all its attempts counts as failure, not each attempt.
+The scheduler thread also expires the requests in the request table at their deadline (time outs).
+"""
+
+import collections
+import concurrent.futures
+import functools
+import threading
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.retry_policy import CircuitOpenError
+
+
+class _QueuedRequest:
+
+    __slots__ = ("packet", "timeout", "detection", "future", "retries", "deadline", "attempt", "not_before")
+
+    def __init__(self, packet, timeout, detection, future, retries, deadline):
+        self.packet = packet
+        self.timeout = timeout
+        self.detection = detection
+        self.future = future
+        self.retries = retries
+        self.deadline = deadline
+        self.attempt = 0
+        self.not_before = 0
+
+
+class BusScheduler:
+
+    BAUD_RATE = 250000
+    TURN_AROUND_US = 100
+    # Maximum time from the end of a request until a module starts its response
+    RESPONSE_TIME_US = 1000
+    MAX_SLOTS = 9
+    # Start bit, 8 data bits, stop bit
+    _BITS_PER_BYTE = 10
+    # Maximum response size with byte stuffing on every byte except STX and ETX
+    _MAX_RESPONSE_SIZE = 2 * DataPacket.MAX_PACKET_SIZE - 2
+    _BROADCAST = 0xFF
+
+    def __init__(self, driver, request_table, pid_ranges, window=4, baud_rate=BAUD_RATE, retry_policy=None,
+                 circuit_breaker=None, metrics=None, response_time_us=RESPONSE_TIME_US):
+        self._driver = driver
+        self._response_time = response_time_us / 1000000
+        self._retry_policy = retry_policy
+        self._circuit_breaker = circuit_breaker
+        self._metrics = metrics
+        self._port_name = driver.get_port()
+        self._requests = request_table
+        self._pid_ranges = pid_ranges
+        self._pids = [pid_range[0] for pid_range in pid_ranges]
+        self._window = window
+        self._byte_time = self._BITS_PER_BYTE / baud_rate
+        self._queue = collections.deque()
+        self._in_flight = {}
+        self._last_sent_slot = None
+        self._bus_free_at = 0
+        self._condition = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._schedule)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _get_pid(self, detection):
+        index = 1 if detection else 0
+        pid = self._pids[index]
+        self._pids[index] += 1
+        if self._pids[index] > self._pid_ranges[index][1]:
+            self._pids[index] = self._pid_ranges[index][0]
+        return pid
+
+    def _get_next_request(self, now):
+        # Returns the next request and the time to wait for a request in backoff (if no request)
+        backoff_wait = None
+        if self._BROADCAST in self._in_flight or len(self._in_flight) >= self._window:
+            return None, backoff_wait
+        for request in self._queue:
+            if request.not_before > now:
+                wait = request.not_before - now
+                backoff_wait = wait if backoff_wait is None else min(backoff_wait, wait)
+                continue
+            if request.packet.dsn == self._BROADCAST:
+                if len(self._in_flight) == 0:
+                    return request, None
+                # Wait for the broadcast, keep the order
+                return None, backoff_wait
+            if request.packet.dsn not in self._in_flight:
+                return request, None
+        return None, backoff_wait
+
+    def _get_bus_time(self, n_tx_bytes, dsn):
+        n_responses = self.MAX_SLOTS if dsn == self._BROADCAST else 1
+        n_bytes = n_tx_bytes + n_responses * self._MAX_RESPONSE_SIZE
+        return n_bytes * self._byte_time + n_responses * (self.TURN_AROUND_US / 1000000 + self._response_time)
+
+    def _schedule(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stop:
+                        return
+                    now = time.monotonic()
+                    deadline = self._requests.get_next_deadline()
+                    if deadline is not None and deadline <= now:
+                        request = None
+                        break
+                    request, wait = self._get_next_request(now)
+                    if request is not None:
+                        wait = self._bus_free_at - time.perf_counter()
+                        if wait <= 0:
+                            break
+                    if deadline is not None and (wait is None or deadline - now < wait):
+                        wait = deadline - now
+                    self._condition.wait(wait)
+                if request is not None:
+                    self._queue.remove(request)
+                    if request.attempt == 0 and not request.future.set_running_or_notify_cancel():
+                        # Cancelled while queued, not sent
+                        continue
+                    packet = request.packet
+                    packet.pid = self._get_pid(request.detection)
+                    data = packet.get_data()
+                    self._in_flight[packet.dsn] = packet.pid
+                    self._last_sent_slot = packet.dsn
+                    self._bus_free_at = time.perf_counter() + self._get_bus_time(len(data), packet.dsn)
+            if request is None:
+                # Expire outside the lock, the futures call back into the schedulers
+                self._requests.expire()
+                continue
+            timeout = request.timeout
+            if request.deadline is not None:
+                timeout = max(0, min(timeout, request.deadline - time.monotonic()))
+            future = self._requests.add(self._port_name, packet, timeout)
+            future.add_done_callback(functools.partial(self._on_request_done, request))
+            self._driver.send_data(data, functools.partial(self._requests.set_tx_time, self._port_name, packet.pid))
+
+    def _is_success(self, request, future):
+        if future.cancelled() or future.exception() is not None:
+            return False
+        # A broadcast without any response is a failure
+        return request.packet.dsn != self._BROADCAST or len(future.result()) > 0
+
+    def _retry(self, request, future):
+        # Queue the request again if it timed out and retries and time are left
+        if self._retry_policy is None or future.cancelled() or not isinstance(future.exception(), TimeoutError):
+            return False
+        if request.attempt >= request.retries:
+            return False
+        now = time.monotonic()
+        backoff = self._retry_policy.get_backoff(request.attempt + 1)
+        if request.deadline is not None and now + backoff >= request.deadline:
+            return False
+        if self._circuit_breaker is not None and not self._circuit_breaker.allow_request(request.packet.dsn):
+            return False
+        request.attempt += 1
+        request.not_before = now + backoff
+        self._queue.appendleft(request)
+        if self._metrics is not None:
+            self._metrics.retries += 1
+        return True
+
+    def _on_request_done(self, request, future):
+        slot = request.packet.dsn
+        success = self._is_success(request, future)
+        with self._condition:
+            self._in_flight.pop(slot, None)
+            if slot == self._last_sent_slot and not future.cancelled() and future.exception() is None:
+                # Response received, bus is free after the turn around time
+                self._bus_free_at = min(self._bus_free_at, time.perf_counter() + self.TURN_AROUND_US / 1000000)
+            retried = not success and self._retry(request, future)
+            self._condition.notify()
+        if retried:
+            return
+        if self._circuit_breaker is not None:
+            if success:
+                self._circuit_breaker.on_success(slot)
+            elif not future.cancelled():
+                self._circuit_breaker.on_failure(slot)
+        outer_future = request.future
+        if outer_future.done():
+            return
+        if future.cancelled():
+            # The outer future is running, so it cannot be cancelled anymore
+            outer_future.set_exception(concurrent.futures.CancelledError())
+        elif future.exception() is not None:
+            outer_future.set_exception(future.exception())
+        else:
+            outer_future.set_result(future.result())
+
+    def submit(self, dsn, data, timeout=None, callback=None, detection=False, retries=None, deadline=None):
+        # Returns a future with the response (list of responses for a broadcast)
+        # Time out is per attempt, the deadline is for all attempts (seconds from now)
+        packet = DataPacket()
+        packet.dsn = dsn
+        packet.ssn = 0
+        packet.data = data
+        # The PID is assigned when sending, use a temporary PID for checking the packet
+        packet.pid = 1
+        if len(packet.get_data()) == 0:
+            raise ValueError("Invalid request packet")
+        future = concurrent.futures.Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        if self._circuit_breaker is not None and not self._circuit_breaker.allow_request(dsn):
+            future.set_exception(CircuitOpenError(f"Slot {dsn} of port {self._port_name} is not responding"))
+            return future
+        policy = self._retry_policy
+        if policy is not None:
+            if timeout is None:
+                timeout = policy.timeout
+            if retries is None:
+                retries = policy.retries
+            if deadline is None:
+                deadline = policy.deadline
+        if timeout is None:
+            timeout = self._requests.get_timeout()
+        if retries is None or dsn == self._BROADCAST:
+            retries = 0
+        if deadline is not None:
+            deadline = time.monotonic() + deadline
+        with self._condition:
+            self._queue.append(_QueuedRequest(packet, timeout, detection, future, retries, deadline))
+            self._condition.notify()
+        return future
+
+    def get_queue_size(self):
+        with self._condition:
+            return len(self._queue)
+
+    def get_in_flight(self):
+        with self._condition:
+            return len(self._in_flight)
+
+    def close(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        self._thread.join()
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_bus_scheduler import TestBusScheduler
+
+    TestBusScheduler().run()
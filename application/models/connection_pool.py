@@ -0,0 +1,409 @@
+"""
+Connection pool for the TCP endpoints (simulators and TCP to RS-485 gateways): socket://<host>:<port>.
+
+All drivers for the same endpoint share one TCP connection and one receive thread.
+Each driver has its own client (same methods as the serial port class, like the TCP client).
+The received frames of a client are kept in a ring buffer (see ring_buffer), a frame that does not fit is dropped
+and counted.
+
+Routing of the responses:
+- the clients of an endpoint use the same PIDs (every bus scheduler uses the same PID ranges), so the PID of every
+  packet written by a client is replaced by a PID of the connection that is not in use, and the route is registered
+- a received frame with a registered PID gets the original PID back and is passed to that client only
+- the route is removed when the response is delivered (a broadcast gets responses of all modules, so its route is
+  kept until ROUTE_TIMEOUT), routes without a response are removed after ROUTE_TIMEOUT
+- a received frame with an unknown PID is passed to all clients (like on the bus)
+Only complete frames are written, other data written by a client is dropped.
+
+Reconnect:
+- the first connection is made when the first client is opened, an error is raised if it fails (like the TCP client)
+- when the connection is lost, it is made again in the background with exponential backoff and jitter
+- while there is no connection, written data is dropped (and counted), the requests time out and are retried
+- the data that was received before the connection was lost can still be read, a partly received frame is dropped
+The connects, disconnects and dropped bytes are reported in the counters of the connection (get_counters).
+
+The connection is closed when its last client is closed.
+The first connection to an endpoint is made without holding the lock of the pool, an endpoint that does not respond
+does not block opening and closing clients of other endpoints.
+"""
+
+import collections
+import socket
+import threading
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+from application.models.retry_policy import RetryPolicy
+from application.models.ring_buffer import RingBuffer
+
+
+class PooledClient:
+
+    _BUFFER_SIZE = 1500
+    _RX_BUFFER_SIZE = 1 << 20
+
+    def __init__(self, connection, rx_buffer_size=_RX_BUFFER_SIZE):
+        self.port = connection.port
+        self.is_open = True
+        self._connection = connection
+        self._rx_buffer = RingBuffer(rx_buffer_size)
+        self._rx_dropped_bytes = 0
+        self._condition = threading.Condition()
+        self._notify_r = None
+        self._notify_w = None
+
+    @property
+    def in_waiting(self):
+        return len(self._rx_buffer)
+
+    @property
+    def is_connected(self):
+        return self._connection.is_connected
+
+    def add_rx_data(self, frame):
+        # Called from the receive thread of the connection, the receive thread does not wait for a full buffer
+        with self._condition:
+            if self._rx_buffer.get_size() - len(self._rx_buffer) < len(frame):
+                # The frame is written completely or not at all
+                self._rx_dropped_bytes += len(frame)
+                return
+            if len(self._rx_buffer) == 0:
+                self._notify()
+            self._rx_buffer.write(frame)
+            self._condition.notify_all()
+
+    def _notify(self):
+        if self._notify_w is not None:
+            try:
+                self._notify_w.send(b"\x00")
+            except (BlockingIOError, OSError):
+                pass
+
+    def _clear_notification(self):
+        if self._notify_r is not None:
+            try:
+                while len(self._notify_r.recv(self._BUFFER_SIZE)) > 0:
+                    pass
+            except BlockingIOError:
+                pass
+
+    def _wait_for_data(self, timeout):
+        # With a time out, waits until data is received (None is forever), like the TCP client
+        if timeout is None or timeout > 0:
+            self._condition.wait_for(lambda: len(self._rx_buffer) > 0 or not self.is_open, timeout)
+
+    def read(self, n_bytes=1, timeout=0):
+        with self._condition:
+            self._wait_for_data(timeout)
+            data_out = self._rx_buffer.read(n_bytes)
+            if len(self._rx_buffer) == 0:
+                self._clear_notification()
+        return data_out
+
+    def readinto(self, buffer, timeout=0):
+        # Reads into the buffer (bytearray or memoryview), returns the number of bytes
+        with self._condition:
+            self._wait_for_data(timeout)
+            n_bytes = self._rx_buffer.readinto(buffer)
+            if len(self._rx_buffer) == 0:
+                self._clear_notification()
+        return n_bytes
+
+    def write(self, data):
+        self._connection.send(self, data)
+
+    def fileno(self):
+        with self._condition:
+            if self._notify_r is None:
+                self._notify_r, self._notify_w = socket.socketpair()
+                self._notify_r.setblocking(False)
+                self._notify_w.setblocking(False)
+                if len(self._rx_buffer) > 0:
+                    self._notify()
+        return self._notify_r.fileno()
+
+    def get_counters(self):
+        # Counters of the connection and the dropped bytes of this client
+        counters = self._connection.get_counters()
+        with self._condition:
+            counters["rx_dropped_bytes"] = self._rx_dropped_bytes
+        return counters
+
+    def close(self):
+        with self._condition:
+            if not self.is_open:
+                return
+            self.is_open = False
+            self._condition.notify_all()
+            if self._notify_r is not None:
+                self._notify_r.close()
+                self._notify_w.close()
+                self._notify_r = None
+                self._notify_w = None
+        ConnectionPool.release(self._connection, self)
+
+
+class PooledConnection:
+
+    CONNECT_TIMEOUT = 2
+    ROUTE_TIMEOUT = 10
+    _RX_BUFFER_SIZE = 65536
+    _PID_RANGE = (0x0001, 0xFFFF)
+    _BROADCAST = 0xFF
+
+    def __init__(self, host, port, retry_policy=None):
+        self.port = f"socket://{host}:{port}"
+        self.is_connected = False
+        self._address = (host, port)
+        # Only the backoff of the retry policy is used, retries and deadline are not limited
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy(backoff=0.1, max_backoff=5)
+        self._clients = []
+        # {PID on the connection: (client, PID of the client, broadcast)}, the routes in order of their time out
+        self._routes = {}
+        self._route_timeouts = collections.deque()
+        self._pid = self._PID_RANGE[0]
+        self._counters = {"connects": 0, "disconnects": 0, "rx_frames": 0, "tx_dropped_bytes": 0}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._sock = None
+        # The first connection is made directly, errors are raised
+        self._connect()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _connect(self):
+        sock = socket.create_connection(self._address, self.CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        with self._lock:
+            self._sock = sock
+            self.is_connected = True
+            self._counters["connects"] += 1
+
+    def _reconnect(self):
+        # Returns True when connected, False when the connection is closed
+        attempt = 0
+        while not self._stop_event.is_set():
+            attempt += 1
+            if self._stop_event.wait(self._retry_policy.get_backoff(attempt)):
+                break
+            try:
+                self._connect()
+                return True
+            except OSError:
+                pass
+        return False
+
+    def _disconnect(self):
+        with self._lock:
+            sock = self._sock
+            self._sock = None
+            if self.is_connected:
+                self.is_connected = False
+                self._counters["disconnects"] += 1
+        if sock is not None:
+            sock.close()
+
+    def _remove_expired_routes(self, now):
+        # Must be called with the lock
+        while len(self._route_timeouts) > 0 and self._route_timeouts[0][0] <= now:
+            _timeout, pid, route = self._route_timeouts.popleft()
+            if self._routes.get(pid, None) is route:
+                del self._routes[pid]
+
+    def _get_free_pid(self):
+        # Returns the next PID that is not in use, must be called with the lock
+        for _ in range(self._PID_RANGE[1] - self._PID_RANGE[0] + 1):
+            pid = self._pid
+            self._pid = self._pid + 1 if self._pid < self._PID_RANGE[1] else self._PID_RANGE[0]
+            if pid not in self._routes:
+                return pid
+        # All PIDs in use, the oldest routes are replaced
+        return pid
+
+    def _add_routes(self, client, data):
+        # Returns the data with the PIDs of the connection, only the complete frames
+        packets = []
+        for frame in FrameDecoder().feed(data):
+            packet = DataPacket()
+            if packet.from_data(frame) == DataPacket.STATUS_OK:
+                packets.append(packet)
+        buffer = bytearray()
+        now = time.monotonic()
+        with self._lock:
+            self._remove_expired_routes(now)
+            for packet in packets:
+                route = (client, packet.pid, packet.dsn == self._BROADCAST)
+                packet.pid = self._get_free_pid()
+                self._routes[packet.pid] = route
+                self._route_timeouts.append((now + self.ROUTE_TIMEOUT, packet.pid, route))
+                packet.encode_into(buffer)
+        return bytes(buffer)
+
+    def _route(self, frame):
+        packet = DataPacket()
+        route = None
+        with self._lock:
+            self._counters["rx_frames"] += 1
+            if packet.from_data(frame) == DataPacket.STATUS_OK:
+                route = self._routes.get(packet.pid, None)
+            if route is None:
+                clients = list(self._clients)
+            else:
+                clients = [route[0]]
+                if not route[2]:
+                    del self._routes[packet.pid]
+        if route is not None:
+            packet.pid = route[1]
+            frame = packet.get_data(True)
+        for client in clients:
+            client.add_rx_data(frame)
+
+    def _receive(self, sock):
+        # Receives until the connection is lost or closed
+        decoder = FrameDecoder()
+        buffer = bytearray(self._RX_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while not self._stop_event.is_set():
+            try:
+                n_bytes = sock.recv_into(buffer)
+            except OSError:
+                break
+            if n_bytes == 0:
+                break
+            for frame in decoder.feed(view[:n_bytes]):
+                self._route(frame)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._lock:
+                sock = self._sock
+            if sock is not None:
+                self._receive(sock)
+            self._disconnect()
+            if not self._reconnect():
+                break
+
+    def add_client(self, client):
+        with self._lock:
+            self._clients.append(client)
+
+    def remove_client(self, client):
+        # Returns the number of clients left
+        with self._lock:
+            self._clients.remove(client)
+            self._routes = {pid: route for pid, route in self._routes.items() if route[0] is not client}
+            return len(self._clients)
+
+    def get_routes(self):
+        # Returns the number of routes waiting for a response
+        with self._lock:
+            return len(self._routes)
+
+    def send(self, client, data):
+        data = self._add_routes(client, data)
+        with self._lock:
+            sock = self._sock
+        if sock is None:
+            with self._lock:
+                self._counters["tx_dropped_bytes"] += len(data)
+            return
+        try:
+            with self._send_lock:
+                sock.sendall(data)
+        except OSError:
+            # The receive thread detects the lost connection and reconnects
+            with self._lock:
+                self._counters["tx_dropped_bytes"] += len(data)
+
+    def get_counters(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["connected"] = self.is_connected
+            counters["clients"] = len(self._clients)
+        return counters
+
+    def close(self):
+        self._stop_event.set()
+        with self._lock:
+            sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._disconnect()
+
+
+class ConnectionPool:
+
+    _connections = {}
+    # {host:port: event}, set when the first connection of the endpoint is made (or failed)
+    _connecting = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _add_client(cls, connection):
+        # Must be called with the lock
+        client = PooledClient(connection)
+        connection.add_client(client)
+        return client
+
+    @classmethod
+    def open(cls, host, port):
+        # Returns a new client for the endpoint, the connection is shared
+        key = f"{host}:{port}"
+        while True:
+            with cls._lock:
+                connection = cls._connections.get(key, None)
+                if connection is not None:
+                    return cls._add_client(connection)
+                connecting = cls._connecting.get(key, None)
+                if connecting is None:
+                    connecting = threading.Event()
+                    cls._connecting[key] = connecting
+                    break
+            # Another thread is connecting to the endpoint, if that fails this thread tries itself
+            connecting.wait()
+        try:
+            connection = PooledConnection(host, port)
+        except (Exception, ):
+            with cls._lock:
+                del cls._connecting[key]
+            connecting.set()
+            raise
+        with cls._lock:
+            del cls._connecting[key]
+            cls._connections[key] = connection
+            client = cls._add_client(connection)
+        connecting.set()
+        return client
+
+    @classmethod
+    def release(cls, connection, client):
+        # Closes the connection when the last client is released
+        with cls._lock:
+            if connection.remove_client(client) > 0:
+                return
+            for key, value in list(cls._connections.items()):
+                if value is connection:
+                    del cls._connections[key]
+        connection.close()
+
+    @classmethod
+    def get_counters(cls):
+        # Counters of all connections: {host:port: counters}
+        with cls._lock:
+            connections = dict(cls._connections)
+        return {key: connection.get_counters() for key, connection in connections.items()}
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_connection_pool import TestConnectionPool
+
+    TestConnectionPool().run()
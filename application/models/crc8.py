@@ -1,24 +1,74 @@
 """
 Calculate CRC (8 bit) over a byte array.
+
+The CRC is calculated using a precomputed table (256 entries) for polynome 0x07.
+Accepts bytes, bytearray, memoryview or a list of integers.
+For calculating the CRC while a packet is being built or received, use the Crc8 class.
+For checking many frames at once (offline capture analysis), use check_crcs.
 """
 
 CRC_POLY = 0x07
 
 
-def calculate_crc(data_bytes):
-    crc = 0
-    for byte in data_bytes:
-        crc ^= byte
+def _create_crc_table(poly):
+    table = []
+    for value in range(256):
+        crc = value
         for _i in range(8):
             if (crc & 0x80) > 0:
-                crc <<= 1
-                crc ^= CRC_POLY
+                crc = ((crc << 1) ^ poly) & 0xFF
             else:
-                crc <<= 1
-            crc &= 0xFF
+                crc = (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+CRC_TABLE = _create_crc_table(CRC_POLY)
+
+
+def calculate_crc(data_bytes, crc=0):
+    table = CRC_TABLE
+    for byte in data_bytes:
+        crc = table[crc ^ byte]
     return crc
 
 
+def check_crcs(frames):
+    # Checks unstuffed frames (<DSN><SSN><PID><DATA><CRC>), returns a list of booleans (True is CRC OK)
+    table = CRC_TABLE
+    results = []
+    for frame in frames:
+        crc = 0
+        if len(frame) < 2:
+            results.append(False)
+            continue
+        for byte in frame:
+            crc = table[crc ^ byte]
+        # Running the CRC over the data including its CRC results in 0
+        results.append(crc == 0)
+    return results
+
+
+class Crc8:
+
+    def __init__(self, data_bytes=b""):
+        self._crc = calculate_crc(data_bytes)
+
+    def update(self, data_bytes):
+        self._crc = calculate_crc(data_bytes, self._crc)
+        return self
+
+    def update_byte(self, byte):
+        self._crc = CRC_TABLE[self._crc ^ byte]
+        return self
+
+    def digest(self):
+        return self._crc
+
+    def reset(self):
+        self._crc = 0
+
+
 if __name__ == "__main__":
 
     from unit_tests.models.test_crc8 import TestCrc8
@@ -8,6 +8,12 @@ Data 1 ... 35 bytes.
 Minimum packet size: 8
 Maximum packet size: 42
 Bytes stuffing using DLE.
+
+The data is stored as bytes, decoded data is always copied (also when decoded from a list or a memoryview),
+so the caller can reuse its buffer.
+The data property returns the data as a list (compatible with older code) and can be modified.
+For fast access without conversion, use the payload property.
+To decode multiple fields of the data in one call, use a payload schema (see payload_schema).
 """
 
 import struct
@@ -15,38 +21,114 @@ import struct
 from application.models.crc8 import calculate_crc
 
 
+def _create_stuffing_table(special_bytes, dle):
+    # For every byte value the bytes to send
+    table = []
+    for byte in range(256):
+        if byte in special_bytes:
+            table.append(bytes([dle, ~byte & 0xFF]))
+        else:
+            table.append(bytes([byte]))
+    return tuple(table)
+
+
+def _create_number_structs(bytes_to_format):
+    # For every number of bytes and signed/unsigned: the padding and the struct to convert the bytes to a number
+    structs = {}
+    for n_bytes in range(9):
+        size = min(size for size in bytes_to_format if size >= n_bytes)
+        for signed in (False, True):
+            frmt = bytes_to_format[size].lower() if signed else bytes_to_format[size]
+            padding = (b"\xff" if signed else b"\x00") * (size - n_bytes)
+            structs[(n_bytes, signed)] = (padding, struct.Struct(">" + frmt))
+    return structs
+
+
 class DataPacket:
 
+    __slots__ = ("dsn", "ssn", "pid", "status", "_payload", "_data")
+
     STX = 0x02
     ETX = 0x04
     DLE = 0x20
     MIN_PACKET_SIZE = 8
+    MAX_PACKET_SIZE = 42
+    MAX_DATA_SIZE = 35
+
+    # Result of from_data
+    STATUS_OK = 0
+    STATUS_INVALID_SIZE = 1
+    STATUS_INVALID_FRAME = 2
+    STATUS_INVALID_STUFFING = 3
+    STATUS_CRC_ERROR = 4
 
     # Upper case is unsigned, lower case is signed
     _BYTES_TO_FORMAT = {1: "B", 2: "H", 4: "I", 8: "Q"}
+    _NUMBER_STRUCTS = _create_number_structs(_BYTES_TO_FORMAT)
 
     # We use the original IBM character encoding
     _ENCODING = "cp437"
 
+    _DLE_BYTES = bytes([DLE])
+    _SPECIAL_BYTES = bytes([STX, ETX, DLE])
+    _STUFFED_BYTES = _create_stuffing_table(_SPECIAL_BYTES, DLE)
+    _STUFFED_PAIRS = (
+        (_STUFFED_BYTES[STX], bytes([STX])),
+        (_STUFFED_BYTES[ETX], bytes([ETX])),
+        (_STUFFED_BYTES[DLE], bytes([DLE]))
+    )
+    _ASCII_TABLE = bytes(b if 31 < b < 127 else 46 for b in range(256))
+
     def __init__(self):
         self.dsn = 0
         self.ssn = 0
         self.pid = 0
-        self.data = []
+        self.status = self.STATUS_OK
+        self._payload = b""
+        self._data = None
 
     def __str__(self):
         output = "Properties:\n"
         output += f"DSN  : {self.dsn}\n"
         output += f"SSN  : {self.ssn}\n"
         output += f"PID  : {self.pid}\n"
-        output += f"Data : {self._represent(self.data)}"
+        output += f"Data : {self._represent(self.payload)}"
         return output
 
+    @property
+    def data(self):
+        if self._data is None:
+            # From now on the list is used, because it can be modified by the caller
+            self._data = list(self._payload)
+            self._payload = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        if isinstance(value, list):
+            self._data = value
+            self._payload = None
+        else:
+            self._data = None
+            self._payload = value
+
+    @property
+    def payload(self):
+        if self._data is not None:
+            return bytes(self._data)
+        return self._payload
+
+    @payload.setter
+    def payload(self, value):
+        self._data = None
+        self._payload = value
+
     def _init_packet(self):
         self.dsn = 0
         self.ssn = 0
         self.pid = 0
-        self.data = []
+        self._payload = b""
+        self._data = None
 
     def _represent(self, data):
         output = ""
@@ -55,81 +137,100 @@ class DataPacket:
         output += f"- {self.convert_data_to_string()}"
         return output
 
-    def _apply_byte_stuffing(self, data):
-        stuffed_data = []
-        for byte in data:
-            if byte in [self.STX, self.ETX, self.DLE]:
-                stuffed_data.append(self.DLE)
-                stuffed_data.append(~byte & 0xFF)
-            else:
-                stuffed_data.append(byte)
-        return stuffed_data
+    def _apply_byte_stuffing(self, data, buffer):
+        if len(data.translate(None, self._SPECIAL_BYTES)) == len(data):
+            buffer += data
+        else:
+            stuffed_bytes = self._STUFFED_BYTES
+            for byte in data:
+                buffer += stuffed_bytes[byte]
 
     def _remove_byte_stuffing(self, data):
-        unstuffed_data = []
-        stuffed_byte = False
-        for byte in data:
-            if byte == self.DLE:
-                stuffed_byte = True
-                continue
-            if stuffed_byte:
-                unstuffed_data.append(~byte & 0xFF)
-                stuffed_byte = False
-            else:
-                unstuffed_data.append(byte)
-        return unstuffed_data
+        # Returns None if the byte stuffing is not valid (DLE not followed by a data byte)
+        data = bytes(data)
+        pairs = self._STUFFED_PAIRS
+        if data.count(self.DLE) == data.count(pairs[0][0]) + data.count(pairs[1][0]) + data.count(pairs[2][0]):
+            # Only the special bytes are stuffed, replace the pairs (DLE last, it may not be replaced again)
+            for stuffed, unstuffed in pairs:
+                data = data.replace(stuffed, unstuffed)
+            return data
+        parts = data.split(self._DLE_BYTES)
+        unstuffed_data = bytearray(parts[0])
+        for part in parts[1:]:
+            if len(part) == 0:
+                return None
+            unstuffed_data.append(part[0] ^ 0xFF)
+            unstuffed_data += part[1:]
+        return bytes(unstuffed_data)
+
+    def _is_valid(self, payload, is_response):
+        return ((1 <= self.dsn <= 255 or (is_response and self.dsn == 0)) and 0 <= self.ssn <= 255 and
+                self.dsn != self.ssn and 1 <= self.pid <= 65535 and 1 <= len(payload) <= self.MAX_DATA_SIZE)
 
     def from_data(self, data_bytes):
         self._init_packet()
-        if len(data_bytes) >= self.MIN_PACKET_SIZE and data_bytes[0] == self.STX and data_bytes[-1] == self.ETX:
-            data_bytes = self._remove_byte_stuffing(data_bytes[1:-1])
-            if calculate_crc(data_bytes[:-1]) == data_bytes[-1]:
+        self.status = self.STATUS_OK
+        if len(data_bytes) < self.MIN_PACKET_SIZE:
+            self.status = self.STATUS_INVALID_SIZE
+        elif data_bytes[0] != self.STX or data_bytes[-1] != self.ETX:
+            self.status = self.STATUS_INVALID_FRAME
+        else:
+            data_bytes = data_bytes[1:-1]
+            if self.DLE in data_bytes:
+                data_bytes = self._remove_byte_stuffing(data_bytes)
+            if data_bytes is None:
+                self.status = self.STATUS_INVALID_STUFFING
+            elif not self.MIN_PACKET_SIZE - 2 <= len(data_bytes) <= self.MAX_PACKET_SIZE - 2:
+                self.status = self.STATUS_INVALID_SIZE
+            elif calculate_crc(data_bytes) != 0:
+                # Calculating the CRC over the data including the CRC results in 0
+                self.status = self.STATUS_CRC_ERROR
+            else:
                 self.dsn = data_bytes[0]
                 self.ssn = data_bytes[1]
-                self.pid = data_bytes[2] * 256 + data_bytes[3]
-                self.data = data_bytes[4:-1]
-
-    def get_data(self):
-        data_bytes = []
-        if (1 <= self.dsn <= 255 and 0 <= self.ssn <= 255 and self.dsn != self.ssn and
-                1 <= self.pid <= 65535 and 1 <= len(self.data) <= 35):
-            data_bytes.extend([
-                self.dsn,
-                self.ssn,
-                (self.pid >> 8) & 0xFF,
-                self.pid & 0xFF,
-            ])
-            data_bytes.extend(self.data)
-            crc = calculate_crc(data_bytes)
-            data_bytes.append(crc)
-            data_bytes = self._apply_byte_stuffing(data_bytes)
-            data_bytes.insert(0, self.STX)
-            data_bytes.append(self.ETX)
-        return bytes(data_bytes)
+                self.pid = (data_bytes[2] << 8) | data_bytes[3]
+                self._payload = bytes(data_bytes[4:-1])
+        return self.status
+
+    def encode_into(self, buffer, is_response=False):
+        # Appends the packet to the buffer (bytearray), returns the number of bytes added
+        # A response (from a module to the PC) is allowed to have DSN 0
+        payload = self.payload
+        if not self._is_valid(payload, is_response):
+            return 0
+        data_bytes = bytes((self.dsn, self.ssn, self.pid >> 8, self.pid & 0xFF)) + payload
+        data_bytes += bytes((calculate_crc(data_bytes),))
+        start = len(buffer)
+        buffer.append(self.STX)
+        self._apply_byte_stuffing(data_bytes, buffer)
+        buffer.append(self.ETX)
+        return len(buffer) - start
+
+    def get_data(self, is_response=False):
+        buffer = bytearray()
+        self.encode_into(buffer, is_response)
+        return bytes(buffer)
 
     def convert_data_to_number(self, n_bytes=0, offset=0, signed=False):
-        if n_bytes == 0 or n_bytes > len(self.data):
-            data_bytes = self.data[offset:]
+        payload = self.payload
+        if n_bytes == 0 or n_bytes > len(payload):
+            data_bytes = payload[offset:]
         else:
-            data_bytes = self.data[offset:offset + n_bytes]
+            data_bytes = payload[offset:offset + n_bytes]
         if len(data_bytes) > 8:
             raise Exception(f"Amount of bytes too big (> 8): {len(data_bytes)}")
-        while len(data_bytes) not in [1, 2, 4, 8]:
-            if signed:
-                data_bytes.insert(0, 255)
-            else:
-                data_bytes.insert(0, 0)
-        frmt = self._BYTES_TO_FORMAT[len(data_bytes)]
-        if signed:
-            frmt = frmt.lower()
-        return struct.unpack(">" + frmt, bytes(data_bytes))[0]
+        padding, number_struct = self._NUMBER_STRUCTS[(len(data_bytes), signed)]
+        return number_struct.unpack(padding + bytes(data_bytes))[0]
+
+    def decode_payload(self, schema):
+        # Returns a named tuple with the fields of the payload schema
+        return schema.decode(self.payload)
 
     def convert_data_to_string(self, ascii_only=True):
-        data = self.data.copy()
+        data = bytes(self.payload)
         if ascii_only:
-            for i in range(len(data)):
-                data[i] = data[i] if 31 < data[i] < 127 else 46
-        return bytes(data).decode(self._ENCODING)
+            data = data.translate(self._ASCII_TABLE)
+        return data.decode(self._ENCODING)
 
 
 if __name__ == "__main__":
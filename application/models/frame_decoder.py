@@ -0,0 +1,144 @@
+"""
+Frame decoder.
+Takes chunks of received data and returns the complete frames found in it.
+
+Frames can be split over multiple chunks, a chunk can contain multiple frames.
+While receiving a frame the byte stuffing is removed and the CRC is calculated on the fly.
+The returned frames are the frames as received (including STX, byte stuffing and ETX),
+so they can be passed to DataPacket.from_data().
+
+Frames are dropped when:
+- the unstuffed frame is longer than the maximum packet size (framing error)
+- a new STX is received before the ETX (framing error)
+- the frame is shorter than the minimum packet size (framing error)
+- the CRC is not correct (CRC error)
+"""
+
+from application.models.crc8 import CRC_TABLE
+from application.models.data_packet import DataPacket
+
+
+class FrameDecoder:
+
+    _STX = bytes([DataPacket.STX])
+    _ETX = bytes([DataPacket.ETX])
+    _DLE = bytes([DataPacket.DLE])
+
+    # Limits for the unstuffed frame without STX and ETX
+    _MIN_SIZE = DataPacket.MIN_PACKET_SIZE - 2
+    _MAX_SIZE = DataPacket.MAX_PACKET_SIZE - 2
+
+    def __init__(self):
+        self._raw = bytearray()
+        self._in_frame = False
+        self._dle = False
+        self._size = 0
+        self._crc = 0
+        self.frames = 0
+        self.framing_errors = 0
+        self.crc_errors = 0
+
+    def _start_frame(self):
+        self._raw.clear()
+        self._raw += self._STX
+        self._in_frame = True
+        self._dle = False
+        self._size = 0
+        self._crc = 0
+
+    def _add_segment(self, segment):
+        # Removes byte stuffing from the segment and updates size and CRC
+        table = CRC_TABLE
+        crc = self._crc
+        size = self._size
+        i = 0
+        n = len(segment)
+        if self._dle and n > 0:
+            crc = table[crc ^ (segment[0] ^ 0xFF)]
+            size += 1
+            self._dle = False
+            i = 1
+        while i < n:
+            j = segment.find(self._DLE, i)
+            if j < 0:
+                j = n
+            for byte in segment[i:j]:
+                crc = table[crc ^ byte]
+            size += j - i
+            if j + 1 < n:
+                crc = table[crc ^ (segment[j + 1] ^ 0xFF)]
+                size += 1
+            elif j + 1 == n:
+                self._dle = True
+            i = j + 2
+        self._crc = crc
+        self._size = size
+
+    def _end_frame(self, frames):
+        self._in_frame = False
+        if self._dle or self._size < self._MIN_SIZE:
+            self.framing_errors += 1
+        elif self._crc != 0:
+            # Calculating the CRC over the data including the CRC results in 0
+            self.crc_errors += 1
+        else:
+            self._raw += self._ETX
+            frames.append(bytes(self._raw))
+            self.frames += 1
+
+    def feed(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        frames = []
+        pos = 0
+        n = len(data)
+        while pos < n:
+            if not self._in_frame:
+                pos = data.find(self._STX, pos)
+                if pos < 0:
+                    break
+                self._start_frame()
+                pos += 1
+                continue
+            pos_etx = data.find(self._ETX, pos)
+            pos_stx = data.find(self._STX, pos)
+            end = n
+            if pos_etx >= 0:
+                end = pos_etx
+            if 0 <= pos_stx < end:
+                end = pos_stx
+            segment = data[pos:end]
+            self._raw += segment
+            self._add_segment(segment)
+            pos = end
+            if self._size > self._MAX_SIZE:
+                # Frame too long, discard and wait for the next STX
+                self._in_frame = False
+                self.framing_errors += 1
+            elif end == pos_stx:
+                # New frame started before the end of the current frame
+                self.framing_errors += 1
+                self._in_frame = False
+            elif end == pos_etx:
+                self._end_frame(frames)
+                pos += 1
+        return frames
+
+    def reset(self):
+        self._raw.clear()
+        self._in_frame = False
+        self._dle = False
+
+    def get_counters(self):
+        return {
+            "frames": self.frames,
+            "framing_errors": self.framing_errors,
+            "crc_errors": self.crc_errors
+        }
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_frame_decoder import TestFrameDecoder
+
+    TestFrameDecoder().run()
@@ -0,0 +1,245 @@
+"""
+Asyncio transport and protocol for the Lily System bus.
+
+One event loop can drive many ports, without a thread per port.
+Supports the same port names as the RS485 driver:
+- serial ports (POSIX only, the file descriptor of the serial port is added to the event loop)
+- socket://host:port (simulator)
+
+Usage:
+
+    bus = await LilyBus.open("socket://localhost:17001")
+    packet = await bus.request(1, [1])
+    bus.close()
+
+Like the RS485 driver, receive has priority: data is only sent when nothing was received for RX_DELAY_US.
+"""
+
+import asyncio
+import collections
+import os
+import serial
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+
+
+class LilyBusProtocol(asyncio.Protocol):
+
+    RX_DELAY_US = 20
+
+    def __init__(self, rx_callback=None):
+        self.transport = None
+        self._rx_callback = rx_callback
+        self._decoder = FrameDecoder()
+        self._pending = {}
+        self._tx_queue = collections.deque()
+        self._tx_handle = None
+        self._t_last_rx = 0
+        self._closed = asyncio.get_running_loop().create_future()
+
+    def _flush_tx(self):
+        self._tx_handle = None
+        if self.transport is None or self.transport.is_closing():
+            return
+        wait = self._t_last_rx + self.RX_DELAY_US / 1000000 - time.perf_counter()
+        if wait > 0:
+            self._tx_handle = asyncio.get_running_loop().call_later(wait, self._flush_tx)
+            return
+        while len(self._tx_queue) > 0:
+            self.transport.write(self._tx_queue.popleft())
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._t_last_rx = time.perf_counter()
+        for frame in self._decoder.feed(data):
+            packet = DataPacket()
+            packet.from_data(frame)
+            future = self._pending.pop(packet.pid, None)
+            if future is not None and not future.done():
+                future.set_result(packet)
+            elif self._rx_callback is not None:
+                self._rx_callback(packet)
+
+    def connection_lost(self, exc):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection lost"))
+        self._pending.clear()
+        if not self._closed.done():
+            self._closed.set_result(exc)
+
+    def send(self, data):
+        self._tx_queue.append(data)
+        if self._tx_handle is None:
+            self._tx_handle = asyncio.get_running_loop().call_soon(self._flush_tx)
+
+    def request(self, pid, data):
+        future = asyncio.get_running_loop().create_future()
+        self._pending[pid] = future
+        self.send(data)
+        return future
+
+    def cancel_request(self, pid):
+        self._pending.pop(pid, None)
+
+    def get_counters(self):
+        return self._decoder.get_counters()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+
+class SerialTransport(asyncio.Transport):
+
+    _READ_SIZE = 4096
+
+    def __init__(self, loop, protocol, serial_port):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self._serial = serial_port
+        self._fd = serial_port.fileno()
+        self._tx_buffer = bytearray()
+        self._closing = False
+        self._closed = False
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._read_ready)
+        self._loop.call_soon(self._protocol.connection_made, self)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._fd, self._READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._close(e)
+            return
+        if len(data) > 0:
+            self._protocol.data_received(data)
+
+    def _write_ready(self):
+        try:
+            n_bytes = os.write(self._fd, self._tx_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._close(e)
+            return
+        del self._tx_buffer[:n_bytes]
+        if len(self._tx_buffer) == 0:
+            self._loop.remove_writer(self._fd)
+            if self._closing:
+                self._close(None)
+
+    def _close(self, exc):
+        if self._closed:
+            return
+        self._closed = True
+        self._closing = True
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._serial.close()
+        self._loop.call_soon(self._protocol.connection_lost, exc)
+
+    def write(self, data):
+        if self._closing:
+            return
+        if len(self._tx_buffer) == 0:
+            try:
+                n_bytes = os.write(self._fd, data)
+            except (BlockingIOError, InterruptedError):
+                n_bytes = 0
+            except OSError as e:
+                self._close(e)
+                return
+            data = data[n_bytes:]
+            if len(data) == 0:
+                return
+            self._loop.add_writer(self._fd, self._write_ready)
+        self._tx_buffer += data
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            if len(self._tx_buffer) == 0:
+                self._close(None)
+
+    def get_extra_info(self, name, default=None):
+        if name == "serial":
+            return self._serial
+        return default
+
+
+class LilyBus:
+
+    BAUD_RATE = 250000
+    REQUEST_TIME_OUT = 1
+    PID_RANGE = (0x0001, 0xFBFF)
+
+    def __init__(self, port_name, transport, protocol):
+        self._port_name = port_name
+        self._transport = transport
+        self._protocol = protocol
+        self._pid = self.PID_RANGE[0]
+
+    @classmethod
+    async def open(cls, port_name, rx_callback=None):
+        loop = asyncio.get_running_loop()
+        if port_name.startswith("socket://"):
+            host, port = port_name[9:].split(":")
+            transport, protocol = await loop.create_connection(lambda: LilyBusProtocol(rx_callback), host, int(port))
+        else:
+            protocol = LilyBusProtocol(rx_callback)
+            transport = SerialTransport(loop, protocol, serial.Serial(port_name, cls.BAUD_RATE, timeout=0))
+            await asyncio.sleep(0)
+        return cls(port_name, transport, protocol)
+
+    def _next_pid(self):
+        pid = self._pid
+        self._pid += 1
+        if self._pid > self.PID_RANGE[1]:
+            self._pid = self.PID_RANGE[0]
+        return pid
+
+    def get_port(self):
+        return self._port_name
+
+    def get_counters(self):
+        return self._protocol.get_counters()
+
+    def send_data(self, data):
+        self._protocol.send(data)
+
+    async def request(self, dsn, data, timeout=REQUEST_TIME_OUT):
+        packet = DataPacket()
+        packet.dsn = dsn
+        packet.ssn = 0
+        packet.pid = self._next_pid()
+        packet.data = data
+        data = packet.get_data()
+        if len(data) == 0:
+            raise ValueError("Invalid request packet")
+        try:
+            return await asyncio.wait_for(self._protocol.request(packet.pid, data), timeout)
+        finally:
+            self._protocol.cancel_request(packet.pid)
+
+    def close(self):
+        self._transport.close()
+
+    async def wait_closed(self):
+        await self._protocol.wait_closed()
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_lily_bus import TestLilyBus
+
+    TestLilyBus().run()
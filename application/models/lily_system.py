@@ -2,23 +2,75 @@
 Lily System module.
 - Detects racks/modules
 - Communicates with the modules
+
+Requests are sent by a bus scheduler per port, this keeps multiple requests in flight (one per slot).
+Requests that are waiting for a response are kept in a request table (by port and PID).
+The request table calls a callback (or completes a future) when the response is received or on a time out.
+The time outs are handled by the detection thread.
+
+Module detection runs for all ports at the same time, a full scan (wildcard) takes one bus round trip.
+When the modules in a rack do not change, the interval between full scans is doubled (up to a maximum).
+Targeted probes (one slot) are sent when a module stops responding, a new module starts the next full scan directly.
+
+Metrics are recorded per port (bus counters, time outs and round trip times), see get_metrics().
+
+Requests that time out are retried (new PID, exponential backoff with jitter) until the packet time out.
+A circuit breaker per port rejects requests directly when a slot stops responding (the state is kept per slot),
+when the broadcast and all known slots fail, the requests for the whole rack are rejected at once.
+The module detection is used as trial to check if the rack responds again.
+While the breaker is open, the detection and the probes leave the rack as it is.
+
+The identity of the modules (name, serial and version) is kept in a module cache on disk (if a file name is given).
+The cached modules are shown directly at startup, in the background each cached module is validated with one
+Get serial request. When the serial is different, the entry is evicted and the module identity is requested again.
+
+Serial ports can be watched (hot plug), a port that is added is opened and scanned directly,
+the rack of a port that is removed is removed. The other ports are not scanned again.
+
+The raw traffic of all ports can be recorded in a capture file (see bus_capture), for debugging.
+
+The received packets are handled in an RX dispatch thread per port (bounded queue, the driver waits when it is full),
+so handling the packets (locks, rack update events) does not delay the bus.
+
+The detection thread is started with start(), not by the constructor, so the application window can be shown first.
+stop() stops the detection and closes the ports.
+The serial port watcher, the simulators and the bus capture are imported when used (faster startup).
+The startup phases (opening the ports, the first port scan and the first module detection) are timed,
+see startup_timer.
 """
 
+import concurrent.futures
 import copy
+import functools
 import threading
 import time
 
+# The scheduler raises the error class of its own import path (application.models), not the one of models
+from models.bus_scheduler import BusScheduler, CircuitOpenError
 from models.data_packet import DataPacket
+from models.metrics import Metrics
+from models.module_cache import ModuleCache
+from models.payload_schema import GENERIC_RESPONSES
+from models.request_table import RequestTable
+from models.retry_policy import CircuitBreaker, RetryPolicy
 from models.rs485_driver import RS485Driver
-from models.simulator.simulators import Simulators
+from models.startup_timer import StartupTimer
 
 
 class LilySystem:
 
-    _racks = []
     _module_detect_interval = 5
+    _module_detect_max_interval = 80
     _loop_interval = 0.1
     _packet_timeout = 5
+    _packet_retries = 3
+    _attempt_timeout = 0.2
+    _detection_timeout = 0.5
+    _request_window = 4
+    _port_watch_interval = 1
+    _rx_queue_size = 1024
+    # Generic commands for the module identity
+    _module_info_commands = {"name": 2, "serial": 3, "version": 4}
 
     _packet_id_ranges = (
         # Normal packets (63k)
@@ -32,73 +84,387 @@ class LilySystem:
     #         {
     #             "id": "047C-0002",
     #             "slot": 3,
-    #             "name": "Lily System signal generator"
+    #             "name": "Lily System signal generator",
+    #             "serial": "SG-000123",
+    #             "version": "1.0.0"
     #         },
     #         {
     #             "id": "047C-0001",
     #             "slot": 1,
-    #             "name": "Lily System Controller module"
+    #             "name": "Lily System Controller module",
+    #             "serial": "CM-000045",
+    #             "version": "1.2.0"
     #         }
     #     ]
     # }
 
-    def __init__(self, rack_update_event):
+    def __init__(self, rack_update_event, cache_filename=None, watch_serial_ports=False):
         self._rack_update_event = rack_update_event
+        self._watch_serial_ports = watch_serial_ports
+        self._port_watcher = None
+        self._capture = None
+        self._cache = ModuleCache(cache_filename) if cache_filename is not None else None
+        self._racks = self._cache.get_racks() if self._cache is not None else []
+        self._ports = {}
+        self._schedulers = {}
+        self._detection = {}
+        self._probes = set()
+        # Modules with an identity request in progress and cached modules that are validated
+        self._info_requests = {}
+        self._validated = set()
         self._lock = threading.RLock()
         self._stop_event = threading.Event()
+        self._metrics = Metrics()
+        self._requests = RequestTable(self._packet_timeout, self._metrics)
         self._detection_thread = threading.Thread(target=self._module_detection)
         self._detection_thread.daemon = True
-        self._detection_thread.start()
-        self._packet_id = self._packet_id_ranges[0][0]
-        self._packet_detection_id = self._packet_id_ranges[1][0]
-        self._send_packets = []
 
     def __del__(self):
+        if self._port_watcher is not None:
+            self._port_watcher.close()
         if self._detection_thread.is_alive():
             self._stop_event.set()
             self._detection_thread.join()
 
-    def _handle_rx_packet(self, data):
+    def _handle_rx_packet(self, port_name, data):
         packet = DataPacket()
-        packet.from_data(data)
+        if packet.from_data(data) == DataPacket.STATUS_OK:
+            driver = self._ports.get(port_name, None)
+            if driver is not None and not self._requests.complete(port_name, packet, driver.rx_time_ns):
+                with self._lock:
+                    detection = self._detection.get(port_name, None)
+                    if detection is not None and packet.ssn not in detection["slots"]:
+                        # Unknown module, scan the rack directly
+                        detection["next"] = 0
+
+    def _open_port(self, port_name):
+        if port_name in self._ports:
+            return
+        driver = RS485Driver(port_name, functools.partial(self._handle_rx_packet, port_name), True,
+                             self._metrics.get_port(port_name), self._capture, self._rx_queue_size)
+        scheduler = BusScheduler(driver, self._requests, self._packet_id_ranges, self._request_window,
+                                 retry_policy=RetryPolicy(self._packet_retries, self._attempt_timeout,
+                                                          self._packet_timeout),
+                                 circuit_breaker=CircuitBreaker(broadcast_key=0xFF), metrics=driver.get_metrics())
         with self._lock:
-            for port, send_packet, timestamp in self._send_packets:
-                if packet.pid == send_packet.pid:
-                    # Check if the packet is from a detection
-                    self._rack_update_event(port)
+            self._ports[port_name] = driver
+            self._schedulers[port_name] = scheduler
+            self._detection[port_name] = {
+                "interval": self._module_detect_interval,
+                "next": 0,
+                "busy": False,
+                "slots": set()
+            }
 
-    def _send_module_detection(self, port):
-        # We need the ID and the name
-        packet = DataPacket()
-        packet.dsn = 0xFF
-        packet.ssn = 0
-        packet.data = [1]
-        packet.pid = self._packet_detection_id
-        port.send_data(packet.get_data())
+    def _close_port(self, port_name):
         with self._lock:
-            self._send_packets.append((port.get_port(), copy.deepcopy(packet), time.time()))
-        self._packet_detection_id += 1
-        if self._packet_detection_id > self._packet_id_ranges[1][1]:
-            self._packet_detection_id = self._packet_id_ranges[1][0]
+            driver = self._ports.pop(port_name, None)
+            scheduler = self._schedulers.pop(port_name, None)
+            self._detection.pop(port_name, None)
+            self._racks = [rack for rack in self._racks if rack["port"] != port_name]
+            self._validated = set(filter(lambda key: key[0] != port_name, self._validated))
+        if scheduler is not None:
+            scheduler.close()
+        if driver is not None:
+            driver.close()
+        self._rack_update_event(self.get_racks())
+
+    def _on_serial_port_event(self, event, port_name):
+        # Hot plug, only the added port is scanned
+        from models.list_serial_ports import SerialPortWatcher
+
+        if event == SerialPortWatcher.EVENT_ADD:
+            try:
+                self._open_port(port_name)
+            except (Exception, ):
+                pass
+        else:
+            self._close_port(port_name)
+
+    @staticmethod
+    def _get_module_id(packet):
+        # Returns None if the response is not a valid module ID
+        try:
+            module_id = packet.decode_payload(GENERIC_RESPONSES[1])
+        except ValueError:
+            return None
+        return f"{module_id.mfg:04X}-{module_id.module:04X}"
+
+    def _send_module_detection(self, port_name):
+        # Get the ID of all modules (wildcard), the names are requested when the modules are found
+        with self._lock:
+            if port_name not in self._schedulers:
+                return
+            scheduler = self._schedulers[port_name]
+            self._detection[port_name]["busy"] = True
+        scheduler.submit(0xFF, [1], self._detection_timeout,
+                         functools.partial(self._on_module_detection, port_name), True)
+
+    def _update_rack(self, port_name, detected, slots=None):
+        # Update the modules in the given slots (all slots if not given), returns True if the rack changed
+        with self._lock:
+            if port_name not in self._detection:
+                # Port is closed
+                return False
+            racks = list(filter(lambda r: r["port"] == port_name, self._racks))
+            if len(racks) == 0:
+                racks.append({"port": port_name, "modules": []})
+                self._racks.append(racks[0])
+            current = {m["slot"]: m for m in racks[0]["modules"]}
+            if slots is not None:
+                detected = {**{s: m["id"] for s, m in current.items() if s not in slots}, **detected}
+            modules = []
+            for slot, module_id in sorted(detected.items()):
+                module = current.get(slot, None)
+                if module is None or module["id"] != module_id:
+                    module = {"id": module_id, "slot": slot, "name": "", "serial": "", "version": ""}
+                modules.append(module)
+            changed = modules != racks[0]["modules"]
+            racks[0]["modules"] = modules
+            self._detection[port_name]["slots"] = set(detected.keys())
+            removed = [slot for slot, module in current.items() if module not in modules]
+            for slot in removed:
+                self._validated.discard((port_name, slot))
+        if self._cache is not None:
+            for slot in removed:
+                self._cache.remove(port_name, slot)
+        for module in modules:
+            if module["name"] == "":
+                self._request_module_info(port_name, module["slot"])
+            elif (port_name, module["slot"]) not in self._validated:
+                self._validate_module(port_name, module["slot"])
+        if changed:
+            self._rack_update_event(self.get_racks())
+        return changed
+
+    def _on_module_detection(self, port_name, future):
+        # No modules when the rack does not respond, the rack is not changed when the circuit breaker is open
+        detected = {}
+        if not future.cancelled() and future.exception() is None:
+            for packet in future.result():
+                module_id = self._get_module_id(packet)
+                if module_id is not None:
+                    detected[packet.ssn] = module_id
+        circuit_open = not future.cancelled() and isinstance(future.exception(), CircuitOpenError)
+        changed = not circuit_open and self._update_rack(port_name, detected)
+        with self._lock:
+            detection = self._detection.get(port_name, None)
+            if detection is None:
+                return
+            if changed:
+                detection["interval"] = self._module_detect_interval
+            elif not circuit_open:
+                # Stable rack, back off
+                detection["interval"] = min(2 * detection["interval"], self._module_detect_max_interval)
+            detection["next"] = time.monotonic() + detection["interval"]
+            detection["busy"] = False
+        StartupTimer.mark("first module detection")
+
+    def _on_request_done(self, port_name, slot, future):
+        if not future.cancelled() and isinstance(future.exception(), TimeoutError):
+            self._send_slot_probe(port_name, slot)
+
+    def _send_slot_probe(self, port_name, slot):
+        # Check if the module in the slot is still there
+        with self._lock:
+            detection = self._detection.get(port_name, None)
+            if (port_name, slot) in self._probes or detection is None or slot not in detection["slots"]:
+                return
+            self._probes.add((port_name, slot))
+            scheduler = self._schedulers[port_name]
+        scheduler.submit(slot, [1], self._detection_timeout,
+                         functools.partial(self._on_slot_probe, port_name, slot), True)
+
+    def _on_slot_probe(self, port_name, slot, future):
+        with self._lock:
+            self._probes.discard((port_name, slot))
+        # A request that is cancelled after sending gets a CancelledError (see bus scheduler)
+        if future.cancelled() or isinstance(future.exception(), (CircuitOpenError, concurrent.futures.CancelledError)):
+            return
+        detected = {}
+        if future.exception() is None:
+            module_id = self._get_module_id(future.result())
+            if module_id is not None:
+                detected[slot] = module_id
+        if self._update_rack(port_name, detected, {slot}):
+            with self._lock:
+                detection = self._detection.get(port_name, None)
+                if detection is not None:
+                    detection["interval"] = self._module_detect_interval
+
+    def _get_module(self, port_name, slot):
+        with self._lock:
+            for rack in filter(lambda r: r["port"] == port_name, self._racks):
+                for module in filter(lambda m: m["slot"] == slot, rack["modules"]):
+                    return module
+        return None
+
+    def _request_module_info(self, port_name, slot):
+        # Get the name, serial and version of the module
+        with self._lock:
+            if (port_name, slot) in self._info_requests:
+                return
+            self._info_requests[(port_name, slot)] = len(self._module_info_commands)
+        for field, command in self._module_info_commands.items():
+            self.send_request(port_name, slot, [command],
+                              functools.partial(self._on_module_info, port_name, slot, field))
+
+    def _on_module_info(self, port_name, slot, field, future):
+        module = None
+        with self._lock:
+            self._info_requests[(port_name, slot)] -= 1
+            done = self._info_requests[(port_name, slot)] == 0
+            if done:
+                del self._info_requests[(port_name, slot)]
+            if not future.cancelled() and future.exception() is None:
+                module = self._get_module(port_name, slot)
+                if module is not None:
+                    command = self._module_info_commands[field]
+                    module[field] = getattr(future.result().decode_payload(GENERIC_RESPONSES[command]), field)
+            if done:
+                module = self._get_module(port_name, slot)
+                if module is not None and module["serial"] != "":
+                    self._validated.add((port_name, slot))
+                    module = dict(module)
+                else:
+                    module = None
+        if done and module is not None and self._cache is not None:
+            self._cache.set(port_name, slot, module)
+        if field == "name":
+            self._rack_update_event(self.get_racks())
+
+    def _validate_module(self, port_name, slot):
+        # Cached module, check if it is still the same module (same serial)
+        with self._lock:
+            if (port_name, slot) in self._info_requests:
+                return
+            self._info_requests[(port_name, slot)] = 1
+        self.send_request(port_name, slot, [self._module_info_commands["serial"]],
+                          functools.partial(self._on_module_validation, port_name, slot))
+
+    def _on_module_validation(self, port_name, slot, future):
+        with self._lock:
+            del self._info_requests[(port_name, slot)]
+        if future.cancelled() or future.exception() is not None:
+            return
+        serial = future.result().decode_payload(GENERIC_RESPONSES[self._module_info_commands["serial"]]).serial
+        if self._cache is not None and self._cache.validate(port_name, slot, serial):
+            with self._lock:
+                self._validated.add((port_name, slot))
+            return
+        # Other module in the slot, get the identity again
+        with self._lock:
+            module = self._get_module(port_name, slot)
+            if module is not None:
+                module.update({"name": "", "serial": "", "version": ""})
+        self._rack_update_event(self.get_racks())
+        self._request_module_info(port_name, slot)
+
+    def _open_simulator_ports(self):
+        from models.simulator.simulators import Simulators
 
-    def _module_detection(self):
-        open_ports = []
         if Simulators.is_running():
             try:
-                for port in Simulators.PORTS:
-                    open_ports.append(RS485Driver(f"socket://localhost:{port}", self._handle_rx_packet))
+                for port_name in Simulators.get_port_names():
+                    self._open_port(port_name)
             except (Exception, ):
                 pass
-        t_detect = 5
+
+    def _module_detection(self):
+        if len(self._racks) > 0:
+            # Show the cached modules directly
+            self._rack_update_event(self.get_racks())
+            StartupTimer.mark("cached modules shown")
+        with StartupTimer.phase("open simulator ports"):
+            self._open_simulator_ports()
+        if self._watch_serial_ports:
+            from models.list_serial_ports import SerialPortWatcher
+
+            with StartupTimer.phase("serial port scan"):
+                self._port_watcher = SerialPortWatcher(self._on_serial_port_event, self._port_watch_interval)
+                self._port_watcher.wait_for_scan()
+        with self._lock:
+            # Cached racks on ports that are not available are not shown
+            racks = [rack for rack in self._racks if rack["port"] in self._ports]
+            changed = len(racks) != len(self._racks)
+            self._racks = racks
+        if changed:
+            self._rack_update_event(self.get_racks())
         while not self._stop_event.is_set():
-            # Module detection
-            if t_detect >= self._module_detect_interval:
-                for port in open_ports:
-                    self._send_module_detection(port)
-                t_detect = 0
+            # Module detection, for all ports that are due
+            now = time.monotonic()
+            with self._lock:
+                ports = [port_name for port_name, detection in self._detection.items()
+                         if not detection["busy"] and detection["next"] <= now]
+            for port_name in ports:
+                self._send_module_detection(port_name)
 
+            self._requests.expire()
+            if self._cache is not None:
+                self._cache.save()
             time.sleep(self._loop_interval)
-            t_detect += self._loop_interval
+
+    def start(self):
+        # Starts the module detection (in the background)
+        if self._detection_thread.ident is None:
+            self._detection_thread.start()
+
+    def stop(self):
+        # Stops the module detection and closes all ports, no rack update events are sent
+        self._stop_event.set()
+        if self._detection_thread.is_alive() and self._detection_thread is not threading.current_thread():
+            self._detection_thread.join()
+        if self._port_watcher is not None:
+            self._port_watcher.close()
+            self._port_watcher = None
+        with self._lock:
+            schedulers = list(self._schedulers.values())
+            drivers = list(self._ports.values())
+            self._schedulers = {}
+            self._ports = {}
+            self._detection = {}
+        for scheduler in schedulers:
+            scheduler.close()
+        for driver in drivers:
+            driver.close()
+        if self._cache is not None:
+            self._cache.save()
+
+    def send_request(self, port_name, dsn, data, callback=None, timeout=None):
+        # Returns a future with the response packet, the future gets a TimeoutError when there is no response
+        with self._lock:
+            scheduler = self._schedulers[port_name]
+        future = scheduler.submit(dsn, data, timeout, callback)
+        if dsn != 0xFF:
+            future.add_done_callback(functools.partial(self._on_request_done, port_name, dsn))
+        return future
+
+    def get_request_counters(self):
+        return self._requests.get_counters()
+
+    def get_metrics(self):
+        # Use the snapshot or the exporters (to_json, to_prometheus) of the metrics
+        return self._metrics
+
+    def start_capture(self, filename):
+        from models.bus_capture import BusCaptureWriter
+
+        # Record the raw traffic of all ports
+        self.stop_capture()
+        with self._lock:
+            self._capture = BusCaptureWriter(filename)
+            for driver in self._ports.values():
+                driver.set_capture(self._capture)
+
+    def stop_capture(self):
+        # The drivers stop recording first, after set_capture(None) no driver adds records, then the file is closed
+        with self._lock:
+            capture = self._capture
+            self._capture = None
+            for driver in self._ports.values():
+                driver.set_capture(None)
+        if capture is not None:
+            capture.close()
 
     def get_racks(self):
         with self._lock:
@@ -108,6 +474,8 @@ class LilySystem:
 
 if __name__ == "__main__":
 
+    from models.simulator.simulators import Simulators
+
     def _rack_update(racks):
         print("Rack update:")
         print(racks)
@@ -115,4 +483,5 @@ if __name__ == "__main__":
     Simulators.run()
 
     lily_system = LilySystem(_rack_update)
+    lily_system.start()
     time.sleep(7)
@@ -1,50 +1,209 @@
 """
 Lists all the available serial ports on the system.
+
+A port is available if it can be opened. The ports are checked in a thread pool (at most MAX_WORKERS threads),
+a port that does not open within the open timeout (hangs) is skipped.
+
+The serial port scanner keeps the results of the previous scan.
+On a next scan only the ports that changed (new port or other hardware) are checked again.
+Only available ports are kept by hardware ID. A port that could not be opened (busy or hanging) is checked again
+after RECHECK_INTERVAL, the interval is doubled after every failed check (up to MAX_RECHECK_INTERVAL).
+
+The serial port watcher scans the ports periodically and reports added and removed ports (hot plug).
+On Linux the ports are read from sysfs (/sys/class/tty), other systems use the port list of pyserial.
 """
 
+import math
+import os
+import queue
+import serial
+import sys
 import threading
 import time
-import serial
 
 from serial.tools.list_ports import comports
 
 SKIP_PORTS = ["Bluetooth link"]
+OPEN_TIMEOUT = 0.5
+MAX_WORKERS = 8
+RECHECK_INTERVAL = 2
+MAX_RECHECK_INTERVAL = 30
+
+_SYSFS_TTY = "/sys/class/tty"
 
 
 def get_available_serial_ports():
-    ports = []
-    threads = []
-    lock = threading.RLock()
+    return SerialPortScanner().scan()
 
-    serial_ports = comports()
 
-    for port in serial_ports:
+def list_serial_ports():
+    # Returns the ports without opening them: {port name: hardware ID}
+    if sys.platform.startswith("linux") and os.path.isdir(_SYSFS_TTY):
+        return _list_sysfs_ports()
+    ports = {}
+    for port in comports():
         for query in SKIP_PORTS:
             if query in port.description:
                 break
         else:
-            t = threading.Thread(target=_check_serial_port, args=(lock, port.device, ports))
-            t.daemon = True
-            t.start()
-            threads.append(t)
+            ports[port.device] = port.hwid
+    return ports
 
-    while True in list(map(lambda x: x.is_alive(), threads)):
-        time.sleep(0.01)
 
-    return sorted(ports)
+def _list_sysfs_ports():
+    # Only ttys with a device, the hardware ID is the device path (changes when other hardware is plugged in)
+    ports = {}
+    for name in os.listdir(_SYSFS_TTY):
+        device_path = os.path.join(_SYSFS_TTY, name, "device")
+        if not os.path.exists(device_path):
+            continue
+        device_path = os.path.realpath(device_path)
+        if os.path.basename(os.path.realpath(os.path.join(device_path, "subsystem"))) == "platform":
+            # Not a real port (placeholder of the serial driver)
+            continue
+        ports[f"/dev/{name}"] = device_path
+    return ports
 
 
-def _check_serial_port(lock_object, port_name, port_list):
+def _check_serial_port(port_name):
     try:
         p = serial.Serial(port_name)
         p.close()
-        lock_object.acquire()
-        try:
-            port_list.append(port_name)
-        finally:
-            lock_object.release()
+        return True
     except (Exception, ):
-        pass
+        return False
+
+
+def _check_serial_ports(port_names, open_timeout=OPEN_TIMEOUT, max_workers=MAX_WORKERS,
+                        check_function=_check_serial_port):
+    # Returns the ports that can be opened, the worker threads are daemon threads so a hanging port does not block
+    if len(port_names) == 0:
+        return []
+    port_queue = queue.Queue()
+    for port_name in port_names:
+        port_queue.put(port_name)
+    results = {}
+    condition = threading.Condition()
+
+    def _worker():
+        while True:
+            try:
+                name = port_queue.get_nowait()
+            except queue.Empty:
+                return
+            result = check_function(name)
+            with condition:
+                results[name] = result
+                condition.notify()
+
+    n_workers = min(max_workers, len(port_names))
+    for _ in range(n_workers):
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+
+    # Each worker checks its ports one by one, every check may take the open timeout
+    deadline = time.monotonic() + open_timeout * math.ceil(len(port_names) / n_workers)
+    with condition:
+        while len(results) < len(port_names):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            condition.wait(remaining)
+        return [port_name for port_name in port_names if results.get(port_name, False)]
+
+
+class SerialPortScanner:
+
+    def __init__(self, open_timeout=OPEN_TIMEOUT, max_workers=MAX_WORKERS, list_function=list_serial_ports,
+                 recheck_interval=RECHECK_INTERVAL, max_recheck_interval=MAX_RECHECK_INTERVAL,
+                 check_function=_check_serial_port):
+        self._open_timeout = open_timeout
+        self._max_workers = max_workers
+        self._list_function = list_function
+        self._recheck_interval = recheck_interval
+        self._max_recheck_interval = max_recheck_interval
+        self._check_function = check_function
+        # {port name: (hardware ID, available, time of the next check, recheck interval)}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _must_check(self, port_name, hwid, now):
+        result = self._results.get(port_name, None)
+        if result is None or result[0] != hwid:
+            return True
+        return not result[1] and result[2] <= now
+
+    def _get_result(self, port_name, hwid, is_available, now):
+        if is_available:
+            return hwid, True, None, None
+        # Not available, check again after the interval, the interval is doubled if the port was not available
+        interval = self._recheck_interval
+        previous = self._results.get(port_name, None)
+        if previous is not None and previous[0] == hwid and not previous[1]:
+            interval = min(2 * previous[3], self._max_recheck_interval)
+        return hwid, False, now + interval, interval
+
+    def scan(self, refresh=False):
+        # Returns the available ports, with refresh all ports are checked again
+        ports = self._list_function()
+        now = time.monotonic()
+        with self._lock:
+            checked = [port_name for port_name, hwid in ports.items()
+                       if refresh or self._must_check(port_name, hwid, now)]
+            available = _check_serial_ports(checked, self._open_timeout, self._max_workers, self._check_function)
+            self._results = {
+                port_name: (self._get_result(port_name, hwid, port_name in available, now) if port_name in checked
+                            else self._results[port_name])
+                for port_name, hwid in ports.items()
+            }
+            return sorted(port_name for port_name, result in self._results.items() if result[1])
+
+
+class SerialPortWatcher:
+
+    EVENT_ADD = "add"
+    EVENT_REMOVE = "remove"
+
+    def __init__(self, event_handler, interval=1, scanner=None):
+        # The event handler is called with the event and the port name (from the watcher thread)
+        self._event_handler = event_handler
+        self._interval = interval
+        self._scanner = scanner if scanner is not None else SerialPortScanner()
+        self._ports = set()
+        self._scanned = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _watch(self):
+        while not self._stop_event.is_set():
+            try:
+                ports = set(self._scanner.scan())
+            except (Exception, ):
+                ports = self._ports
+            added = sorted(ports - self._ports)
+            removed = sorted(self._ports - ports)
+            self._ports = ports
+            for port_name in removed:
+                self._event_handler(self.EVENT_REMOVE, port_name)
+            for port_name in added:
+                self._event_handler(self.EVENT_ADD, port_name)
+            self._scanned.set()
+            self._stop_event.wait(self._interval)
+
+    def wait_for_scan(self, timeout=None):
+        # Wait until the first scan is done (the events of the ports that are already there are sent)
+        return self._scanned.wait(timeout)
+
+    def get_ports(self):
+        return sorted(self._ports)
+
+    def close(self):
+        self._stop_event.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
 
 
 if __name__ == "__main__":
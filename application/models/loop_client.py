@@ -0,0 +1,110 @@
+"""
+Client for connecting to a virtual bus in memory (loop://<name>).
+Must have same methods as the serial port class.
+
+Written data is processed by the virtual bus directly, the responses are put in the receive buffer.
+Like a serial port, fileno() can be used with select/selectors.
+The socket pair for this is only created when fileno() is used, so many clients can be created cheaply.
+
+The buses are registered here by name, so the driver does not depend on the simulator.
+A bus is an object with process_data(decoder, data, buffer), like the virtual bus of the simulator.
+"""
+
+import socket
+import threading
+
+from application.models.frame_decoder import FrameDecoder
+
+
+class LoopClient:
+
+    _BUFFER_SIZE = 1500
+
+    _buses = {}
+    _buses_lock = threading.Lock()
+
+    def __init__(self, name):
+        self.port = f"loop://{name}"
+        self.in_waiting = 0
+        self._bus = self.get_bus(name)
+        self._decoder = FrameDecoder()
+        self._rx_data = bytearray()
+        self._lock = threading.Lock()
+        self._notify_r = None
+        self._notify_w = None
+
+    @classmethod
+    def register_bus(cls, name, bus):
+        with cls._buses_lock:
+            cls._buses[name] = bus
+        return f"loop://{name}"
+
+    @classmethod
+    def unregister_bus(cls, name):
+        with cls._buses_lock:
+            cls._buses.pop(name, None)
+
+    @classmethod
+    def get_bus(cls, name):
+        with cls._buses_lock:
+            bus = cls._buses.get(name, None)
+        if bus is None:
+            raise ValueError(f"Virtual bus '{name}' does not exist")
+        return bus
+
+    def _notify(self):
+        if self._notify_w is not None:
+            try:
+                self._notify_w.send(b"\x00")
+            except (BlockingIOError, OSError):
+                pass
+
+    def _clear_notification(self):
+        if self._notify_r is not None:
+            try:
+                while len(self._notify_r.recv(self._BUFFER_SIZE)) > 0:
+                    pass
+            except BlockingIOError:
+                pass
+
+    def read(self, n_bytes=1):
+        with self._lock:
+            data_out = bytes(self._rx_data[:n_bytes])
+            del self._rx_data[:n_bytes]
+            self.in_waiting = len(self._rx_data)
+            if self.in_waiting == 0:
+                self._clear_notification()
+        return data_out
+
+    def write(self, data):
+        with self._lock:
+            was_empty = len(self._rx_data) == 0
+            self._bus.process_data(self._decoder, data, self._rx_data)
+            self.in_waiting = len(self._rx_data)
+            if was_empty and self.in_waiting > 0:
+                self._notify()
+
+    def fileno(self):
+        with self._lock:
+            if self._notify_r is None:
+                self._notify_r, self._notify_w = socket.socketpair()
+                self._notify_r.setblocking(False)
+                self._notify_w.setblocking(False)
+                if self.in_waiting > 0:
+                    self._notify()
+        return self._notify_r.fileno()
+
+    def close(self):
+        with self._lock:
+            if self._notify_r is not None:
+                self._notify_r.close()
+                self._notify_w.close()
+                self._notify_r = None
+                self._notify_w = None
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_virtual_bus import TestVirtualBus
+
+    TestVirtualBus().run()
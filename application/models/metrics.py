@@ -0,0 +1,170 @@
+"""
+Metrics per port: bus counters and a histogram of the request round trip times (RTT).
+
+Recording is cheap: counters are plain integers and a histogram value is one bucket increment (no locks).
+A snapshot copies the values, exporting (JSON or Prometheus text) uses the snapshot, not the live values.
+
+The histogram is HDR style: each power of two is split in 16 linear sub buckets (relative error < 6.25%).
+Values are in nanoseconds (time.perf_counter_ns).
+"""
+
+import json
+import threading
+
+
+class LatencyHistogram:
+
+    _SUB_BUCKET_BITS = 4
+    _SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+    _N_BUCKETS = 64 * _SUB_BUCKETS
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self):
+        self._counts = [0] * self._N_BUCKETS
+        self._sum = 0
+        self._min = None
+        self._max = 0
+
+    @classmethod
+    def _get_index(cls, value):
+        if value < cls._SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - cls._SUB_BUCKET_BITS - 1
+        return ((shift + 1) << cls._SUB_BUCKET_BITS) + (value >> shift) - cls._SUB_BUCKETS
+
+    @classmethod
+    def _get_value(cls, index):
+        # Middle of the bucket
+        if index < cls._SUB_BUCKETS:
+            return index
+        shift = (index >> cls._SUB_BUCKET_BITS) - 1
+        sub_bucket = (index & (cls._SUB_BUCKETS - 1)) + cls._SUB_BUCKETS
+        return (sub_bucket << shift) + (1 << shift) // 2
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        self._counts[self._get_index(value)] += 1
+        self._sum += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if value > self._max:
+            self._max = value
+
+    def get_percentile(self, percentile, counts=None):
+        if counts is None:
+            counts = self._counts
+        total = sum(counts)
+        if total == 0:
+            return 0
+        limit = total * percentile / 100
+        count = 0
+        for index, n in enumerate(counts):
+            count += n
+            if n > 0 and count >= limit:
+                return min(self._get_value(index), self._max)
+        return self._max
+
+    def snapshot(self):
+        counts = list(self._counts)
+        count = sum(counts)
+        snapshot = {
+            "count": count,
+            "sum": self._sum,
+            "min": self._min if self._min is not None else 0,
+            "max": self._max,
+            "mean": self._sum / count if count > 0 else 0
+        }
+        for percentile in self.PERCENTILES:
+            snapshot[f"p{percentile:g}"] = self.get_percentile(percentile, counts)
+        return snapshot
+
+    def reset(self):
+        self._counts = [0] * self._N_BUCKETS
+        self._sum = 0
+        self._min = None
+        self._max = 0
+
+
+class PortMetrics:
+
+    # Counters kept by the port metrics, the driver adds the frame decoder counters and the TX queue depth
+    COUNTERS = ("tx_frames", "tx_bytes", "rx_bytes", "timeouts", "retries")
+
+    def __init__(self, port_name):
+        self.port_name = port_name
+        self.tx_frames = 0
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.rtt = LatencyHistogram()
+        self._sources = []
+
+    def add_source(self, function):
+        # Function returning a dictionary with values that are read at snapshot time (gauges, counters kept elsewhere)
+        self._sources.append(function)
+
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in self.COUNTERS}
+        for function in self._sources:
+            snapshot.update(function())
+        snapshot["rtt_ns"] = self.rtt.snapshot()
+        return snapshot
+
+
+class Metrics:
+
+    _PREFIX = "lily"
+
+    def __init__(self):
+        self._ports = {}
+        self._lock = threading.Lock()
+
+    def get_port(self, port_name):
+        port = self._ports.get(port_name, None)
+        if port is None:
+            with self._lock:
+                port = self._ports.setdefault(port_name, PortMetrics(port_name))
+        return port
+
+    def snapshot(self):
+        with self._lock:
+            ports = list(self._ports.values())
+        return {port.port_name: port.snapshot() for port in ports}
+
+    def to_json(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        return json.dumps(snapshot, indent=4)
+
+    def to_prometheus(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = []
+        names = sorted(set(name for values in snapshot.values() for name in values if name != "rtt_ns"))
+        for name in names:
+            metric_type = "gauge" if name.endswith("depth") else "counter"
+            metric = f"{self._PREFIX}_{name}" + ("_total" if metric_type == "counter" else "")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for port_name, values in snapshot.items():
+                if name in values:
+                    lines.append(f'{metric}{{port="{port_name}"}} {values[name]}')
+        if len(snapshot) > 0:
+            metric = f"{self._PREFIX}_request_rtt_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for port_name, values in snapshot.items():
+                rtt = values["rtt_ns"]
+                for percentile in LatencyHistogram.PERCENTILES:
+                    lines.append(f'{metric}{{port="{port_name}",quantile="{percentile / 100:g}"}} '
+                                 f'{rtt[f"p{percentile:g}"] / 1e9:.9f}')
+                lines.append(f'{metric}_sum{{port="{port_name}"}} {rtt["sum"] / 1e9:.9f}')
+                lines.append(f'{metric}_count{{port="{port_name}"}} {rtt["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_metrics import TestMetrics
+
+    TestMetrics().run()
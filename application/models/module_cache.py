@@ -0,0 +1,107 @@
+"""
+Cache with the identity of the modules (ID, name, serial and version), stored on disk (JSON).
+
+The identity of a module does not change, so the modules can be shown directly when the application starts.
+The cache is keyed by port and slot, each entry has the serial of the module.
+When the module in a slot has a different serial, the entry is evicted.
+
+Changes are saved by calling save(), only if something changed.
+The file is written to a temporary file first and then replaced, so a crash does not leave a broken cache.
+"""
+
+import json
+import os
+import threading
+
+
+class ModuleCache:
+
+    FIELDS = ("id", "name", "serial", "version")
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._entries = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def _get_key(port_name, slot):
+        return f"{port_name}/{slot}"
+
+    def _load(self):
+        try:
+            with open(self._filename, "r") as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            entries = {}
+        if isinstance(entries, dict):
+            self._entries = {key: value for key, value in entries.items()
+                             if isinstance(value, dict) and "port" in value and "slot" in value}
+
+    def get(self, port_name, slot):
+        with self._lock:
+            entry = self._entries.get(self._get_key(port_name, slot), None)
+            return None if entry is None else dict(entry)
+
+    def set(self, port_name, slot, module):
+        # Only modules with a serial are stored
+        if module.get("serial", "") == "":
+            return
+        entry = {"port": port_name, "slot": slot}
+        entry.update({field: module.get(field, "") for field in self.FIELDS})
+        with self._lock:
+            key = self._get_key(port_name, slot)
+            if self._entries.get(key, None) != entry:
+                self._entries[key] = entry
+                self._changed = True
+
+    def remove(self, port_name, slot):
+        with self._lock:
+            if self._entries.pop(self._get_key(port_name, slot), None) is not None:
+                self._changed = True
+
+    def validate(self, port_name, slot, serial):
+        # Returns True if the serial matches, the entry is evicted if the serial is different
+        with self._lock:
+            key = self._get_key(port_name, slot)
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return False
+            if entry["serial"] == serial:
+                return True
+            del self._entries[key]
+            self._changed = True
+        return False
+
+    def get_racks(self):
+        # The racks in the same format as the LilySystem racks
+        racks = {}
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: (e["port"], e["slot"]))
+        for entry in entries:
+            racks.setdefault(entry["port"], []).append({field: entry[field] for field in self.FIELDS})
+            racks[entry["port"]][-1]["slot"] = entry["slot"]
+        return [{"port": port_name, "modules": modules} for port_name, modules in racks.items()]
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return False
+            content = json.dumps(self._entries, indent=4)
+            self._changed = False
+        folder = os.path.dirname(self._filename)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        temp_filename = f"{self._filename}.tmp"
+        with open(temp_filename, "w") as fp:
+            fp.write(content)
+        os.replace(temp_filename, self._filename)
+        return True
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_module_cache import TestModuleCache
+
+    TestModuleCache().run()
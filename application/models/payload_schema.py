@@ -0,0 +1,125 @@
+"""
+Payload schemas: decode and encode all fields of the packet data in one call.
+
+A schema is a comma separated list of fields "<type> <name>", for example:
+"u16 mfg, u16 module, i32 value, str[16] name"
+Types:
+- u8, u16, u32, u64: unsigned numbers
+- i8, i16, i32, i64: signed numbers
+- f32, f64: floating point numbers
+- str[n], bytes[n]: string or bytes with a fixed size (padded with zeros)
+- str, bytes: the remaining data (only as last field)
+Numbers are big endian, strings use the same character encoding as the data packet.
+
+A schema is compiled once into a struct, use PayloadSchema.compile() to share the compiled schemas.
+Decoding unpacks the whole payload in one call (unpack_from) into a named tuple.
+The payload can be bytes, a bytearray or a memoryview, the data is not copied (except the remaining data field).
+"""
+
+import collections
+import re
+import struct
+
+
+class PayloadSchema:
+
+    _FORMATS = {
+        "u8": "B", "u16": "H", "u32": "I", "u64": "Q",
+        "i8": "b", "i16": "h", "i32": "i", "i64": "q",
+        "f32": "f", "f64": "d"
+    }
+    _FIELD = re.compile(r"^(\w+?)(?:\[(\d+)])?\s+([A-Za-z_]\w*)$")
+
+    # We use the original IBM character encoding, other characters than ASCII are shown as dots
+    _ENCODING = "cp437"
+    _ASCII_TABLE = bytes(b if 31 < b < 127 else 46 for b in range(256))
+
+    _schemas = {}
+
+    def __init__(self, definition, name="Payload"):
+        self.definition = definition
+        fields = [field.strip() for field in definition.split(",")] if definition.strip() != "" else []
+        formats = ">"
+        names = []
+        self._strings = []
+        self._has_remaining = False
+        for index, field in enumerate(fields):
+            match = self._FIELD.match(field)
+            if match is None:
+                raise ValueError(f"Invalid field: '{field}'")
+            field_type, size, field_name = match.groups()
+            if field_type in ("str", "bytes"):
+                if size is not None:
+                    formats += f"{size}s"
+                elif index == len(fields) - 1:
+                    self._has_remaining = True
+                else:
+                    raise ValueError(f"Field without size is not the last field: '{field}'")
+                if field_type == "str":
+                    self._strings.append(index)
+            elif field_type in self._FORMATS and size is None:
+                formats += self._FORMATS[field_type]
+            else:
+                raise ValueError(f"Invalid field type: '{field}'")
+            names.append(field_name)
+        self._struct = struct.Struct(formats)
+        self.size = self._struct.size
+        self.record = collections.namedtuple(name, names)
+        self._make = self.record._make
+
+    @classmethod
+    def compile(cls, definition, name="Payload"):
+        # Returns the compiled schema, a schema is compiled only once
+        key = (definition, name)
+        schema = cls._schemas.get(key, None)
+        if schema is None:
+            schema = cls._schemas.setdefault(key, cls(definition, name))
+        return schema
+
+    def decode(self, data, offset=0):
+        if len(data) - offset < self.size:
+            raise ValueError(f"Payload too small: {len(data) - offset} bytes, expected at least {self.size}")
+        values = self._struct.unpack_from(data, offset)
+        if self._has_remaining:
+            values += (bytes(data[offset + self.size:]),)
+        if len(self._strings) > 0:
+            values = list(values)
+            for index in self._strings:
+                values[index] = values[index].rstrip(b"\x00").translate(self._ASCII_TABLE).decode(self._ENCODING)
+        return self._make(values)
+
+    def _get_values(self, values, fields):
+        values = list(self.record(*values, **fields))
+        for index in self._strings:
+            values[index] = values[index].encode(self._ENCODING, "replace")
+        remaining = values.pop() if self._has_remaining else b""
+        return values, remaining
+
+    def encode(self, *values, **fields):
+        # Values by position or by name, returns the payload (bytes)
+        values, remaining = self._get_values(values, fields)
+        return self._struct.pack(*values) + remaining
+
+    def encode_into(self, buffer, offset, *values, **fields):
+        # Writes the payload into the buffer (bytearray or memoryview), returns the number of bytes written
+        values, remaining = self._get_values(values, fields)
+        self._struct.pack_into(buffer, offset, *values)
+        if len(remaining) > 0:
+            buffer[offset + self.size:offset + self.size + len(remaining)] = remaining
+        return self.size + len(remaining)
+
+
+# Responses of the generic commands (by command)
+GENERIC_RESPONSES = {
+    1: PayloadSchema.compile("u16 mfg, u16 module", "ModuleId"),
+    2: PayloadSchema.compile("str name", "ModuleName"),
+    3: PayloadSchema.compile("str serial", "ModuleSerial"),
+    4: PayloadSchema.compile("str version", "ModuleVersion")
+}
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_payload_schema import TestPayloadSchema
+
+    TestPayloadSchema().run()
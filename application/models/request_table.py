@@ -0,0 +1,163 @@
+"""
+Table with the requests that are waiting for a response (in flight).
+
+Requests are identified by port and packet ID (PID).
+A received packet is matched with its request in O(1) and completes the future of the request.
+Requests that are not answered within their time out are expired using a heap, ordered by deadline.
+The future of an expired request gets a TimeoutError.
+
+A broadcast request (DSN 0xFF) can have multiple responses (one per module).
+These requests are collecting responses until the time out, the future gets the list of responses.
+
+Responses for requests that are expired (late) or already answered (duplicate) are counted and dropped.
+
+With metrics, the round trip time (RTT) is recorded per port and the time outs are counted per port.
+The RTT is the time between writing the request (set_tx_time) and receiving the response (perf_counter_ns).
+"""
+
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+
+class _Request:
+
+    __slots__ = ("key", "packet", "deadline", "future", "responses", "tx_time_ns")
+
+    def __init__(self, key, packet, deadline, collect_responses):
+        self.key = key
+        self.packet = packet
+        self.deadline = deadline
+        self.tx_time_ns = None
+        self.future = concurrent.futures.Future()
+        self.responses = [] if collect_responses else None
+
+
+class RequestTable:
+
+    # Keep track of finished requests for detecting late and duplicate responses
+    _RETIRED_TIME_FACTOR = 2
+
+    def __init__(self, timeout, metrics=None):
+        self._timeout = timeout
+        self._metrics = metrics
+        self._lock = threading.RLock()
+        self._requests = {}
+        self._retired = {}
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._counters = {
+            "requests": 0,
+            "responses": 0,
+            "timeouts": 0,
+            "late": 0,
+            "duplicates": 0,
+            "unknown": 0
+        }
+
+    def _retire(self, request, now, state):
+        # The retired requests are ordered by time, because the retire time is the same for all requests
+        del self._requests[request.key]
+        self._retired[request.key] = (state, now + self._timeout * self._RETIRED_TIME_FACTOR)
+
+    def add(self, port, packet, timeout=None, callback=None):
+        if timeout is None:
+            timeout = self._timeout
+        key = (port, packet.pid)
+        request = _Request(key, packet, time.monotonic() + timeout, packet.dsn == 0xFF)
+        if callback is not None:
+            request.future.add_done_callback(callback)
+        with self._lock:
+            self._retired.pop(key, None)
+            previous = self._requests.get(key, None)
+            self._requests[key] = request
+            heapq.heappush(self._deadlines, (request.deadline, next(self._sequence), request))
+            self._counters["requests"] += 1
+        if previous is not None:
+            previous.future.cancel()
+        return request.future
+
+    def set_tx_time(self, port, pid, tx_time_ns):
+        request = self._requests.get((port, pid), None)
+        if request is not None:
+            request.tx_time_ns = tx_time_ns
+
+    def complete(self, port, packet, rx_time_ns=None):
+        key = (port, packet.pid)
+        with self._lock:
+            request = self._requests.get(key, None)
+            if request is None:
+                if key in self._retired:
+                    counter = "late" if self._retired[key][0] == "expired" else "duplicates"
+                    self._counters[counter] += 1
+                else:
+                    self._counters["unknown"] += 1
+                return False
+            self._counters["responses"] += 1
+            if self._metrics is not None and request.tx_time_ns is not None:
+                if rx_time_ns is None:
+                    rx_time_ns = time.perf_counter_ns()
+                self._metrics.get_port(port).rtt.record(rx_time_ns - request.tx_time_ns)
+            if request.responses is not None:
+                # Broadcast, collect until the time out
+                request.responses.append(packet)
+                return True
+            self._retire(request, time.monotonic(), "completed")
+        request.future.set_result(packet)
+        return True
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        with self._lock:
+            while len(self._deadlines) > 0 and self._deadlines[0][0] <= now:
+                request = heapq.heappop(self._deadlines)[2]
+                if self._requests.get(request.key, None) is request:
+                    if request.responses is not None:
+                        self._retire(request, now, "completed")
+                    else:
+                        self._retire(request, now, "expired")
+                        self._counters["timeouts"] += 1
+                        if self._metrics is not None:
+                            self._metrics.get_port(request.key[0]).timeouts += 1
+                    expired.append(request)
+            while len(self._retired) > 0:
+                key, (_state, t_remove) = next(iter(self._retired.items()))
+                if t_remove > now:
+                    break
+                del self._retired[key]
+        for request in expired:
+            if request.responses is not None:
+                request.future.set_result(request.responses)
+            else:
+                request.future.set_exception(TimeoutError(f"No response for PID {request.key[1]:04X}"))
+        return expired
+
+    def get_timeout(self):
+        return self._timeout
+
+    def get_next_deadline(self):
+        with self._lock:
+            if len(self._deadlines) > 0:
+                return self._deadlines[0][0]
+        return None
+
+    def get_counters(self):
+        with self._lock:
+            counters = self._counters.copy()
+            counters["in_flight"] = len(self._requests)
+        return counters
+
+    def __len__(self):
+        with self._lock:
+            return len(self._requests)
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_request_table import TestRequestTable
+
+    TestRequestTable().run()
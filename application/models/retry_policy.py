@@ -0,0 +1,148 @@
+"""
+Retry policy and circuit breaker for bus requests.
+
+Retry policy:
+- each attempt has a time out, the request has a deadline for all attempts
+- a request that timed out is sent again (new PID) after a backoff time
+- the backoff time increases exponentially, with jitter to spread retries of multiple requests
+
+Circuit breaker (one per port, the state is kept per key, the bus scheduler uses the slot as key):
+- closed: requests are sent, consecutive failures are counted
+- open: too many consecutive failures, requests are rejected directly (CircuitOpenError)
+- half open: after the reset time one request is sent as trial, if it succeeds the breaker closes, else opens again
+A key per slot prevents that a slot without a module blocks the requests to the other modules of the rack.
+With a broadcast key, the breaker also has a state for all keys (the port): when the broadcast is open and the last
+request of every other known key failed, the whole rack is not responding and the requests for all keys are rejected
+(also for keys that did not fail yet). After the reset time one request (any key) is sent as trial for the port,
+any success closes the port state, the state per key is kept.
+"""
+
+import random
+import threading
+import time
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+class RetryPolicy:
+
+    def __init__(self, retries=2, timeout=0.1, deadline=None, backoff=0.01, backoff_factor=2, max_backoff=0.5,
+                 jitter=0.5):
+        self.retries = retries
+        self.timeout = timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def get_backoff(self, attempt):
+        # Backoff before the given retry (1 is the first retry), jitter reduces the time with up to the jitter fraction
+        delay = min(self.backoff * self.backoff_factor ** (attempt - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+
+class _BreakerState:
+
+    __slots__ = ("state", "failures", "opened_at", "trial_pending")
+
+    def __init__(self):
+        self.state = CircuitBreaker.STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_pending = False
+
+
+class CircuitBreaker:
+
+    STATE_CLOSED = "closed"
+    STATE_OPEN = "open"
+    STATE_HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_time=2, broadcast_key=None):
+        self._failure_threshold = failure_threshold
+        self._reset_time = reset_time
+        self._broadcast_key = broadcast_key
+        # {key: state}, a key without state is closed
+        self._states = {}
+        # Keys that had a request (except the broadcast) and the state of the port (None is closed)
+        self._keys = set()
+        self._port_state = None
+        self._lock = threading.Lock()
+
+    def _allow_request(self, state):
+        # Must be called with the lock
+        if state is None or state.state == self.STATE_CLOSED:
+            return True
+        if state.state == self.STATE_OPEN and time.monotonic() - state.opened_at >= self._reset_time:
+            state.state = self.STATE_HALF_OPEN
+            state.trial_pending = False
+        if state.state == self.STATE_HALF_OPEN and not state.trial_pending:
+            state.trial_pending = True
+            return True
+        return False
+
+    def _open(self, state):
+        state.state = self.STATE_OPEN
+        state.opened_at = time.monotonic()
+        state.trial_pending = False
+
+    def _is_rack_failing(self):
+        # Must be called with the lock, the broadcast is open and the last request of all known keys failed
+        broadcast = self._states.get(self._broadcast_key, None)
+        return (broadcast is not None and broadcast.state == self.STATE_OPEN and
+                all(key in self._states for key in self._keys))
+
+    def allow_request(self, key=None):
+        with self._lock:
+            if self._port_state is not None:
+                # The trial request for the port is sent, also if the key is open
+                return self._allow_request(self._port_state)
+            return self._allow_request(self._states.get(key, None))
+
+    def on_success(self, key=None):
+        with self._lock:
+            self._states.pop(key, None)
+            if key != self._broadcast_key:
+                self._keys.add(key)
+            self._port_state = None
+
+    def on_failure(self, key=None):
+        with self._lock:
+            state = self._states.setdefault(key, _BreakerState())
+            state.failures += 1
+            if state.state == self.STATE_HALF_OPEN or state.failures >= self._failure_threshold:
+                self._open(state)
+            if key != self._broadcast_key:
+                self._keys.add(key)
+            if self._port_state is not None:
+                if self._port_state.state == self.STATE_HALF_OPEN:
+                    self._open(self._port_state)
+            elif self._broadcast_key is not None and self._is_rack_failing():
+                self._port_state = _BreakerState()
+                self._open(self._port_state)
+
+    def _get_state(self, state):
+        # Must be called with the lock
+        if state is None:
+            return self.STATE_CLOSED
+        if state.state == self.STATE_OPEN and time.monotonic() - state.opened_at >= self._reset_time:
+            return self.STATE_HALF_OPEN
+        return state.state
+
+    def get_state(self, key=None):
+        with self._lock:
+            return self._get_state(self._states.get(key, None))
+
+    def get_port_state(self):
+        with self._lock:
+            return self._get_state(self._port_state)
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_retry_policy import TestRetryPolicy
+
+    TestRetryPolicy().run()
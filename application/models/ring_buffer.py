@@ -0,0 +1,80 @@
+"""
+Ring buffer for received data, used by the TCP client and the clients of the connection pool.
+
+The data is written directly into the free space (recv_into and commit) or copied in (write).
+Reading copies the data out (read) or into a buffer of the caller (readinto), the buffered data is never moved.
+The ring buffer is not thread safe, the owner uses its own lock.
+"""
+
+
+class RingBuffer:
+
+    def __init__(self, size):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        # Start of the data and number of bytes
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def get_size(self):
+        return len(self._buffer)
+
+    def get_free_space(self):
+        # Returns the free part of the buffer after the data (up to the end of the buffer), empty if it is full
+        end = (self._start + self._count) % len(self._buffer)
+        if end < self._start or self._count == len(self._buffer):
+            return self._view[end:self._start]
+        return self._view[end:]
+
+    def commit(self, n_bytes):
+        # Adds the bytes that are written in the free space
+        self._count += n_bytes
+
+    def write(self, data):
+        # Copies the data into the buffer, returns the number of bytes written (less if the buffer is full)
+        data = memoryview(data).cast("B")
+        n_written = 0
+        while n_written < len(data):
+            space = self.get_free_space()
+            if len(space) == 0:
+                break
+            n_bytes = min(len(space), len(data) - n_written)
+            space[:n_bytes] = data[n_written:n_written + n_bytes]
+            self._count += n_bytes
+            n_written += n_bytes
+        return n_written
+
+    def _consume(self, n_bytes):
+        self._start = (self._start + n_bytes) % len(self._buffer)
+        self._count -= n_bytes
+
+    def read(self, n_bytes):
+        # Returns at most n_bytes from the start of the data
+        n_bytes = min(n_bytes, self._count)
+        end = self._start + n_bytes
+        if end <= len(self._buffer):
+            data_out = bytes(self._view[self._start:end])
+        else:
+            data_out = bytes(self._view[self._start:]) + bytes(self._view[:end - len(self._buffer)])
+        self._consume(n_bytes)
+        return data_out
+
+    def readinto(self, buffer):
+        # Reads into the buffer (bytearray or memoryview), returns the number of bytes
+        buffer = memoryview(buffer).cast("B")
+        n_bytes = min(len(buffer), self._count)
+        n_first = min(n_bytes, len(self._buffer) - self._start)
+        buffer[:n_first] = self._view[self._start:self._start + n_first]
+        buffer[n_first:n_bytes] = self._view[:n_bytes - n_first]
+        self._consume(n_bytes)
+        return n_bytes
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_ring_buffer import TestRingBuffer
+
+    TestRingBuffer().run()
@@ -9,15 +9,44 @@ Data cannot be sent and received simultaneously.
 This is handled by the transmit and receive thread (tr_thread).
 When data is being received, this is handled first.
 If no data is being received, data is sent from the TX queue (if any)
+
+There are two modes for the transmit and receive thread:
+- polling (default): checks the port every LOOP_DELAY_US using a busy wait (low latency, high CPU load).
+  Ports with a blocking read (TCP connections) are not polled, the thread waits for received data (at most LOOP_DELAY_US).
+- event driven: waits on the port (selectors) and wakes up when data is received or queued for sending.
+  If the port cannot be used with selectors (serial port on Windows), the port is polled every POLL_INTERVAL_US.
+
+Port names:
+- socket://<host>:<port>: TCP connection to the simulator or a gateway, shared by all drivers for the same endpoint
+  (see connection_pool)
+- loop://<name>: virtual bus in memory (simulated modules without sockets), the loop client is imported when used
+- other: serial port
+
+The driver records the port metrics: frames and bytes sent and received, decoder errors and the TX queue depth.
+The time (perf_counter_ns) a request is written is passed to the TX callback of the request (if any),
+the time data is received is available in rx_time_ns while the RX callback is called.
+
+By default the RX callback is called in the transmit and receive thread, a slow callback delays the bus.
+With an RX queue size, the frames are put in a bounded queue and the RX callback is called on an executor
+(dedicated thread, thread pool or asyncio loop) with an overflow policy, see rx_dispatcher.
+The RX queue depth and the dropped frames are in the port metrics.
+
+The raw bus traffic can be recorded in a capture (see bus_capture), with the same TX and RX times.
 """
 
+import io
 import queue
+import selectors
 import serial
+import socket
 import threading
 import time
 
-from application.models.data_packet import DataPacket
-from application.models.tcp_client import TCPClient
+from application.models.bus_capture import BusCapture
+from application.models.connection_pool import ConnectionPool, PooledClient
+from application.models.frame_decoder import FrameDecoder
+from application.models.metrics import PortMetrics
+from application.models.rx_dispatcher import RxDispatcher
 
 
 class RS485Driver:
@@ -25,18 +54,43 @@ class RS485Driver:
     BAUD_RATE = 250000
     LOOP_DELAY_US = 300
     RX_DELAY_US = 20
+    POLL_INTERVAL_US = 1000
+    IDLE_TIMEOUT = 0.5
+    RX_READ_SIZE = 65536
 
-    def __init__(self, serial_port, rx_callback):
+    def __init__(self, serial_port, rx_callback, event_driven=False, metrics=None, capture=None, rx_queue_size=0,
+                 rx_overflow_policy=RxDispatcher.POLICY_BLOCK, rx_executor=None):
         self._tx_queue = queue.Queue()
         self._rx_callback = rx_callback
+        self._rx_dispatcher = None
+        if rx_queue_size > 0:
+            self._rx_dispatcher = RxDispatcher(self._dispatch_rx_frame, rx_queue_size, rx_overflow_policy, rx_executor)
+        self._event_driven = event_driven
         if serial_port.startswith("socket://"):
             host, port = serial_port[9:].split(":")
-            self._serial = TCPClient(host, int(port))
+            self._serial = ConnectionPool.open(host, int(port))
+        elif serial_port.startswith("loop://"):
+            from application.models.loop_client import LoopClient
+
+            self._serial = LoopClient(serial_port[7:])
         else:
             self._serial = serial.Serial(serial_port, self.BAUD_RATE)
+        self._decoder = FrameDecoder()
+        self.rx_time_ns = 0
+        self._metrics = metrics if metrics is not None else PortMetrics(serial_port)
+        self._metrics.add_source(self._get_metrics)
+        self._recorder = None
+        self._recorder_lock = threading.Lock()
+        self.set_capture(capture)
         self._stop_event = threading.Event()
         self._stop_event.clear()
-        self._tr_thread = threading.Thread(target=self._transmit_receive)
+        if event_driven:
+            self._wake_r, self._wake_w = socket.socketpair()
+            self._wake_r.setblocking(False)
+            self._wake_w.setblocking(False)
+            self._tr_thread = threading.Thread(target=self._transmit_receive_events)
+        else:
+            self._tr_thread = threading.Thread(target=self._transmit_receive)
         self._tr_thread.daemon = True
         self._tr_thread.start()
 
@@ -47,45 +101,172 @@ class RS485Driver:
         while (time.perf_counter() - start) < value:
             pass
 
+    def _receive(self):
+        self._process_rx_data(self._serial.read(self._serial.in_waiting))
+
+    def _process_rx_data(self, data):
+        rx_time_ns = time.perf_counter_ns()
+        self._metrics.rx_bytes += len(data)
+        self._record(BusCapture.DIRECTION_RX, rx_time_ns, data)
+        if self._rx_dispatcher is not None:
+            for frame in self._decoder.feed(data):
+                self._rx_dispatcher.put(frame, rx_time_ns)
+            return
+        self.rx_time_ns = rx_time_ns
+        for frame in self._decoder.feed(data):
+            self._rx_callback(frame)
+
+    def _dispatch_rx_frame(self, frame, rx_time_ns):
+        # Called by the RX dispatcher, one frame at a time
+        self.rx_time_ns = rx_time_ns
+        self._rx_callback(frame)
+
+    def _record(self, direction, time_ns, data):
+        # The lock makes sure no record is added after set_capture(None) returned
+        with self._recorder_lock:
+            if self._recorder is not None:
+                self._recorder.record(direction, time_ns, data)
+
+    def _transmit(self):
+        try:
+            data, tx_callback = self._tx_queue.get_nowait()
+        except queue.Empty:
+            return
+        self._serial.write(data)
+        tx_time_ns = time.perf_counter_ns()
+        self._metrics.tx_frames += 1
+        self._metrics.tx_bytes += len(data)
+        self._record(BusCapture.DIRECTION_TX, tx_time_ns, data)
+        if tx_callback is not None:
+            tx_callback(tx_time_ns)
+
+    def _get_metrics(self):
+        counters = self._decoder.get_counters()
+        return {
+            "rx_frames": counters["frames"],
+            "crc_errors": counters["crc_errors"],
+            "framing_errors": counters["framing_errors"],
+            "tx_queue_depth": self._tx_queue.qsize(),
+            **self._get_rx_dispatcher_metrics()
+        }
+
+    def _get_rx_dispatcher_metrics(self):
+        if self._rx_dispatcher is None:
+            return {}
+        counters = self._rx_dispatcher.get_counters()
+        return {
+            "rx_queue_depth": counters["queue_depth"],
+            "rx_queue_max_depth": counters["max_queue_depth"],
+            "rx_dropped_frames": counters["dropped"]
+        }
+
+    def _transmit_receive_blocking(self):
+        while not self._stop_event.is_set():
+            data = self._serial.read(self.RX_READ_SIZE)
+            if len(data) == 0 and self._tx_queue.empty():
+                # Nothing to do, wait for received data
+                data = self._serial.read(self.RX_READ_SIZE, self.LOOP_DELAY_US / 1000000)
+            if len(data) > 0:
+                # Receive has priority, check again for more data before sending
+                self._process_rx_data(data)
+                continue
+            if not self._serial.is_open:
+                # Connection closed, nothing can be sent and read does not wait anymore
+                self._stop_event.wait(self.LOOP_DELAY_US / 1000000)
+                continue
+            self._transmit()
+
     def _transmit_receive(self):
-        rx_data = b""
+        if isinstance(self._serial, PooledClient):
+            self._transmit_receive_blocking()
+            return
         while not self._stop_event.is_set():
             if self._serial.in_waiting > 0:
                 while self._serial.in_waiting > 0:
-                    rx_data += self._serial.read(self._serial.in_waiting)
-                    while True:
-                        stx_pos = rx_data.find(DataPacket.STX)
-                        if stx_pos >= 0:
-                            rx_data = rx_data[stx_pos:]
-                        else:
-                            break
-                        etx_pos = rx_data.find(DataPacket.ETX)
-                        if etx_pos > 0:
-                            self._rx_callback(rx_data[:etx_pos + 1])
-                            rx_data = rx_data[etx_pos + 1:]
-                        else:
-                            break
+                    self._receive()
                     self._usleep(self.RX_DELAY_US)
             else:
                 # No bytes waiting, sending data if any
-                try:
-                    self._serial.write(self._tx_queue.get_nowait())
-                except queue.Empty:
-                    pass
+                self._transmit()
 
             self._usleep(self.LOOP_DELAY_US)
 
+    def _get_port_fileno(self):
+        try:
+            return self._serial.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+
+    def _wake_up(self):
+        try:
+            self._wake_w.send(b"\x00")
+        except (BlockingIOError, OSError):
+            # Already a wake up pending or closed
+            pass
+
+    def _clear_wake_up(self):
+        try:
+            while len(self._wake_r.recv(64)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+    def _transmit_receive_events(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._wake_r, selectors.EVENT_READ)
+            port_fileno = self._get_port_fileno()
+            if port_fileno is not None:
+                selector.register(port_fileno, selectors.EVENT_READ)
+                idle_timeout = self.IDLE_TIMEOUT
+            else:
+                idle_timeout = self.POLL_INTERVAL_US / 1000000
+            while not self._stop_event.is_set():
+                # With data to send, only wait a short time to see if the bus is quiet
+                tx_pending = not self._tx_queue.empty()
+                timeout = self.RX_DELAY_US / 1000000 if tx_pending else idle_timeout
+                for key, _mask in selector.select(timeout):
+                    if key.fileobj is self._wake_r:
+                        self._clear_wake_up()
+                if self._serial.in_waiting > 0:
+                    # Receive has priority, check again for more data before sending
+                    while self._serial.in_waiting > 0:
+                        self._receive()
+                    continue
+                self._transmit()
+
     def get_port(self):
         return self._serial.port
 
-    def send_data(self, data):
-        self._tx_queue.put(data)
+    def get_counters(self):
+        return self._decoder.get_counters()
+
+    def get_metrics(self):
+        return self._metrics
+
+    def set_capture(self, capture):
+        # Start recording in the capture, None stops recording (waits for a record in progress)
+        recorder = capture.get_recorder(self._serial.port) if capture is not None else None
+        with self._recorder_lock:
+            self._recorder = recorder
+
+    def send_data(self, data, tx_callback=None):
+        # The TX callback is called with the time the data is written (perf_counter_ns)
+        self._tx_queue.put((data, tx_callback))
+        if self._event_driven:
+            self._wake_up()
 
     def close(self):
         if self._tr_thread.is_alive():
             self._stop_event.set()
+            if self._event_driven:
+                self._wake_up()
             self._tr_thread.join()
+        if self._rx_dispatcher is not None:
+            self._rx_dispatcher.close()
         self._serial.close()
+        if self._event_driven:
+            self._wake_r.close()
+            self._wake_w.close()
 
 
 if __name__ == "__main__":
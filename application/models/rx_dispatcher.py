@@ -0,0 +1,135 @@
+"""
+RX dispatcher: delivers received frames to the consumer outside the transmit and receive thread of the driver.
+
+The frames are put in a bounded queue, the consumer (handler) is called on an executor:
+- None: a dedicated thread
+- a concurrent.futures executor (thread pool)
+- an asyncio event loop (the handler is called in the loop)
+The frames are always delivered in order, one at a time (one drain of the queue is scheduled at a time).
+
+Overflow policy when the queue is full:
+- block: the receiving thread waits until there is space (no frames are lost, backpressure)
+- drop_oldest: the oldest frame in the queue is dropped
+- drop_newest: the new frame is dropped
+The counters (queue depth, maximum queue depth, delivered, dropped, blocked and errors) are in get_counters().
+Exceptions of the handler are counted, delivery continues with the next frame.
+"""
+
+import asyncio
+import collections
+import threading
+
+
+class RxDispatcher:
+
+    POLICY_BLOCK = "block"
+    POLICY_DROP_OLDEST = "drop_oldest"
+    POLICY_DROP_NEWEST = "drop_newest"
+
+    def __init__(self, handler, max_size=1024, policy=POLICY_BLOCK, executor=None):
+        if policy not in (self.POLICY_BLOCK, self.POLICY_DROP_OLDEST, self.POLICY_DROP_NEWEST):
+            raise ValueError(f"Invalid overflow policy: '{policy}'")
+        self._handler = handler
+        self._max_size = max_size
+        self._policy = policy
+        self._executor = executor
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._drain_scheduled = False
+        self._closed = False
+        self._counters = {"max_queue_depth": 0, "delivered": 0, "dropped": 0, "blocked": 0, "errors": 0}
+        self._thread = None
+        if executor is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _schedule_drain(self):
+        # Must be called with the lock
+        if self._drain_scheduled or self._thread is not None:
+            return
+        self._drain_scheduled = True
+        if isinstance(self._executor, asyncio.AbstractEventLoop):
+            self._executor.call_soon_threadsafe(self._drain)
+        else:
+            self._executor.submit(self._drain)
+
+    def _deliver(self, item):
+        try:
+            self._handler(*item)
+        except (Exception, ):
+            with self._condition:
+                self._counters["errors"] += 1
+
+    def _drain(self):
+        # Delivers the frames until the queue is empty
+        while True:
+            with self._condition:
+                if len(self._queue) == 0:
+                    self._drain_scheduled = False
+                    return
+                item = self._queue.popleft()
+                self._counters["delivered"] += 1
+                self._condition.notify_all()
+            self._deliver(item)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._queue) > 0 or self._closed)
+                if len(self._queue) == 0:
+                    return
+                item = self._queue.popleft()
+                self._counters["delivered"] += 1
+                self._condition.notify_all()
+            self._deliver(item)
+
+    def put(self, *item):
+        # Called from the receiving thread, the handler is called with the same arguments
+        # Returns False if the frame is dropped
+        with self._condition:
+            if self._closed:
+                self._counters["dropped"] += 1
+                return False
+            if len(self._queue) >= self._max_size:
+                if self._policy == self.POLICY_DROP_NEWEST:
+                    self._counters["dropped"] += 1
+                    return False
+                if self._policy == self.POLICY_DROP_OLDEST:
+                    self._queue.popleft()
+                    self._counters["dropped"] += 1
+                else:
+                    self._counters["blocked"] += 1
+                    self._condition.wait_for(lambda: len(self._queue) < self._max_size or self._closed)
+                    if self._closed:
+                        self._counters["dropped"] += 1
+                        return False
+            self._queue.append(item)
+            self._counters["max_queue_depth"] = max(self._counters["max_queue_depth"], len(self._queue))
+            self._condition.notify_all()
+            self._schedule_drain()
+        return True
+
+    def get_queue_depth(self):
+        return len(self._queue)
+
+    def get_counters(self):
+        with self._condition:
+            counters = dict(self._counters)
+            counters["queue_depth"] = len(self._queue)
+        return counters
+
+    def close(self):
+        # The frames in the queue are still delivered by the dedicated thread, new frames are dropped
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_rx_dispatcher import TestRxDispatcher
+
+    TestRxDispatcher().run()
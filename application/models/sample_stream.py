@@ -0,0 +1,140 @@
+"""
+Sample stream: sink for measurement samples streamed by the modules.
+
+The payloads of the packets are reinterpreted as NumPy arrays (frombuffer, no copy) with the data type of the samples
+(big endian on the bus, for example ">i2" for signed 16 bit samples).
+Many payloads can be added at once, they are converted in one call.
+The samples are written into a preallocated ring buffer (the only copy, the byte order is converted while copying).
+
+Every sample has a timestamp (seconds), kept in step with the samples in a second ring buffer:
+- with a sample rate: the timestamp of the first sample of the payload plus the sample index / sample rate
+- without a sample rate: the timestamp of the payload for all samples of the payload
+If no timestamp is given, the stream continues from the previous timestamp (sample rate) or uses the current time.
+
+Statistics (mean, minimum, maximum and RMS) are calculated vectorized, over the latest samples or per window.
+"""
+
+import numpy
+import threading
+import time
+
+
+class SampleStream:
+
+    STATISTICS = ("mean", "min", "max", "rms")
+
+    def __init__(self, dtype=">i2", capacity=65536, sample_rate=None):
+        self._dtype = numpy.dtype(dtype)
+        self._capacity = capacity
+        self._sample_rate = sample_rate
+        # The buffers use the native byte order
+        self._samples = numpy.zeros(capacity, self._dtype.newbyteorder("="))
+        self._timestamps = numpy.zeros(capacity, numpy.float64)
+        self._count = 0
+        self._next_timestamp = None
+        self._lock = threading.Lock()
+
+    def _get_timestamps(self, counts, timestamps):
+        # Timestamps for all samples, counts is the number of samples per payload
+        n_samples = int(counts.sum())
+        if timestamps is None:
+            if self._sample_rate is not None and self._next_timestamp is not None:
+                start = self._next_timestamp
+            else:
+                start = time.monotonic()
+            if self._sample_rate is None:
+                return numpy.full(n_samples, start)
+            return start + numpy.arange(n_samples) / self._sample_rate
+        values = numpy.repeat(numpy.asarray(timestamps, numpy.float64), counts)
+        if self._sample_rate is not None:
+            # Index of every sample within its payload
+            starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            values += (numpy.arange(n_samples) - starts) / self._sample_rate
+        return values
+
+    def _write(self, samples, timestamps):
+        # Only the latest samples are kept if there are more samples than the capacity
+        if len(samples) > self._capacity:
+            self._count += len(samples) - self._capacity
+            samples = samples[-self._capacity:]
+            timestamps = timestamps[-self._capacity:]
+        index = self._count % self._capacity
+        n_first = min(len(samples), self._capacity - index)
+        self._samples[index:index + n_first] = samples[:n_first]
+        self._timestamps[index:index + n_first] = timestamps[:n_first]
+        n_second = len(samples) - n_first
+        if n_second > 0:
+            self._samples[:n_second] = samples[n_first:]
+            self._timestamps[:n_second] = timestamps[n_first:]
+        self._count += len(samples)
+
+    def add_payloads(self, payloads, timestamps=None):
+        # Payloads: bytes-like objects (memoryviews are not copied), timestamps: one per payload (or None)
+        item_size = self._dtype.itemsize
+        if len(payloads) == 1:
+            data = payloads[0]
+        else:
+            data = b"".join(payloads)
+        samples = numpy.frombuffer(data, self._dtype, len(data) // item_size)
+        counts = numpy.fromiter((len(payload) // item_size for payload in payloads), numpy.int64, len(payloads))
+        if int(counts.sum()) * item_size != len(data):
+            raise ValueError(f"Payload size is not a multiple of the sample size ({item_size} bytes)")
+        with self._lock:
+            sample_times = self._get_timestamps(counts, timestamps)
+            self._write(samples, sample_times)
+            if len(sample_times) > 0 and self._sample_rate is not None:
+                self._next_timestamp = sample_times[-1] + 1 / self._sample_rate
+        return len(samples)
+
+    def add_payload(self, payload, timestamp=None):
+        return self.add_payloads([payload], None if timestamp is None else [timestamp])
+
+    def get_count(self):
+        # Total number of samples added
+        return self._count
+
+    def get_size(self):
+        # Number of samples in the buffer
+        return min(self._count, self._capacity)
+
+    def get_samples(self, n_samples=None):
+        # Returns the latest samples and their timestamps (oldest first, copies)
+        with self._lock:
+            size = min(self._count, self._capacity)
+            n_samples = size if n_samples is None else min(n_samples, size)
+            end = self._count % self._capacity
+            indexes = numpy.arange(end - n_samples, end) % self._capacity
+            return self._timestamps[indexes], self._samples[indexes]
+
+    @staticmethod
+    def _calculate_statistics(samples, axis=None):
+        values = samples.astype(numpy.float64)
+        return {
+            "mean": values.mean(axis),
+            "min": values.min(axis),
+            "max": values.max(axis),
+            "rms": numpy.sqrt(numpy.square(values).mean(axis))
+        }
+
+    def get_statistics(self, n_samples=None):
+        # Statistics of the latest samples, returns None if there are no samples
+        _timestamps, samples = self.get_samples(n_samples)
+        if len(samples) == 0:
+            return None
+        return {name: float(value) for name, value in self._calculate_statistics(samples).items()}
+
+    def get_window_statistics(self, window_size, n_windows=None):
+        # Statistics per window of the latest complete windows (oldest first), arrays with one value per window
+        n_available = self.get_size() // window_size
+        n_windows = n_available if n_windows is None else min(n_windows, n_available)
+        timestamps, samples = self.get_samples(n_windows * window_size)
+        statistics = self._calculate_statistics(samples.reshape(n_windows, window_size), 1)
+        statistics["timestamp"] = timestamps[::window_size]
+        return statistics
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_sample_stream import TestSampleStream
+
+    TestSampleStream().run()
@@ -32,18 +32,35 @@ class LilyModule:
         output = attribute
         return output
 
+    def _process_module_commands(self, data):
+        # Commands of the module type, the default is to return the data
+        return data
+
+    def get_slot_number(self):
+        return self._slot_number
+
+    def process_request(self, packet):
+        # Process a decoded request, the request packet is not changed (can be passed to multiple modules)
+        data = packet.data
+        if len(data) == 0 or (packet.dsn != 255 and packet.dsn != self._slot_number):
+            return None
+        if 0 < data[0] <= 0x32:
+            data = self._process_generic_commands(data)
+        else:
+            data = self._process_module_commands(data)
+        if len(data) == 0:
+            return None
+        response = DataPacket()
+        response.dsn = packet.ssn
+        response.ssn = self._slot_number
+        response.pid = packet.pid
+        response.data = list(data)
+        return response
+
     def process_packet(self, data):
-        response = None
         packet = DataPacket()
         packet.from_data(data)
-        if len(packet.data) > 0 and packet.dsn == 255 or packet.dsn == self._slot_number:
-            if 0 < packet.data[0] <= 0x32:
-                packet.data = self._process_generic_commands(packet.data)
-            if len(packet.data) > 0:
-                response = packet
-                packet.dsn = packet.ssn
-                packet.ssn = self._slot_number
-        return response
+        return self.process_request(packet)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+"""
+LS-MM Measurement module.
+
+Streams samples of a sine wave (signed 16 bit, big endian), every get samples request returns the next samples.
+"""
+
+import math
+import numpy
+
+from application.models.simulator.lily_module import LilyModule
+
+
+class LilyModuleMM(LilyModule):
+
+    COMMAND_GET_SAMPLES = 0x40
+    SAMPLES_PER_PACKET = 16
+    SAMPLE_TYPE = ">i2"
+
+    def __init__(self, slot_number, serial, sample_rate=1000, frequency=50, amplitude=10000):
+        super().__init__(slot_number, [0x04, 0x7C, 0x00, 0x03], "LS-MM Measurement Module", serial, "1.0")
+        self._sample_rate = sample_rate
+        self._frequency = frequency
+        self._amplitude = amplitude
+        self._sample_index = 0
+
+    def _process_module_commands(self, data):
+        if data[0] == self.COMMAND_GET_SAMPLES:
+            return list(self.get_samples(self.SAMPLES_PER_PACKET))
+        return super()._process_module_commands(data)
+
+    def get_sample_rate(self):
+        return self._sample_rate
+
+    def get_samples(self, n_samples):
+        # Returns the next samples (bytes)
+        indexes = numpy.arange(self._sample_index, self._sample_index + n_samples)
+        self._sample_index += n_samples
+        samples = self._amplitude * numpy.sin(2 * math.pi * self._frequency * indexes / self._sample_rate)
+        return numpy.round(samples).astype(self.SAMPLE_TYPE).tobytes()
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_sample_stream import TestSampleStream
+
+    TestSampleStream().run()
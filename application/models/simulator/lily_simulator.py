@@ -1,64 +1,123 @@
 """
 Simulates a rack with various modules.
+
+Multiple clients can be connected at the same time, the connections stay open until the client closes them.
+All connections are handled by one thread using a selector.
+Every frame in the received data is processed, frames can be split over multiple chunks (decoder per connection).
+The responses for one chunk are sent at once, data that could not be sent is sent when the socket is writable.
 """
 
+import selectors
 import socket
 import threading
 
-from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+from application.models.simulator.virtual_bus import VirtualBus
+
+
+class _Connection:
+
+    __slots__ = ("sock", "decoder", "tx_buffer")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.tx_buffer = bytearray()
 
 
 class LilySimulator:
 
     _HOST = "localhost"
-    _RX_BUFFER_SIZE = 1500
+    _RX_BUFFER_SIZE = 65536
     _RX_TIME_OUT = 1
 
     def __init__(self, port, modules):
         self._port = port
-        self._modules = modules
+        self._bus = VirtualBus(modules)
+        # Listen before the thread is started, so clients can connect directly after creating the simulator
+        self._sock = socket.create_server((self._HOST, self._port))
+        self._sock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ)
         self._stop_event = threading.Event()
         self._thread = threading.Thread(target=self._handle_packets)
         self._thread.daemon = True
         self._thread.start()
 
     def __del__(self):
-        if self._thread.is_alive():
-            self._stop_event.set()
-            self._thread.join()
+        self.close()
+
+    def _accept(self):
+        try:
+            sock = self._sock.accept()[0]
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._selector.register(sock, selectors.EVENT_READ, _Connection(sock))
+
+    def _disconnect(self, connection):
+        self._selector.unregister(connection.sock)
+        connection.sock.close()
+
+    def _receive(self, connection):
+        try:
+            data = connection.sock.recv(self._RX_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if len(data) == 0:
+            self._disconnect(connection)
+            return
+        self._bus.process_data(connection.decoder, data, connection.tx_buffer)
+        if len(connection.tx_buffer) > 0:
+            self._send(connection)
+
+    def _send(self, connection):
+        try:
+            n_bytes = connection.sock.send(connection.tx_buffer)
+        except BlockingIOError:
+            n_bytes = 0
+        except OSError:
+            self._disconnect(connection)
+            return
+        del connection.tx_buffer[:n_bytes]
+        # Only wait for writable when there is data left
+        events = selectors.EVENT_READ
+        if len(connection.tx_buffer) > 0:
+            events |= selectors.EVENT_WRITE
+        if self._selector.get_key(connection.sock).events != events:
+            self._selector.modify(connection.sock, events, connection)
 
     def _handle_packets(self):
-        sock = socket.create_server((self._HOST, self._port))
-        sock.settimeout(self._RX_TIME_OUT)
         while not self._stop_event.is_set():
-            try:
-                connection = sock.accept()[0]
-            except TimeoutError:
-                continue
-            data = connection.recv(self._RX_BUFFER_SIZE)
-            pos_stx = data.find(DataPacket.STX)
-            pos_etx = data.find(DataPacket.ETX)
-            if pos_stx != -1 and (pos_etx - pos_stx) >= 7:
-                for response in self._process_packet(data[pos_stx:pos_etx + 1]):
-                    connection.sendall(response.get_data())
-        sock.close()
-
-    def _process_packet(self, data):
-        responses = []
-        for module in self._modules:
-            response = module.process_packet(data)
-            if response is not None:
-                responses.append(response)
-        return responses
+            for key, events in self._selector.select(self._RX_TIME_OUT):
+                if key.data is None:
+                    self._accept()
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self._send(key.data)
+                if events & selectors.EVENT_READ and key.fileobj.fileno() >= 0:
+                    self._receive(key.data)
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
 
     def is_running(self):
         return self._thread.is_alive()
 
+    def close(self):
+        if self._thread.is_alive():
+            self._stop_event.set()
+            self._thread.join()
+
 
 if __name__ == "__main__":
 
     import time
 
+    from models.data_packet import DataPacket
     from models.rs485_driver import RS485Driver
     from models.simulator.lily_module_cm import LilyModuleCM
 
@@ -82,3 +141,4 @@ if __name__ == "__main__":
     time.sleep(2)
 
     rs485.close()
+    sim.close()
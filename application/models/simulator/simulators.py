@@ -1,9 +1,11 @@
 """
 Run the simulators
+The simulators run as TCP servers (one per port) or as virtual buses in memory (virtual=True).
 """
 
 from application.models.simulator.lily_module_cm import LilyModuleCM
 from application.models.simulator.lily_simulator import LilySimulator
+from application.models.simulator.virtual_bus import VirtualBus
 
 
 class Simulators:
@@ -11,24 +13,33 @@ class Simulators:
     PORTS = [17001, 17002]
 
     _simulators = []
+    _port_names = []
 
     @classmethod
-    def run(cls):
+    def run(cls, virtual=False):
         serial = 100001
         for port in cls.PORTS:
             modules = [LilyModuleCM(1, f"{serial}")]
             serial += 1
-            cls._simulators.append(
-                LilySimulator(port, modules)
-            )
+            if virtual:
+                cls._port_names.append(VirtualBus.register(f"simulator{port}", modules))
+            else:
+                cls._simulators.append(
+                    LilySimulator(port, modules)
+                )
+                cls._port_names.append(f"socket://localhost:{port}")
 
     @classmethod
     def is_running(cls):
-        running = False
+        running = len(cls._port_names) > 0
         if len(cls._simulators) > 0:
             running = False not in list(map(lambda s: s.is_running(), cls._simulators))
         return running
 
+    @classmethod
+    def get_port_names(cls):
+        return list(cls._port_names)
+
 
 if __name__ == "__main__":
 
@@ -49,8 +60,8 @@ if __name__ == "__main__":
     print("Connecting to the simulator")
 
     ports = []
-    for _port in Simulators.PORTS:
-        ports.append(RS485Driver(f"socket://localhost:{_port}", _rx_callback))
+    for _port_name in Simulators.get_port_names():
+        ports.append(RS485Driver(_port_name, _rx_callback))
 
     # Ask the module ID for all modules
     packet = DataPacket()
@@ -1,20 +1,81 @@
 """
 TCP server used in the simulator but also in the unit tests.
+
+Multiple clients can be connected at the same time, the connections stay open until the client closes them.
+All connections are handled by one thread using a selector (no thread per connection).
+
+The packet handler returns a list of responses (bytes) and is called:
+- framing (default): for every complete frame, frames split over multiple chunks are reassembled (decoder per
+  connection), invalid frames are dropped and counted
+- raw (framing=False): for every received chunk of data
+The responses for one chunk are sent at once, data that could not be sent is sent when the socket is writable.
+When more than _TX_BUFFER_LIMIT bytes are waiting to be sent (client does not read), the connection is not read
+until the data is sent, so the memory of the server does not grow.
+An exception in the packet handler is counted (handler errors) and the chunk is dropped, the server keeps running.
+
+Statistics are kept per connection (bytes and frames received and sent, framing, CRC and handler errors, bytes
+waiting to be sent), see get_stats().
+Use port 0 to let the system choose a free port (parallel test runs), get_port() returns the port.
 """
 
+import selectors
 import socket
 import threading
+import time
+
+from application.models.frame_decoder import FrameDecoder
+
+
+class _Connection:
+
+    __slots__ = ("sock", "address", "decoder", "tx_buffer", "stats")
+
+    def __init__(self, sock, address, framing):
+        self.sock = sock
+        self.address = f"{address[0]}:{address[1]}"
+        self.decoder = FrameDecoder() if framing else None
+        self.tx_buffer = bytearray()
+        self.stats = {
+            "connected_at": time.time(),
+            "rx_bytes": 0,
+            "rx_frames": 0,
+            "tx_bytes": 0,
+            "tx_frames": 0,
+            "handler_errors": 0
+        }
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["address"] = self.address
+        stats["tx_buffer"] = len(self.tx_buffer)
+        if self.decoder is not None:
+            stats["framing_errors"] = self.decoder.framing_errors
+            stats["crc_errors"] = self.decoder.crc_errors
+        return stats
 
 
 class TCPServer:
 
-    _BUFFER_SIZE = 1500
+    _BUFFER_SIZE = 65536
     _RX_TIME_OUT = 1
+    _TX_BUFFER_LIMIT = 1048576
 
-    def __init__(self, host, port, packet_handler):
+    def __init__(self, host, port, packet_handler, framing=True):
         self._host = host
-        self._port = port
         self._packet_handler = packet_handler
+        self._framing = framing
+        self._connections = {}
+        self._closed_stats = {"connections": 0, "rx_bytes": 0, "tx_bytes": 0}
+        self._lock = threading.Lock()
+        # Listen before the thread is started, so clients can connect directly after creating the server
+        self._sock = socket.create_server((self._host, port))
+        self._sock.setblocking(False)
+        self._port = self._sock.getsockname()[1]
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._sock, selectors.EVENT_READ)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
         self._stop_event = threading.Event()
         self._thread = threading.Thread(target=self._tcp_server)
         self._thread.daemon = True
@@ -23,24 +84,105 @@ class TCPServer:
     def __del__(self):
         self.close()
 
+    def _accept(self):
+        try:
+            sock, address = self._sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = _Connection(sock, address, self._framing)
+        with self._lock:
+            self._connections[sock] = connection
+        self._selector.register(sock, selectors.EVENT_READ, connection)
+
+    def _disconnect(self, connection):
+        self._selector.unregister(connection.sock)
+        connection.sock.close()
+        with self._lock:
+            del self._connections[connection.sock]
+            self._closed_stats["connections"] += 1
+            self._closed_stats["rx_bytes"] += connection.stats["rx_bytes"]
+            self._closed_stats["tx_bytes"] += connection.stats["tx_bytes"]
+
+    def _receive(self, connection):
+        try:
+            data = connection.sock.recv(self._BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if len(data) == 0:
+            self._disconnect(connection)
+            return
+        stats = connection.stats
+        stats["rx_bytes"] += len(data)
+        chunks = [data] if connection.decoder is None else connection.decoder.feed(data)
+        for chunk in chunks:
+            stats["rx_frames"] += 1
+            try:
+                responses = self._packet_handler(chunk)
+            except (Exception, ):
+                stats["handler_errors"] += 1
+                continue
+            for response in responses:
+                connection.tx_buffer += response
+                stats["tx_frames"] += 1
+        if len(connection.tx_buffer) > 0:
+            self._send(connection)
+
+    def _send(self, connection):
+        try:
+            n_bytes = connection.sock.send(connection.tx_buffer)
+        except BlockingIOError:
+            n_bytes = 0
+        except OSError:
+            self._disconnect(connection)
+            return
+        del connection.tx_buffer[:n_bytes]
+        connection.stats["tx_bytes"] += n_bytes
+        # Only wait for writable when there is data left, stop reading when too much data is waiting
+        events = selectors.EVENT_READ if len(connection.tx_buffer) < self._TX_BUFFER_LIMIT else 0
+        if len(connection.tx_buffer) > 0:
+            events |= selectors.EVENT_WRITE
+        if self._selector.get_key(connection.sock).events != events:
+            self._selector.modify(connection.sock, events, connection)
+
     def _tcp_server(self):
-        with socket.create_server((self._host, self._port)) as sock:
-            sock.settimeout(self._RX_TIME_OUT)
-            while not self._stop_event.is_set():
-                try:
-                    connection = sock.accept()[0]
-                except TimeoutError:
+        while not self._stop_event.is_set():
+            for key, events in self._selector.select(self._RX_TIME_OUT):
+                if key.fileobj is self._sock:
+                    self._accept()
+                    continue
+                if key.fileobj is self._wake_r:
                     continue
-                while not self._stop_event.is_set():
-                    data = connection.recv(self._BUFFER_SIZE)
-                    if len(data) == 0:
-                        break
-                    for response in self._packet_handler(data):
-                        connection.sendall(response)
+                if events & selectors.EVENT_WRITE:
+                    self._send(key.data)
+                if events & selectors.EVENT_READ and key.fileobj.fileno() >= 0:
+                    self._receive(key.data)
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+        self._wake_w.close()
+
+    def get_port(self):
+        return self._port
+
+    def get_stats(self):
+        # Statistics of the open connections and totals of the closed connections
+        with self._lock:
+            return {
+                "connections": [connection.get_stats() for connection in self._connections.values()],
+                "closed": dict(self._closed_stats)
+            }
 
     def close(self):
         if self._thread.is_alive():
             self._stop_event.set()
+            try:
+                self._wake_w.send(b"\x00")
+            except OSError:
+                pass
             self._thread.join()
 
 
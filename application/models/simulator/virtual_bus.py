@@ -0,0 +1,84 @@
+"""
+Virtual bus with simulated modules, used in memory (no sockets).
+
+A virtual bus is registered with a name and can be opened by the RS485 driver with: loop://<name>.
+The buses are registered in the loop client (the driver does not depend on the simulator).
+Each bus is a rack with up to 9 slots. Requests are routed to the module in the slot (or all modules for a broadcast).
+Data written to the bus is processed directly, the responses are available for reading when the write returns.
+Modules can be inserted and removed while the bus is used (hot plug).
+
+The same request processing is used by the simulator (TCP).
+"""
+
+from application.models.data_packet import DataPacket
+from application.models.loop_client import LoopClient
+from application.models.simulator.lily_module_cm import LilyModuleCM
+
+
+class VirtualBus:
+
+    N_SLOTS = 9
+    _BROADCAST = 0xFF
+
+    def __init__(self, modules):
+        self._modules = modules
+        self._slots = {module.get_slot_number(): module for module in modules}
+
+    def insert_module(self, module):
+        # Replaces the module in the same slot (if any), the lists are replaced (not changed) for the readers
+        self.remove_module(module.get_slot_number())
+        self._modules = self._modules + [module]
+        self._slots = {**self._slots, module.get_slot_number(): module}
+
+    def remove_module(self, slot_number):
+        self._modules = [module for module in self._modules if module.get_slot_number() != slot_number]
+        self._slots = {module.get_slot_number(): module for module in self._modules}
+
+    def process_request(self, packet):
+        if packet.dsn == self._BROADCAST:
+            modules = self._modules
+        else:
+            module = self._slots.get(packet.dsn, None)
+            modules = [] if module is None else [module]
+        responses = []
+        for module in modules:
+            response = module.process_request(packet)
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def process_data(self, decoder, data, buffer):
+        # Decodes the frames in the data and appends the responses to the buffer (bytearray)
+        request = DataPacket()
+        for frame in decoder.feed(data):
+            if request.from_data(frame) == DataPacket.STATUS_OK:
+                for response in self.process_request(request):
+                    response.encode_into(buffer, True)
+
+    @staticmethod
+    def register(name, modules):
+        return LoopClient.register_bus(name, VirtualBus(modules))
+
+    @staticmethod
+    def unregister(name):
+        LoopClient.unregister_bus(name)
+
+    @staticmethod
+    def get(name):
+        return LoopClient.get_bus(name)
+
+    @classmethod
+    def create_racks(cls, n_racks, n_modules=N_SLOTS, name="rack"):
+        # Creates racks with communication modules, returns the port names
+        ports = []
+        for rack in range(1, n_racks + 1):
+            modules = [LilyModuleCM(slot, f"{rack:04X}{slot:02X}") for slot in range(1, n_modules + 1)]
+            ports.append(cls.register(f"{name}{rack}", modules))
+        return ports
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_virtual_bus import TestVirtualBus
+
+    TestVirtualBus().run()
@@ -0,0 +1,94 @@
+"""
+Startup timing: wall time of the import and initialization phases of the application.
+
+A phase is timed with a context manager, a mark records a moment (for example the first module detection).
+The times are relative to the import of this module (import it first), a mark is only recorded the first time.
+Phases and marks are always recorded (negligible overhead), the report is only shown in the startup timing mode:
+app.pyw --startup-timing or environment variable LILY_STARTUP_TIMING=1.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+
+class StartupTimer:
+
+    ENVIRONMENT_VARIABLE = "LILY_STARTUP_TIMING"
+    ARGUMENT = "--startup-timing"
+
+    _start = time.perf_counter()
+    # [(name, start, duration)], duration is None for a mark
+    _records = []
+    _marks = set()
+    _condition = threading.Condition()
+
+    @classmethod
+    def is_enabled(cls, arguments=()):
+        return cls.ARGUMENT in arguments or os.environ.get(cls.ENVIRONMENT_VARIABLE, "0") not in ("", "0")
+
+    @classmethod
+    def _add(cls, name, start, duration):
+        with cls._condition:
+            cls._records.append((name, start - cls._start, duration))
+            cls._condition.notify_all()
+
+    @classmethod
+    @contextlib.contextmanager
+    def phase(cls, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls._add(name, start, time.perf_counter() - start)
+
+    @classmethod
+    def mark(cls, name):
+        with cls._condition:
+            if name in cls._marks:
+                return
+            cls._marks.add(name)
+        cls._add(name, time.perf_counter(), None)
+
+    @classmethod
+    def wait_for_mark(cls, name, timeout=None):
+        with cls._condition:
+            return cls._condition.wait_for(lambda: name in cls._marks, timeout)
+
+    @classmethod
+    def get_report(cls):
+        # Phases and marks in order of their start time (seconds)
+        with cls._condition:
+            records = sorted(cls._records, key=lambda r: r[1])
+        return [{"name": name, "start": start, "duration": duration} for name, start, duration in records]
+
+    @classmethod
+    def get_time(cls, name):
+        # End time of the phase or time of the mark (seconds), None if not recorded
+        for record in cls.get_report():
+            if record["name"] == name:
+                return record["start"] + (record["duration"] or 0)
+        return None
+
+    @classmethod
+    def format_report(cls):
+        lines = ["Startup timing (ms):", f"{'start':>9} {'duration':>9}  phase"]
+        for record in cls.get_report():
+            duration = "" if record["duration"] is None else f"{1000 * record['duration']:9.1f}"
+            lines.append(f"{1000 * record['start']:9.1f} {duration:>9}  {record['name']}")
+        return "\n".join(lines)
+
+    @classmethod
+    def clear(cls):
+        with cls._condition:
+            cls._start = time.perf_counter()
+            cls._records = []
+            cls._marks = set()
+
+
+if __name__ == "__main__":
+
+    from unit_tests.models.test_startup_timer import TestStartupTimer
+
+    TestStartupTimer().run()
@@ -1,20 +1,38 @@
 """
 TCP client for connecting to the simulator.
 Must have same methods as the serial port class.
+
+Like a serial port, fileno() can be used with select/selectors.
+It returns a socket that is readable as long as there is received data waiting.
+
+The received data is written directly into a ring buffer (recv_into, no copies of the buffered data, see ring_buffer).
+When the ring buffer is full, the receive thread waits until data is read (TCP flow control to the server).
+Reading can block: read(n_bytes, timeout) waits until data is received (at most timeout seconds, None is forever)
+and returns the data that is available (at most n_bytes). Without timeout, read does not wait (like before).
+
+When the server closes the connection (EOF) or the connection fails, the receive thread ends.
+The data that is already received can still be read, after that read returns no data without waiting.
 """
 
 import socket
 import threading
 
+from application.models.ring_buffer import RingBuffer
+
 
 class TCPClient:
 
     _BUFFER_SIZE = 1500
+    _RX_BUFFER_SIZE = 1 << 20
 
-    def __init__(self, host, port):
-        self.in_waiting = 0
-        self._rx_data = b""
-        self._lock = threading.RLock()
+    def __init__(self, host, port, rx_buffer_size=_RX_BUFFER_SIZE):
+        self.port = f"socket://{host}:{port}"
+        self.is_open = True
+        self.error = None
+        self._rx_buffer = RingBuffer(rx_buffer_size)
+        self._condition = threading.Condition()
+        self._notify_r, self._notify_w = socket.socketpair()
+        self._notify_r.setblocking(False)
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._sock.connect((host, port))
         self._stop_event = threading.Event()
@@ -25,36 +43,95 @@ class TCPClient:
     def __del__(self):
         self.close()
 
+    @property
+    def in_waiting(self):
+        return len(self._rx_buffer)
+
+    def _get_free_space(self):
+        # Returns the free part of the ring buffer after the data (up to the end of the buffer), waits if it is full
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._rx_buffer) < self._rx_buffer.get_size() or
+                                     self._stop_event.is_set())
+            return self._rx_buffer.get_free_space()
+
     def _handle_rx_packets(self):
-        while not self._stop_event.is_set():
-            try:
-                data = self._sock.recv(self._BUFFER_SIZE)
-                if len(data) > 0:
-                    with self._lock:
-                        self._rx_data += data
-                        self.in_waiting = len(self._rx_data)
-            except (Exception, ):
-                pass
+        try:
+            while not self._stop_event.is_set():
+                # Only this thread writes in the free space, so the data is received without holding the lock
+                n_bytes = self._sock.recv_into(self._get_free_space())
+                if n_bytes == 0:
+                    # Connection closed by the server (or closed by us)
+                    break
+                with self._condition:
+                    if len(self._rx_buffer) == 0:
+                        self._notify_w.send(b"\x00")
+                    self._rx_buffer.commit(n_bytes)
+                    self._condition.notify_all()
+        except OSError as e:
+            if not self._stop_event.is_set():
+                self.error = e
+        finally:
+            with self._condition:
+                self.is_open = False
+                self._condition.notify_all()
 
-    def read(self, n_bytes=1):
-        with self._lock:
-            data_out = self._rx_data[:n_bytes]
-            self._rx_data = self._rx_data[n_bytes:]
-            self.in_waiting = len(self._rx_data)
+    def _wait_for_data(self, timeout):
+        # Returns True if there is data, must be called with the lock
+        if timeout is not None and timeout <= 0:
+            return len(self._rx_buffer) > 0
+        return (self._condition.wait_for(lambda: len(self._rx_buffer) > 0 or not self.is_open, timeout) and
+                len(self._rx_buffer) > 0)
+
+    def _data_read(self):
+        # Must be called with the lock, after reading from the ring buffer
+        if len(self._rx_buffer) == 0:
+            self._clear_notification()
+        self._condition.notify_all()
+
+    def read(self, n_bytes=1, timeout=0):
+        with self._condition:
+            if not self._wait_for_data(timeout):
+                return b""
+            data_out = self._rx_buffer.read(n_bytes)
+            self._data_read()
         return data_out
 
+    def readinto(self, buffer, timeout=0):
+        # Reads into the buffer (bytearray or memoryview), returns the number of bytes
+        with self._condition:
+            if not self._wait_for_data(timeout):
+                return 0
+            n_bytes = self._rx_buffer.readinto(buffer)
+            self._data_read()
+        return n_bytes
+
+    def _clear_notification(self):
+        try:
+            while len(self._notify_r.recv(self._BUFFER_SIZE)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+    def fileno(self):
+        return self._notify_r.fileno()
+
     def write(self, data):
         self._sock.sendall(data)
 
     def close(self):
+        self._stop_event.set()
         try:
             self._sock.shutdown(socket.SHUT_RDWR)
-            self._sock.close()
-        except (Exception,):
+        except (Exception, ):
             pass
-        if self._rx_thread.is_alive():
-            self._stop_event.set()
+        with self._condition:
+            # Wake up the receive thread when the ring buffer is full
+            self._condition.notify_all()
+        if self._rx_thread.is_alive() and self._rx_thread is not threading.current_thread():
             self._rx_thread.join()
+        self._sock.close()
+        self._notify_r.close()
+        self._notify_w.close()
 
 
 if __name__ == "__main__":
@@ -1,5 +1,8 @@
 """
 Main view of the application
+
+The tree items are indexed by rack ID and module location, no searching in the tree.
+The topology is applied as a difference: only changed items are added, updated or removed.
 """
 
 import wx
@@ -23,6 +26,9 @@ class ViewMain(wx.MDIParentFrame):
 
         self.SetInitialSize(self._MIN_WINDOW_SIZE)
 
+        self._rack_items = {}
+        self._module_items = {}
+
         self.Bind(wx.EVT_MENU, self._on_menu_exit, id=self.ID_MENU_EXIT)
         self.Bind(wx.EVT_SIZE, self._on_window_resize)
 
@@ -47,12 +53,28 @@ class ViewMain(wx.MDIParentFrame):
         self._notebook = wx.Notebook(parent)
         return self._notebook
 
-    def _find_item(self, item_id, parent):
-        item, cookie = self._tree.GetFirstChild(parent)
-        while item.IsOk():
-            if self._tree.GetItemText(item) == item_id:
-                return item
-            item, cookie = self._tree.GetNextChild(self._tree.GetRootItem(), cookie)
+    def _add_rack_item(self, rack_id, position):
+        item = self._tree.InsertItem(self._tree.GetRootItem(), position, rack_id)
+        self._rack_items[rack_id] = item
+        self._module_items[rack_id] = {}
+        return item
+
+    def _remove_rack_item(self, rack_id):
+        self._tree.Delete(self._rack_items.pop(rack_id))
+        del self._module_items[rack_id]
+
+    def _apply_modules(self, rack_id, modules):
+        rack_item = self._rack_items[rack_id]
+        items = self._module_items[rack_id]
+        locations = set(map(lambda m: m[1], modules))
+        for location in list(filter(lambda x: x not in locations, items.keys())):
+            self._tree.Delete(items.pop(location))
+        for position, (module_id, location) in enumerate(modules):
+            item = items.get(location, None)
+            if item is None:
+                items[location] = self._tree.InsertItem(rack_item, position, module_id, data=location)
+            elif self._tree.GetItemText(item) != module_id:
+                self._tree.SetItemText(item, module_id)
 
     def _on_menu_exit(self, event):
         self.Close()
@@ -62,18 +84,33 @@ class ViewMain(wx.MDIParentFrame):
         wx.adv.LayoutAlgorithm().LayoutMDIFrame(self)
 
     def add_rack(self, rack_id):
-        root = self._tree.GetRootItem()
-        if self._find_item(rack_id, root) is None:
-            self._tree.AppendItem(root, rack_id)
-            self._tree.ExpandAll()
+        if rack_id not in self._rack_items:
+            self._add_rack_item(rack_id, len(self._rack_items))
+            self._tree.Expand(self._tree.GetRootItem())
 
     def add_module(self, rack_id, module_id, location):
-        root = self._tree.GetRootItem()
-        rack_item = self._find_item(rack_id, root)
-        if rack_item is not None:
-            if self._find_item(module_id, rack_item) is None:
-                self._tree.AppendItem(rack_item, module_id, data=location)
-        self._tree.ExpandAll()
+        rack_item = self._rack_items.get(rack_id, None)
+        if rack_item is not None and location not in self._module_items[rack_id]:
+            self._module_items[rack_id][location] = self._tree.AppendItem(rack_item, module_id, data=location)
+            self._tree.Expand(rack_item)
+
+    def apply_topology(self, racks):
+        # Racks: list of (rack_id, [(module_id, location), ...]), in the order they must be shown
+        rack_ids = set(map(lambda r: r[0], racks))
+        self._tree.Freeze()
+        try:
+            for rack_id in list(filter(lambda x: x not in rack_ids, self._rack_items.keys())):
+                self._remove_rack_item(rack_id)
+            for position, (rack_id, modules) in enumerate(racks):
+                is_new = rack_id not in self._rack_items
+                if is_new:
+                    self._add_rack_item(rack_id, position)
+                self._apply_modules(rack_id, modules)
+                if is_new:
+                    self._tree.Expand(self._rack_items[rack_id])
+            self._tree.Expand(self._tree.GetRootItem())
+        finally:
+            self._tree.Thaw()
 
     def get_item_data(self, item):
         return self._tree.GetItemData(item)
@@ -102,5 +139,10 @@ if __name__ == "__main__":
     f.add_module("Rack [COM1]", "4 - Module 4", ("COM1", 4))
     # Try to add a module for a not existing rack
     f.add_module("Rack [COM9]", "4 - Module 4", ("COM9", 4))
+    # Apply a topology: remove a rack, rename a module, add a module
+    f.apply_topology([
+        ("Rack [COM1]", [(f"{j + 1} - Module {j + 1}", ("COM1", j + 1)) for j in range(5)]),
+        ("Rack [COM3]", [("1 - Renamed module", ("COM3", 1)), ("7 - Module 7", ("COM3", 7))])
+    ])
 
     app.MainLoop()
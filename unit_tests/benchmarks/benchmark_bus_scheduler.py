@@ -0,0 +1,77 @@
+"""
+Benchmark the bus scheduler: one request at a time versus a pipelined request window.
+- Requests per second to a rack with 9 modules, the modules need some time to process a request
+"""
+
+import lily_unit_test
+import threading
+import time
+
+from application.models.bus_scheduler import BusScheduler
+from application.models.data_packet import DataPacket
+from application.models.request_table import RequestTable
+from application.models.simulator.lily_module_cm import LilyModuleCM
+from unit_tests.lib.benchmark_results import BenchmarkResults
+
+
+class _RackDriver:
+
+    # Driver with a rack of simulated modules, each module responds after its processing time
+
+    def __init__(self, request_table, processing_time):
+        self._request_table = request_table
+        self._processing_time = processing_time
+        self._modules = {slot: LilyModuleCM(slot, f"1A2B{slot:02X}") for slot in range(1, 10)}
+
+    def _respond(self, response):
+        packet = DataPacket()
+        packet.from_data(response)
+        self._request_table.complete(self.get_port(), packet)
+
+    @staticmethod
+    def get_port():
+        return "COM1"
+
+    def send_data(self, data, _tx_callback=None):
+        packet = DataPacket()
+        packet.from_data(data)
+        response = self._modules[packet.dsn].process_packet(data)
+        timer = threading.Timer(self._processing_time, self._respond, (response.get_data(True), ))
+        timer.daemon = True
+        timer.start()
+
+
+class BenchmarkBusScheduler(lily_unit_test.TestSuite):
+
+    _PID_RANGES = ((0x0001, 0xFBFF), (0xFC00, 0xFFFF))
+    _PROCESSING_TIME = 0.01
+    _N_REQUESTS = 270
+
+    def _measure_requests(self, window):
+        request_table = RequestTable(1)
+        driver = _RackDriver(request_table, self._PROCESSING_TIME)
+        scheduler = BusScheduler(driver, request_table, self._PID_RANGES, window)
+        try:
+            t = time.perf_counter()
+            futures = [scheduler.submit(i % 9 + 1, [1]) for i in range(self._N_REQUESTS)]
+            for future in futures:
+                future.result(5)
+            t = time.perf_counter() - t
+        finally:
+            scheduler.close()
+        return self._N_REQUESTS / t
+
+    def test_requests_per_second(self):
+        results = {}
+        for window in [1, 4, 9]:
+            results[window] = self._measure_requests(window)
+            self.log.debug(f"Window {window}: {results[window]:.0f} requests/s")
+            message = BenchmarkResults.add(self.__class__.__name__, f"window_{window}", results[window],
+                                           "requests/s")
+            self.fail_if(message is not None, message)
+        self.fail_if(results[9] <= results[1], "Pipelining does not increase the number of requests")
+
+
+if __name__ == "__main__":
+
+    BenchmarkBusScheduler().run()
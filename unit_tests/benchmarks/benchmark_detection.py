@@ -0,0 +1,66 @@
+"""
+Benchmark the module detection: time to detect all modules in N racks.
+The racks are virtual buses (loop://), a wildcard scan is sent to all racks at the same time.
+"""
+
+import lily_unit_test
+import functools
+import time
+
+from application.models.bus_scheduler import BusScheduler
+from application.models.data_packet import DataPacket
+from application.models.request_table import RequestTable
+from application.models.rs485_driver import RS485Driver
+from application.models.simulator.virtual_bus import VirtualBus
+from unit_tests.lib.benchmark_results import BenchmarkResults
+
+
+class BenchmarkDetection(lily_unit_test.TestSuite):
+
+    _PID_RANGES = ((0x0001, 0xFBFF), (0xFC00, 0xFFFF))
+    _N_RACKS = [1, 10, 50]
+    _DETECTION_TIMEOUT = 5
+
+    _request_table = None
+
+    def _rx_callback(self, port_name, data):
+        packet = DataPacket()
+        if packet.from_data(data) == DataPacket.STATUS_OK:
+            self._request_table.complete(port_name, packet)
+
+    def _measure_detection(self, n_racks):
+        # Returns the time until all modules responded
+        self._request_table = RequestTable(self._DETECTION_TIMEOUT)
+        ports = VirtualBus.create_racks(n_racks, name=f"benchmark_{n_racks}_")
+        drivers = [RS485Driver(port, functools.partial(self._rx_callback, port), True) for port in ports]
+        schedulers = [BusScheduler(driver, self._request_table, self._PID_RANGES) for driver in drivers]
+        n_modules = n_racks * VirtualBus.N_SLOTS
+        try:
+            t = time.perf_counter()
+            for scheduler in schedulers:
+                scheduler.submit(0xFF, [1], detection=True)
+            while self._request_table.get_counters()["responses"] < n_modules:
+                if time.perf_counter() - t > self._DETECTION_TIMEOUT:
+                    self.fail(f"Not all modules detected: {self._request_table.get_counters()['responses']}")
+                time.sleep(0.0001)
+            t = time.perf_counter() - t
+        finally:
+            for scheduler in schedulers:
+                scheduler.close()
+            for driver in drivers:
+                driver.close()
+            for rack in range(1, n_racks + 1):
+                VirtualBus.unregister(f"benchmark_{n_racks}_{rack}")
+        return t
+
+    def test_detection_time(self):
+        for n_racks in self._N_RACKS:
+            t = 1000 * self._measure_detection(n_racks)
+            self.log.debug(f"Detection time for {n_racks:3} racks: {t:.1f} ms")
+            message = BenchmarkResults.add(self.__class__.__name__, f"detection_{n_racks}_racks", t, "ms", False)
+            self.fail_if(message is not None, message)
+
+
+if __name__ == "__main__":
+
+    BenchmarkDetection().run()
@@ -0,0 +1,72 @@
+"""
+Benchmark the startup of the Lily System with and without the module cache.
+The time from start() until all modules of N racks are shown with their identity (name, serial and version).
+The racks are virtual buses (loop://), so there is no bus latency in the cold start.
+"""
+
+import lily_unit_test
+import os
+import sys
+import tempfile
+import time
+
+from application.models.simulator.virtual_bus import VirtualBus
+from unit_tests.lib.benchmark_results import BenchmarkResults
+
+
+class BenchmarkModuleCache(lily_unit_test.TestSuite):
+
+    _APPLICATION_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "application"))
+    _N_RACKS = 40
+    _TIMEOUT = 30
+
+    _shown_at = None
+
+    def setup(self):
+        # The Lily System imports the models like the application (from the application folder)
+        if self._APPLICATION_FOLDER not in sys.path:
+            sys.path.append(self._APPLICATION_FOLDER)
+
+    def _on_rack_update(self, racks):
+        modules = [module for rack in racks for module in rack["modules"] if module["name"] != ""]
+        if self._shown_at is None and len(modules) == self._N_RACKS * VirtualBus.N_SLOTS:
+            self._shown_at = time.perf_counter()
+
+    def _measure_startup(self, ports, cache_filename):
+        # Returns the time until all modules are shown
+        from models.lily_system import LilySystem
+
+        self._shown_at = None
+        lily_system = LilySystem(self._on_rack_update, cache_filename)
+        for port in ports:
+            lily_system._open_port(port)
+        try:
+            t = time.perf_counter()
+            lily_system.start()
+            while self._shown_at is None:
+                if time.perf_counter() - t > self._TIMEOUT:
+                    self.fail("Not all modules shown")
+                time.sleep(0.0001)
+        finally:
+            lily_system.stop()
+        return self._shown_at - t
+
+    def test_startup_time(self):
+        ports = VirtualBus.create_racks(self._N_RACKS, name="benchmark_cache_")
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                cache_filename = os.path.join(folder, "module_cache.json")
+                for name in ["cold", "cached"]:
+                    t = 1000 * self._measure_startup(ports, cache_filename)
+                    self.log.debug(f"Startup time {name:6}: {t:.1f} ms")
+                    message = BenchmarkResults.add(self.__class__.__name__, f"startup_{name}_{self._N_RACKS}_racks",
+                                                   t, "ms", False)
+                    self.fail_if(message is not None, message)
+        finally:
+            for rack in range(1, self._N_RACKS + 1):
+                VirtualBus.unregister(f"benchmark_cache_{rack}")
+
+
+if __name__ == "__main__":
+
+    BenchmarkModuleCache().run()
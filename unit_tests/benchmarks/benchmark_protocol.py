@@ -0,0 +1,110 @@
+"""
+Benchmark the protocol functions.
+- CRC throughput
+- Encoding and decoding packets, for different payload sizes and amounts of byte stuffing
+- Converting the packet data to numbers and strings
+- Decoding a multi field payload: one conversion per field compared to a payload schema
+"""
+
+import lily_unit_test
+import time
+
+from application.models.crc8 import calculate_crc
+from application.models.data_packet import DataPacket
+from application.models.payload_schema import PayloadSchema
+from unit_tests.lib.benchmark_results import BenchmarkResults
+
+
+class BenchmarkProtocol(lily_unit_test.TestSuite):
+
+    _MEASURE_TIME = 0.2
+    _PAYLOAD_SIZES = [1, 8, DataPacket.MAX_DATA_SIZE]
+    # Fraction of the payload bytes that must be stuffed
+    _STUFFING_DENSITIES = [0, 0.25, 1]
+
+    def _measure(self, function, *args):
+        # Returns operations per second, the number of calls is increased until the measure time is reached
+        n_calls = 100
+        while True:
+            t = time.perf_counter()
+            for _ in range(n_calls):
+                function(*args)
+            t = time.perf_counter() - t
+            if t >= self._MEASURE_TIME:
+                return n_calls / t
+            n_calls *= 2
+
+    def _add_result(self, name, value, unit):
+        self.log.debug(f"{name:40}: {value:12.0f} {unit}")
+        message = BenchmarkResults.add(self.__class__.__name__, name, value, unit)
+        self.fail_if(message is not None, message)
+
+    @staticmethod
+    def _create_payload(size, density):
+        # The special bytes are spread over the payload
+        n_stuffed = round(size * density)
+        special_bytes = [DataPacket.STX, DataPacket.ETX, DataPacket.DLE]
+        payload = []
+        for i in range(size):
+            if i * n_stuffed // size != (i + 1) * n_stuffed // size:
+                payload.append(special_bytes[i % 3])
+            else:
+                payload.append(0x41 + i % 26)
+        return bytes(payload)
+
+    @staticmethod
+    def _create_packet(payload):
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.ssn = 0
+        packet.pid = 0x1234
+        packet.data = payload
+        return packet
+
+    def test_crc(self):
+        for size in [DataPacket.MAX_PACKET_SIZE, 4096]:
+            data = bytes(i & 0xFF for i in range(size))
+            ops = self._measure(calculate_crc, data)
+            self._add_result(f"crc_{size}_bytes", ops * size / 1000000, "MB/s")
+
+    def test_get_data(self):
+        for size in self._PAYLOAD_SIZES:
+            for density in self._STUFFING_DENSITIES:
+                packet = self._create_packet(self._create_payload(size, density))
+                ops = self._measure(packet.get_data)
+                self._add_result(f"get_data_{size}_bytes_{int(100 * density)}%_stuffed", ops, "ops/s")
+
+    def test_from_data(self):
+        for size in self._PAYLOAD_SIZES:
+            for density in self._STUFFING_DENSITIES:
+                data = self._create_packet(self._create_payload(size, density)).get_data()
+                ops = self._measure(DataPacket().from_data, data)
+                self._add_result(f"from_data_{size}_bytes_{int(100 * density)}%_stuffed", ops, "ops/s")
+
+    def test_convert_data(self):
+        packet = self._create_packet(bytes(range(0x30, 0x30 + DataPacket.MAX_DATA_SIZE)))
+        for n_bytes in [1, 2, 4, 8]:
+            ops = self._measure(packet.convert_data_to_number, n_bytes)
+            self._add_result(f"convert_data_to_number_{n_bytes}_bytes", ops, "ops/s")
+        ops = self._measure(packet.convert_data_to_string)
+        self._add_result("convert_data_to_string", ops, "ops/s")
+
+    def test_payload_schema(self):
+        schema = PayloadSchema.compile("u16 mfg, u16 module, i32 value, str[16] name")
+        packet = self._create_packet(schema.encode(0x047C, 2, -123456, "Generator"))
+
+        def _convert_fields():
+            return (packet.convert_data_to_number(2), packet.convert_data_to_number(2, 2),
+                    packet.convert_data_to_number(4, 4, True), packet.payload[8:24].rstrip(b"\x00").decode("cp437"))
+
+        ops = self._measure(_convert_fields)
+        self._add_result("decode_fields_convert_data", ops, "ops/s")
+        ops = self._measure(packet.decode_payload, schema)
+        self._add_result("decode_fields_payload_schema", ops, "ops/s")
+        ops = self._measure(schema.encode, 0x047C, 2, -123456, "Generator")
+        self._add_result("encode_fields_payload_schema", ops, "ops/s")
+
+
+if __name__ == "__main__":
+
+    BenchmarkProtocol().run()
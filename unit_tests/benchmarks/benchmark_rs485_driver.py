@@ -0,0 +1,113 @@
+"""
+Benchmark the RS485 driver: polling mode versus event driven mode.
+- CPU load per idle port
+- Round trip latency percentiles against the simulator
+"""
+
+import lily_unit_test
+import queue
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.rs485_driver import RS485Driver
+from application.models.simulator.lily_module_cm import LilyModuleCM
+from application.models.simulator.lily_simulator import LilySimulator
+from application.models.simulator.tcp_server import TCPServer
+from unit_tests.lib.benchmark_results import BenchmarkResults
+
+
+class BenchmarkRS485Driver(lily_unit_test.TestSuite):
+
+    _HOST = "localhost"
+    _PORT = 17130
+    _N_PORTS = 4
+    _IDLE_TIME = 2
+    _N_ROUND_TRIPS = 200
+
+    _tcp_servers = []
+    _simulator = None
+    _rx_queue = queue.Queue()
+
+    @staticmethod
+    def _tcp_callback(data):
+        # Loopback
+        packet = DataPacket()
+        packet.from_data(data)
+        packet.dsn = 1
+        packet.ssn = 2
+        return [packet.get_data()]
+
+    def _rx_callback(self, data):
+        self._rx_queue.put(data)
+
+    def _open_drivers(self, event_driven):
+        return [RS485Driver(f"socket://{self._HOST}:{self._PORT + i}", self._rx_callback, event_driven)
+                for i in range(self._N_PORTS)]
+
+    def _measure_idle_cpu_load(self, event_driven):
+        drivers = self._open_drivers(event_driven)
+        time.sleep(0.2)
+        t_cpu = time.process_time()
+        t_wall = time.perf_counter()
+        time.sleep(self._IDLE_TIME)
+        t_cpu = time.process_time() - t_cpu
+        t_wall = time.perf_counter() - t_wall
+        for driver in drivers:
+            driver.close()
+        # CPU load per port in percent of one core
+        return 100 * t_cpu / t_wall / self._N_PORTS
+
+    def _add_result(self, name, value, unit, higher_is_better=True):
+        message = BenchmarkResults.add(self.__class__.__name__, name, value, unit, higher_is_better)
+        self.fail_if(message is not None, message)
+
+    def _measure_round_trip(self, event_driven):
+        driver = RS485Driver(f"socket://{self._HOST}:{self._PORT + self._N_PORTS}", self._rx_callback, event_driven)
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.ssn = 0
+        packet.data = [1]
+        times = []
+        try:
+            for i in range(self._N_ROUND_TRIPS):
+                packet.pid = i + 1
+                data = packet.get_data()
+                t = time.perf_counter()
+                driver.send_data(data)
+                self._rx_queue.get(True, 1)
+                times.append(time.perf_counter() - t)
+        finally:
+            driver.close()
+        times.sort()
+        return 1000000 * times[len(times) // 2], 1000000 * times[int(len(times) * 0.99)]
+
+    def setup(self):
+        self._tcp_servers = [TCPServer(self._HOST, self._PORT + i, self._tcp_callback) for i in range(self._N_PORTS)]
+        self._simulator = LilySimulator(self._PORT + self._N_PORTS, [LilyModuleCM(1, "1A2B3C")])
+
+    def teardown(self):
+        for tcp_server in self._tcp_servers:
+            tcp_server.close()
+        if self._simulator is not None:
+            self._simulator.close()
+
+    def test_idle_cpu_load(self):
+        load_polling = self._measure_idle_cpu_load(False)
+        load_events = self._measure_idle_cpu_load(True)
+        self.log.debug(f"CPU load per idle port, polling     : {load_polling:.1f}%")
+        self.log.debug(f"CPU load per idle port, event driven: {load_events:.1f}%")
+        self.fail_if(load_events >= load_polling, "Event driven mode does not reduce the CPU load")
+
+    def test_round_trip_latency(self):
+        for event_driven in [False, True]:
+            median, p99 = self._measure_round_trip(event_driven)
+            mode = "event driven" if event_driven else "polling     "
+            self.log.debug(f"Round trip, {mode}: median {median:.0f} us, 99% {p99:.0f} us")
+            mode = mode.strip().replace(" ", "_")
+            self._add_result(f"round_trip_{mode}_p50", median, "us", False)
+            self._add_result(f"round_trip_{mode}_p99", p99, "us", False)
+
+
+if __name__ == "__main__":
+
+    BenchmarkRS485Driver().run()
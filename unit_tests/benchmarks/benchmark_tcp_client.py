@@ -0,0 +1,77 @@
+"""
+Benchmark the TCP client: throughput of a 100 MB stream through the TCP server (loopback) and the TCP client.
+- blocking reads (read with time out)
+- polling in_waiting (like the RS485 driver with serial ports)
+"""
+
+import lily_unit_test
+import threading
+import time
+
+from application.models.simulator.tcp_server import TCPServer
+from application.models.tcp_client import TCPClient
+from unit_tests.lib.benchmark_results import BenchmarkResults
+
+
+class BenchmarkTCPClient(lily_unit_test.TestSuite):
+
+    _HOST = "localhost"
+    _PORT = 17150
+    _STREAM_SIZE = 100 * 1000000
+    _CHUNK = bytes(range(256)) * 256
+    _READ_SIZE = 65536
+    _TIMEOUT = 60
+
+    _tcp_server = None
+
+    @staticmethod
+    def _packet_handler(data):
+        # Loopback
+        return [data]
+
+    def setup(self):
+        self._tcp_server = TCPServer(self._HOST, self._PORT, self._packet_handler, False)
+
+    def teardown(self):
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+
+    def _write_stream(self, client):
+        n_bytes = 0
+        while n_bytes < self._STREAM_SIZE:
+            client.write(self._CHUNK)
+            n_bytes += len(self._CHUNK)
+
+    def _measure_throughput(self, blocking):
+        # Returns the throughput in MB/s
+        client = TCPClient(self._HOST, self._PORT)
+        try:
+            writer = threading.Thread(target=self._write_stream, args=(client, ))
+            writer.daemon = True
+            t = time.perf_counter()
+            writer.start()
+            n_bytes = 0
+            while n_bytes < self._STREAM_SIZE:
+                if time.perf_counter() - t > self._TIMEOUT:
+                    self.fail(f"Stream not received: {n_bytes} bytes")
+                if blocking:
+                    n_bytes += len(client.read(self._READ_SIZE, 1))
+                elif client.in_waiting > 0:
+                    n_bytes += len(client.read(client.in_waiting))
+            t = time.perf_counter() - t
+            writer.join()
+        finally:
+            client.close()
+        return self._STREAM_SIZE / t / 1000000
+
+    def test_throughput(self):
+        for name, blocking in (("blocking_read", True), ("polling", False)):
+            throughput = self._measure_throughput(blocking)
+            self.log.debug(f"Throughput {name:13}: {throughput:.1f} MB/s")
+            message = BenchmarkResults.add(self.__class__.__name__, f"throughput_{name}", throughput, "MB/s")
+            self.fail_if(message is not None, message)
+
+
+if __name__ == "__main__":
+
+    BenchmarkTCPClient().run()
@@ -1,73 +1,100 @@
 """
 Test getting the generic commands.
+Requests are sent with retries, a lost packet is sent again.
 """
 
 import lily_unit_test
 
+from application.models.bus_scheduler import BusScheduler
 from application.models.data_packet import DataPacket
+from application.models.payload_schema import GENERIC_RESPONSES
+from application.models.request_table import RequestTable
+from application.models.retry_policy import RetryPolicy
 from application.models.rs485_driver import RS485Driver
 from unit_tests.lib.test_settings import TestSettings
 
 
+class _Driver(RS485Driver):
+
+    # Keeps the PID of the last request sent (a retry has a new PID)
+
+    def __init__(self, serial_port, rx_callback, event_driven=False):
+        self.tx_pid = None
+        super().__init__(serial_port, rx_callback, event_driven)
+
+    def send_data(self, data, tx_callback=None):
+        packet = DataPacket()
+        packet.from_data(data)
+        self.tx_pid = packet.pid
+        super().send_data(data, tx_callback)
+
+
 class TestGenericCommands(lily_unit_test.TestSuite):
 
+    _PID_RANGES = ((0x0001, 0xFBFF), (0xFC00, 0xFFFF))
+    _TIMEOUT = 0.2
+    _RETRIES = 3
+
     rs485 = None
     rx_packet = None
+    _requests = None
+    _scheduler = None
 
-    def _send_packet(self, pid, data):
-        self.rx_packet = None
-        packet = DataPacket()
-        packet.dsn = 0x01
-        packet.ssn = 0x00
-        packet.pid = pid
-        packet.data = [data]
-        self.rs485.send_data(packet.get_data())
+    def _send_packet(self, data):
+        future = self._scheduler.submit(0x01, [data])
+        try:
+            self.rx_packet = future.result()
+        except TimeoutError:
+            self.rx_packet = None
 
     def _rx_callback(self, data):
-        self.rx_packet = DataPacket()
-        self.rx_packet.from_data(data)
-
-    def _packet_received(self):
-        return self.rx_packet is not None
+        packet = DataPacket()
+        if packet.from_data(data) == DataPacket.STATUS_OK:
+            self._requests.complete(self.rs485.get_port(), packet)
 
-    def _check_packet(self, pid, length):
-        self.fail_if(not self.wait_for(self._packet_received, True, 5, 0.1), "Did not receive a packet")
+    def _check_packet(self, length):
+        self.fail_if(self.rx_packet is None, "Did not receive a packet")
         self.fail_if(self.rx_packet.dsn != 0, f"Wrong DSN: {self.rx_packet.dsn}")
         self.fail_if(self.rx_packet.ssn != 1, f"Wrong SSN: {self.rx_packet.ssn}")
-        self.fail_if(self.rx_packet.pid != pid, f"Wrong PID: {self.rx_packet.pid}")
+        self.fail_if(self.rx_packet.pid != self.rs485.tx_pid,
+                     f"Wrong PID: {self.rx_packet.pid}, expected: {self.rs485.tx_pid}")
         self.fail_if(len(self.rx_packet.data) != length, f"Wrong data size: {len(self.rx_packet.data)}")
 
     def setup(self):
-        self.rs485 = RS485Driver(TestSettings.get_serial_port(), self._rx_callback)
+        self._requests = RequestTable(self._TIMEOUT)
+        self.rs485 = _Driver(TestSettings.get_serial_port(), self._rx_callback, True)
+        self._scheduler = BusScheduler(self.rs485, self._requests, self._PID_RANGES,
+                                       retry_policy=RetryPolicy(self._RETRIES, self._TIMEOUT))
 
     def test_get_module_id(self):
-        self._send_packet(1, 1)
-        self._check_packet(1, 4)
-        mfg_code = self.rx_packet.convert_data_to_number(2)
-        self.fail_if(mfg_code != 1148, f"Wrong manufacturer code: {mfg_code}")
-        module_code = self.rx_packet.convert_data_to_number(2, 2)
-        self.log.debug(f"Module ID: {mfg_code:04X}-{module_code:04X}")
+        self._send_packet(1)
+        self._check_packet(4)
+        module_id = self.rx_packet.decode_payload(GENERIC_RESPONSES[1])
+        self.fail_if(module_id.mfg != 1148, f"Wrong manufacturer code: {module_id.mfg}")
+        self.log.debug(f"Module ID: {module_id.mfg:04X}-{module_id.module:04X}")
 
     def test_get_module_name(self):
-        self._send_packet(2, 2)
-        self._check_packet(2, 16)
+        self._send_packet(2)
+        self._check_packet(16)
         module_name = self.rx_packet.convert_data_to_string()
         self.log.debug(f"Module name: {module_name}")
         self.fail_if(not module_name.startswith("LS-"), "Invalid module name")
 
     def test_get_serial(self):
-        self._send_packet(3, 3)
-        self._check_packet(3, 6)
+        self._send_packet(3)
+        self._check_packet(6)
         serial = self.rx_packet.convert_data_to_string()
         self.log.debug(f"Serial: {serial}")
 
     def test_get_version(self):
-        self._send_packet(4, 4)
-        self._check_packet(4, 3)
+        self._send_packet(4)
+        self._check_packet(3)
         version = self.rx_packet.convert_data_to_string()
         self.log.debug(f"Version: {version}")
 
     def teardown(self):
+        if self._scheduler is not None:
+            self._scheduler.close()
         if self.rs485 is not None:
             self.rs485.close()
 
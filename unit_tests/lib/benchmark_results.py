@@ -0,0 +1,107 @@
+"""
+Benchmark results, written to a JSON file and compared with a stored baseline.
+
+Results are stored by key: <benchmark suite>.<benchmark name>.
+The results file is in the test reports folder: benchmark_results.json.
+The baseline file is stored next to the test settings: benchmark_baseline.json.
+The baseline is updated from the last results by running: update_benchmark_baseline.py.
+Each benchmark run (run_benchmarks.py) starts with an empty results file, so results of benchmarks that are removed
+or renamed do not end up in the baseline. A benchmark suite that is run on its own adds its results to the last run.
+
+A result is a regression if it is worse than the baseline by more than the threshold (fraction of the baseline).
+The default threshold can be changed in the baseline file (default_threshold),
+each result in the baseline file can have its own threshold (threshold).
+If there is no baseline for a result, the result is not compared.
+"""
+
+import json
+import os
+import platform
+import threading
+import time
+
+
+class BenchmarkResults:
+
+    _RESULTS_FILENAME = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "test_reports",
+                                                     "benchmark_results.json"))
+    _BASELINE_FILENAME = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "benchmark_baseline.json"))
+    _DEFAULT_THRESHOLD = 0.2
+
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _read_file(filename):
+        if not os.path.isfile(filename):
+            return {}
+        with open(filename, "r") as fp:
+            return json.load(fp)
+
+    @staticmethod
+    def _write_file(filename, content):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as fp:
+            json.dump(content, fp, indent=4)
+
+    @classmethod
+    def _compare(cls, key, result):
+        baseline = cls._read_file(cls._BASELINE_FILENAME)
+        reference = baseline.get("results", {}).get(key, None)
+        if reference is None or reference["value"] == 0:
+            return None
+        threshold = reference.get("threshold", baseline.get("default_threshold", cls._DEFAULT_THRESHOLD))
+        change = (result["value"] - reference["value"]) / reference["value"]
+        if not result["higher_is_better"]:
+            change = -change
+        if change < -threshold:
+            return (f"Regression for {key}: {result['value']:.6g} {result['unit']}, "
+                    f"baseline: {reference['value']:.6g} {result['unit']} ({100 * change:.1f}%)")
+        return None
+
+    @classmethod
+    def clear(cls):
+        # Removes the results of the previous run
+        with cls._lock:
+            if os.path.isfile(cls._RESULTS_FILENAME):
+                os.remove(cls._RESULTS_FILENAME)
+
+    @classmethod
+    def add(cls, suite_name, name, value, unit, higher_is_better=True):
+        # Stores the result, returns a message in case of a regression, else None
+        key = f"{suite_name}.{name}"
+        result = {
+            "value": value,
+            "unit": unit,
+            "higher_is_better": higher_is_better
+        }
+        with cls._lock:
+            results = cls._read_file(cls._RESULTS_FILENAME)
+            results["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            results["python"] = platform.python_version()
+            results["machine"] = platform.machine()
+            results.setdefault("results", {})[key] = result
+            cls._write_file(cls._RESULTS_FILENAME, results)
+            return cls._compare(key, result)
+
+    @classmethod
+    def get_results(cls):
+        return cls._read_file(cls._RESULTS_FILENAME).get("results", {})
+
+    @classmethod
+    def update_baseline(cls):
+        # Replaces the baseline values with the last results, thresholds are kept
+        with cls._lock:
+            baseline = cls._read_file(cls._BASELINE_FILENAME)
+            baseline.setdefault("default_threshold", cls._DEFAULT_THRESHOLD)
+            references = baseline.setdefault("results", {})
+            for key, result in cls.get_results().items():
+                reference = references.setdefault(key, {})
+                reference.update(result)
+            cls._write_file(cls._BASELINE_FILENAME, baseline)
+        return len(references)
+
+
+if __name__ == "__main__":
+
+    for _key, _result in BenchmarkResults.get_results().items():
+        print(f"{_key:60} {_result['value']:12.6g} {_result['unit']}")
@@ -0,0 +1,186 @@
+"""
+Test the bus capture: recording with the driver, reading and replaying.
+"""
+
+import lily_unit_test
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from application.models.bus_capture import BusCapture, BusCaptureReader, BusCaptureReplayer, BusCaptureWriter
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+from application.models.rs485_driver import RS485Driver
+from application.models.simulator.lily_module_cm import LilyModuleCM
+from application.models.simulator.lily_simulator import LilySimulator
+from application.models.simulator.virtual_bus import VirtualBus
+
+
+class TestBusCapture(lily_unit_test.TestSuite):
+
+    _BUS_NAME = "test_capture"
+    _PORT = 17190
+    _N_REQUESTS = 50
+
+    _rx_queue = queue.Queue()
+
+    def _rx_callback(self, data):
+        self._rx_queue.put(data)
+
+    def _send_requests(self, driver):
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.data = [1]
+        for pid in range(1, self._N_REQUESTS + 1):
+            packet.pid = pid
+            driver.send_data(packet.get_data())
+            self._rx_queue.get(True, 1)
+
+    def setup(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._folder.name, "bus.cap")
+
+    def teardown(self):
+        self._folder.cleanup()
+
+    def test_record(self):
+        port_name = VirtualBus.register(self._BUS_NAME, [LilyModuleCM(1, "000001")])
+        capture = BusCaptureWriter(self._filename)
+        driver = RS485Driver(port_name, self._rx_callback, True, capture=capture)
+        try:
+            self._send_requests(driver)
+        finally:
+            driver.close()
+            capture.close()
+            VirtualBus.unregister(self._BUS_NAME)
+        with BusCaptureReader(self._filename) as reader:
+            self.fail_if(reader.get_ports() != [port_name], f"Wrong ports: {reader.get_ports()}")
+            frames = list(reader)
+        tx_frames = [frame for frame in frames if frame.direction == BusCapture.DIRECTION_TX]
+        rx_data = b"".join(frame.data for frame in frames if frame.direction == BusCapture.DIRECTION_RX)
+        self.log.debug(f"Frames: {len(frames)}, file size: {os.path.getsize(self._filename)} bytes")
+        self.fail_if(len(tx_frames) != self._N_REQUESTS, f"Wrong number of TX frames: {len(tx_frames)}")
+        self.fail_if(len(FrameDecoder().feed(rx_data)) != self._N_REQUESTS, "Wrong number of RX frames")
+        self.fail_if(sorted(frames, key=lambda f: f.timestamp) != frames, "Frames not in time order")
+        self.fail_if(frames[0].port_name != port_name, f"Wrong port name: {frames[0].port_name}")
+
+    def test_broken_file(self):
+        capture = BusCaptureWriter(self._filename)
+        recorder = capture.get_recorder("COM1")
+        for i in range(10):
+            recorder.record(BusCapture.DIRECTION_TX, i, bytes(10))
+        capture.close()
+        # Last record not completely written
+        with open(self._filename, "r+b") as fp:
+            fp.truncate(os.path.getsize(self._filename) - 3)
+        with BusCaptureReader(self._filename) as reader:
+            n_frames = len(list(reader))
+        self.fail_if(n_frames != 9, f"Wrong number of frames: {n_frames}")
+        with open(self._filename, "wb") as fp:
+            fp.write(b"no capture")
+        try:
+            BusCaptureReader(self._filename)
+            self.fail("No error for an invalid capture file")
+        except ValueError as e:
+            self.log.debug(f"Error: {e}")
+
+    def test_replay_timing(self):
+        capture = BusCaptureWriter(self._filename)
+        recorder = capture.get_recorder("COM1")
+        for i in range(5):
+            recorder.record(BusCapture.DIRECTION_TX, 20000000 * i, bytes([i]))
+        capture.close()
+        with BusCaptureReader(self._filename) as reader:
+            times = []
+            for speed, expected in [(1, 0.08), (4, 0.02), (0, 0)]:
+                frames = []
+                t = time.perf_counter()
+                n_frames = BusCaptureReplayer(reader, speed).replay(frames.append)
+                t = time.perf_counter() - t
+                self.log.debug(f"Replay at speed {speed}: {1000 * t:.1f} ms")
+                self.fail_if(n_frames != 5 or [frame.data[0] for frame in frames] != list(range(5)), "Wrong frames")
+                # The replay never runs ahead of the capture, the upper limit has a large margin for loaded systems
+                self.fail_if(not expected <= t < expected + 1, f"Wrong replay time: {1000 * t:.1f} ms")
+                times.append(t)
+            self.fail_if(sorted(times, reverse=True) != times, "A faster replay took more time")
+
+    def test_stop_recording(self):
+        # After stopping the recording in the driver, the driver adds no records (also while sending)
+        port_name = VirtualBus.register(self._BUS_NAME, [LilyModuleCM(1, "000001")])
+        capture = BusCaptureWriter(self._filename)
+        driver = RS485Driver(port_name, lambda data: None, True, capture=capture)
+        stop_event = threading.Event()
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.pid = 1
+        packet.data = [1]
+
+        def _send():
+            while not stop_event.is_set():
+                driver.send_data(packet.get_data())
+                time.sleep(0.0001)
+
+        thread = threading.Thread(target=_send)
+        thread.start()
+        try:
+            time.sleep(0.05)
+            driver.set_capture(None)
+            capture.close()
+            time.sleep(0.05)
+            self.fail_if(len(capture._records) != 0, f"Records added after closing: {len(capture._records)}")
+        finally:
+            stop_event.set()
+            thread.join()
+            driver.close()
+            VirtualBus.unregister(self._BUS_NAME)
+        with BusCaptureReader(self._filename) as reader:
+            self.fail_if(len(list(reader)) == 0, "No records in the capture")
+
+    def test_replay_to_simulator(self):
+        port_name = VirtualBus.register(self._BUS_NAME, [LilyModuleCM(1, "000001")])
+        capture = BusCaptureWriter(self._filename)
+        driver = RS485Driver(port_name, self._rx_callback, True, capture=capture)
+        try:
+            self._send_requests(driver)
+        finally:
+            driver.close()
+            capture.close()
+            VirtualBus.unregister(self._BUS_NAME)
+        simulator = LilySimulator(self._PORT, [LilyModuleCM(1, "000001")])
+        driver = RS485Driver(f"socket://localhost:{self._PORT}", self._rx_callback, True)
+        try:
+            with BusCaptureReader(self._filename) as reader:
+                n_frames = BusCaptureReplayer(reader, 0).replay_to_driver(driver)
+            n_responses = 0
+            try:
+                while n_responses < n_frames:
+                    self._rx_queue.get(True, 1)
+                    n_responses += 1
+            except queue.Empty:
+                pass
+        finally:
+            driver.close()
+            simulator.close()
+        self.fail_if(n_responses != self._N_REQUESTS, f"Wrong number of responses: {n_responses}")
+
+    def test_recording_overhead(self):
+        capture = BusCaptureWriter(self._filename)
+        recorder = capture.get_recorder("COM1")
+        data = bytes(DataPacket.MAX_PACKET_SIZE)
+        n_records = 100000
+        t = time.perf_counter()
+        for i in range(n_records):
+            recorder.record(BusCapture.DIRECTION_RX, i, data)
+        t = time.perf_counter() - t
+        capture.close()
+        self.log.debug(f"Recording time: {1e9 * t / n_records:.0f} ns per frame")
+        with BusCaptureReader(self._filename) as reader:
+            n_frames = sum(1 for _ in reader)
+        self.fail_if(n_frames != n_records, f"Wrong number of frames: {n_frames}")
+
+
+if __name__ == "__main__":
+
+    TestBusCapture().run()
@@ -0,0 +1,150 @@
+"""
+Test the bus log analyzer, the results are compared with the frame decoder and the data packet.
+"""
+
+import lily_unit_test
+import os
+import random
+import tempfile
+import time
+
+from application.models.bus_capture import BusCapture, BusCaptureReader, BusCaptureWriter
+from application.models.bus_log_analyzer import BusLogAnalyzer
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+
+
+class TestBusLogAnalyzer(lily_unit_test.TestSuite):
+
+    # Latency per slot in the capture (ns)
+    _LATENCY = 200000
+
+    @staticmethod
+    def _create_packet(dsn, ssn, pid, size):
+        packet = DataPacket()
+        packet.dsn = dsn
+        packet.ssn = ssn
+        packet.pid = pid
+        # Many special bytes, for byte stuffing
+        packet.payload = bytes(random.choice([DataPacket.STX, DataPacket.ETX, DataPacket.DLE, 0x41, 0x42])
+                               for _ in range(size))
+        return packet.get_data(True)
+
+    def _create_traffic(self, n_requests):
+        # Returns a list of (time, direction, data) and the expected number of unanswered requests per slot
+        random.seed(n_requests)
+        traffic = []
+        unanswered = {}
+        t = 0
+        for pid in range(1, n_requests + 1):
+            slot = random.randint(1, 9)
+            traffic.append((t, BusCapture.DIRECTION_TX, self._create_packet(slot, 0, pid, random.randint(1, 8))))
+            if random.random() < 0.05:
+                unanswered[slot] = unanswered.get(slot, 0) + 1
+            else:
+                response = self._create_packet(0, slot, pid, random.randint(1, DataPacket.MAX_DATA_SIZE))
+                if random.random() < 0.02:
+                    # CRC error
+                    response = response[:-2] + bytes([response[-2] ^ 0x01]) + response[-1:]
+                elif random.random() < 0.02:
+                    # Frame not complete (framing error)
+                    response = response[:len(response) // 2]
+                traffic.append((t + slot * self._LATENCY, BusCapture.DIRECTION_RX, response))
+            t += 10 * self._LATENCY
+        return traffic, unanswered
+
+    @staticmethod
+    def _get_expected(data):
+        decoder = FrameDecoder()
+        frames = decoder.feed(data)
+        n_ok = sum(1 for frame in frames if DataPacket().from_data(frame) == DataPacket.STATUS_OK)
+        return n_ok + decoder.crc_errors, decoder.crc_errors, decoder.framing_errors + len(frames) - n_ok
+
+    def test_raw_dump(self):
+        traffic, unanswered = self._create_traffic(2000)
+        data = b"\x00\x41" + b"".join(item[2] for item in traffic)
+        expected = self._get_expected(data)
+        for chunk_size in [BusLogAnalyzer.CHUNK_SIZE, 100]:
+            analyzer = BusLogAnalyzer()
+            analyzer.CHUNK_SIZE = chunk_size
+            analyzer.analyze_raw(data)
+            report = analyzer.get_report()
+            result = (report["frames"], report["crc_errors"], report["framing_errors"])
+            self.log.debug(f"Chunk size {chunk_size}: frames, CRC errors, framing errors: {result}")
+            self.fail_if(result != expected, f"Wrong result: {result}, expected: {expected}")
+            slots = report["ports"]["raw"]
+            for slot, statistics in slots.items():
+                self.fail_if(statistics["latency_us"] is not None, "Latency without timestamps")
+                self.fail_if(statistics["unanswered"] < unanswered.get(slot, 0),
+                             f"Wrong number of unanswered requests for slot {slot}")
+
+    def test_capture(self):
+        traffic, unanswered = self._create_traffic(2000)
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, "bus.cap")
+            capture = BusCaptureWriter(filename)
+            recorder = capture.get_recorder("COM1")
+            for t, direction, data in traffic:
+                if direction == BusCapture.DIRECTION_RX:
+                    # Received in two chunks
+                    recorder.record(direction, t, data[:5])
+                    recorder.record(direction, t, data[5:])
+                else:
+                    recorder.record(direction, t, data)
+            capture.close()
+            reports = []
+            for chunk_size in [BusLogAnalyzer.CHUNK_SIZE, 100]:
+                analyzer = BusLogAnalyzer()
+                analyzer.CHUNK_SIZE = chunk_size
+                with BusCaptureReader(filename) as reader:
+                    self.fail_if(reader.get_index() is None, "No index")
+                    analyzer.analyze_capture(reader)
+                reports.append(analyzer.get_report())
+            # Index not completely written (not a complete entry at the end) and no index, the rest is walked
+            index_filename = BusCapture.get_index_filename(filename)
+            with open(index_filename, "r+b") as index_file:
+                index_file.truncate(os.path.getsize(index_filename) // 2 + 3)
+            for remove_index in [False, True]:
+                if remove_index:
+                    os.remove(index_filename)
+                analyzer = BusLogAnalyzer()
+                analyzer.CHUNK_SIZE = 100
+                with BusCaptureReader(filename) as reader:
+                    analyzer.analyze_capture(reader)
+                reports.append(analyzer.get_report())
+        report = reports[0]
+        self.log.debug(BusLogAnalyzer.format_report(report))
+        self.fail_if(reports[1] != report, "Other result with small chunks")
+        self.fail_if(reports[2] != report, "Other result with a truncated index")
+        self.fail_if(reports[3] != report, "Other result without index")
+        expected = self._get_expected(b"".join(item[2] for item in traffic))
+        result = (report["frames"], report["crc_errors"], report["framing_errors"])
+        self.fail_if(result != expected, f"Wrong result: {result}, expected: {expected}")
+        self.fail_if(report["duration"] is None or report["bus_utilization"] is None, "No bus utilization")
+        for slot, statistics in report["ports"]["COM1"].items():
+            latency = statistics["latency_us"]
+            self.fail_if(latency["p50"] != slot * self._LATENCY / 1000 or latency["max"] != latency["p50"],
+                         f"Wrong latency for slot {slot}: {latency}")
+            self.fail_if(statistics["unanswered"] < unanswered.get(slot, 0),
+                         f"Wrong number of unanswered requests for slot {slot}")
+
+    def test_speed(self):
+        traffic, _unanswered = self._create_traffic(20000)
+        data = b"".join(item[2] for item in traffic)
+        t = time.perf_counter()
+        analyzer = BusLogAnalyzer()
+        analyzer.analyze_raw(data)
+        analyzer.get_report()
+        t_analyzer = time.perf_counter() - t
+        t = time.perf_counter()
+        for frame in FrameDecoder().feed(data):
+            DataPacket().from_data(frame)
+        t_decoder = time.perf_counter() - t
+        self.log.debug(f"Analyzer                 : {len(data) / t_analyzer / 1e6:.1f} MB/s")
+        self.log.debug(f"Frame decoder, data packet: {len(data) / t_decoder / 1e6:.1f} MB/s")
+        self.fail_if(t_analyzer > t_decoder, "Analyzer slower than the frame decoder")
+
+
+if __name__ == "__main__":
+
+    TestBusLogAnalyzer().run()
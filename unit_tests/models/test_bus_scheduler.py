@@ -0,0 +1,285 @@
+"""
+Test the bus scheduler.
+"""
+
+import lily_unit_test
+import queue
+import random
+import threading
+import time
+
+from application.models.bus_scheduler import BusScheduler
+from application.models.data_packet import DataPacket
+from application.models.metrics import PortMetrics
+from application.models.request_table import RequestTable
+from application.models.retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class _Driver:
+
+    # Driver that answers every request after a delay (from another thread), requests can be lost
+    # There are modules in slot 1, 2 and 3 (unless in the dead slots)
+
+    def __init__(self, request_table, response_delay, answer=True, loss=0.0, dead_slots=()):
+        self.tx_times = []
+        self.lost = []
+        self._loss = loss
+        self._dead_slots = dead_slots
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._request_table = request_table
+        self._response_delay = response_delay
+        self._answer = answer
+        self._lock = threading.Lock()
+
+    def _respond(self, packet):
+        time.sleep(self._response_delay)
+        responses = [packet.dsn] if packet.dsn != 0xFF else [1, 2, 3]
+        responses = [slot for slot in responses if slot not in self._dead_slots]
+        with self._lock:
+            self.in_flight -= 1
+        for slot in responses:
+            response = DataPacket()
+            response.dsn = 0
+            response.ssn = slot
+            response.pid = packet.pid
+            response.data = [1]
+            self._request_table.complete(self.get_port(), response)
+
+    @staticmethod
+    def get_port():
+        return "COM1"
+
+    def send_data(self, data, _tx_callback=None):
+        packet = DataPacket()
+        packet.from_data(data)
+        with self._lock:
+            self.tx_times.append((time.perf_counter(), packet.dsn, packet.pid))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            lost = random.random() < self._loss
+            if lost:
+                self.lost.append(packet.pid)
+                self.in_flight -= 1
+        if self._answer and not lost:
+            threading.Thread(target=self._respond, args=(packet, )).start()
+
+
+class TestBusScheduler(lily_unit_test.TestSuite):
+
+    _PID_RANGES = ((0x0001, 0xFBFF), (0xFC00, 0xFFFF))
+
+    def _run_requests(self, window, slots, response_delay, baud_rate=BusScheduler.BAUD_RATE):
+        table = RequestTable(1)
+        driver = _Driver(table, response_delay)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, window, baud_rate)
+        futures = [scheduler.submit(slot, [1]) for slot in slots]
+        responses = [future.result(5) for future in futures]
+        scheduler.close()
+        return driver, responses
+
+    def test_window(self):
+        slots = [1, 2, 3, 4, 5, 6, 7, 8, 9] * 3
+        driver, responses = self._run_requests(4, slots, 0.05)
+        self.log.debug(f"Maximum requests in flight: {driver.max_in_flight}")
+        self.fail_if(driver.max_in_flight != 4, f"Wrong number of requests in flight: {driver.max_in_flight}")
+        self.fail_if(list(map(lambda p: p.ssn, responses)) != slots, "Wrong responses")
+        pids = list(map(lambda x: x[2], driver.tx_times))
+        self.fail_if(pids != list(range(1, len(slots) + 1)), f"Wrong PIDs: {pids}")
+
+    def test_one_request_per_slot(self):
+        driver, responses = self._run_requests(4, [1] * 5, 0.02)
+        self.fail_if(driver.max_in_flight != 1, f"Multiple requests in flight for one slot: {driver.max_in_flight}")
+
+    def test_bus_time(self):
+        # At a low baud rate the bus time limits the number of requests
+        baud_rate = 9600
+        driver, responses = self._run_requests(9, list(range(1, 10)), 0.5, baud_rate)
+        scheduler_time = BusScheduler(_Driver(None, 0, False), RequestTable(1), self._PID_RANGES, 1, baud_rate)
+        scheduler_time.close()
+        min_time = scheduler_time._get_bus_time(len(responses[0].get_data(True)) - 1, 1)
+        for i in range(1, len(driver.tx_times)):
+            diff = driver.tx_times[i][0] - driver.tx_times[i - 1][0]
+            self.fail_if(diff < min_time * 0.9, f"Requests sent too fast: {1000 * diff:.1f} ms, "
+                                                f"expected: {1000 * min_time:.1f} ms")
+
+    def test_broadcast(self):
+        table = RequestTable(0.2)
+        driver = _Driver(table, 0.01)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4)
+        futures = [scheduler.submit(1, [1]), scheduler.submit(0xFF, [1], detection=True), scheduler.submit(2, [1])]
+        # Broadcast completes on the time out, expire requests until all are done
+        t = 2
+        while t > 0 and False in list(map(lambda f: f.done(), futures)):
+            table.expire()
+            time.sleep(0.05)
+            t -= 0.05
+        scheduler.close()
+        self.fail_if(driver.max_in_flight != 1, "Broadcast was sent while other requests were in flight")
+        slots = list(map(lambda p: p.ssn, futures[1].result()))
+        self.fail_if(slots != [1, 2, 3], f"Wrong broadcast responses: {slots}")
+        pid = driver.tx_times[1][2]
+        self.fail_if(pid != 0xFC00, f"Broadcast not in the detection PID range: {pid:04X}")
+
+    def test_cancel(self):
+        # A request that is cancelled while queued is not sent
+        table = RequestTable(1)
+        driver = _Driver(table, 0.1)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4)
+        futures = [scheduler.submit(1, [1]), scheduler.submit(1, [2]), scheduler.submit(1, [3])]
+        cancelled = futures[1].cancel()
+        responses = [futures[0].result(5), futures[2].result(5)]
+        scheduler.close()
+        self.fail_if(not cancelled or not futures[1].cancelled(), "Request not cancelled")
+        self.fail_if(len(driver.tx_times) != 2, f"Cancelled request sent: {len(driver.tx_times)} requests sent")
+        self.fail_if([p.data for p in responses] != [[1], [1]], "Wrong responses")
+        self.fail_if(futures[0].cancel(), "Request cancelled after sending")
+
+    def test_timeout(self):
+        table = RequestTable(0.1)
+        driver = _Driver(table, 0, False)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4)
+        rx_queue = queue.Queue()
+        scheduler.submit(1, [1], callback=rx_queue.put)
+        scheduler.submit(1, [2], callback=rx_queue.put)
+        results = []
+        t = 2
+        while t > 0 and len(results) < 2:
+            table.expire()
+            try:
+                results.append(rx_queue.get(True, 0.05))
+            except queue.Empty:
+                t -= 0.05
+        scheduler.close()
+        self.fail_if(len(results) != 2, "Not all requests timed out")
+        for future in results:
+            self.fail_if(not isinstance(future.exception(), TimeoutError), "No time out error")
+
+    def test_retry(self):
+        table = RequestTable(1)
+        driver = _Driver(table, 0.001, loss=0.5)
+        metrics = PortMetrics("COM1")
+        policy = RetryPolicy(retries=20, timeout=0.02, backoff=0.001)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4, retry_policy=policy, metrics=metrics)
+        futures = [scheduler.submit(1 + i % 9, [1]) for i in range(50)]
+        responses = [future.result(5) for future in futures]
+        scheduler.close()
+        self.log.debug(f"Lost requests: {len(driver.lost)}, retries: {metrics.retries}")
+        self.fail_if(metrics.retries != len(driver.lost), "Wrong number of retries")
+        # A retry has a new PID, the response must not be for a lost PID
+        pids = list(map(lambda p: p.pid, responses))
+        self.fail_if(len(set(pids) & set(driver.lost)) > 0, "Response for a lost request")
+        self.fail_if(len(set(pids)) != len(pids), "Duplicate PIDs")
+
+    def test_deadline(self):
+        table = RequestTable(1)
+        driver = _Driver(table, 0, False)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4,
+                                 retry_policy=RetryPolicy(retries=100, timeout=0.05, deadline=0.3))
+        t = time.perf_counter()
+        future = scheduler.submit(1, [1])
+        exception = future.exception(5)
+        t = time.perf_counter() - t
+        scheduler.close()
+        self.log.debug(f"Time out after {len(driver.tx_times)} attempts and {1000 * t:.0f} ms")
+        self.fail_if(not isinstance(exception, TimeoutError), "No time out error")
+        self.fail_if(t > 0.5, f"Deadline exceeded: {1000 * t:.0f} ms")
+
+    def test_tail_latency(self):
+        # With 1% loss the latency of the lost requests is bounded by the time out
+        table = RequestTable(1)
+        driver = _Driver(table, 0.001, loss=0.01)
+        policy = RetryPolicy(retries=3, timeout=0.05, backoff=0.005)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 9, retry_policy=policy)
+        latencies = []
+        t_start = {}
+        for i in range(500):
+            t_start[i] = time.perf_counter()
+            future = scheduler.submit(1 + i % 9, [1])
+            future.add_done_callback(lambda f, i=i: latencies.append(time.perf_counter() - t_start[i]))
+            if i % 9 == 8:
+                future.result(5)
+        time.sleep(0.3)
+        scheduler.close()
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99)]
+        self.log.debug(f"Lost: {len(driver.lost)}, maximum latency: {1000 * latencies[-1]:.0f} ms, "
+                       f"99%: {1000 * p99:.0f} ms")
+        self.fail_if(len(latencies) != 500, f"Not all requests are completed: {len(latencies)}")
+        self.fail_if(latencies[-1] > 0.5, f"Latency not bounded: {1000 * latencies[-1]:.0f} ms")
+
+    def test_circuit_breaker(self):
+        table = RequestTable(1)
+        driver = _Driver(table, 0, False)
+        breaker = CircuitBreaker(failure_threshold=3, reset_time=0.2)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4,
+                                 retry_policy=RetryPolicy(retries=2, timeout=0.02, backoff=0.001),
+                                 circuit_breaker=breaker)
+        # Only requests that failed after all attempts are counted, not each attempt
+        for _ in range(3):
+            self.fail_if(breaker.get_state(1) != CircuitBreaker.STATE_CLOSED, "Circuit breaker is not closed")
+            future = scheduler.submit(1, [1])
+            self.fail_if(not isinstance(future.exception(5), TimeoutError), "No time out error")
+        self.fail_if(breaker.get_state(1) != CircuitBreaker.STATE_OPEN, "Circuit breaker is not open")
+        n_sent = len(driver.tx_times)
+        self.fail_if(n_sent != 9, f"Wrong number of attempts: {n_sent}")
+        future = scheduler.submit(1, [1])
+        self.fail_if(not isinstance(future.exception(1), CircuitOpenError), "Request not rejected")
+        self.fail_if(len(driver.tx_times) != n_sent, "Request sent while the circuit breaker is open")
+        # After the reset time a trial request is sent
+        time.sleep(0.25)
+        driver._answer = True
+        future = scheduler.submit(1, [1])
+        self.fail_if(future.result(5).ssn != 1, "Wrong response")
+        self.fail_if(breaker.get_state(1) != CircuitBreaker.STATE_CLOSED, "Circuit breaker is not closed")
+        scheduler.close()
+
+    def test_dead_slot(self):
+        # Requests to a slot without a module do not block the other slots and the broadcast
+        table = RequestTable(1)
+        driver = _Driver(table, 0.001, dead_slots=(2, ))
+        breaker = CircuitBreaker()
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4,
+                                 retry_policy=RetryPolicy(retries=3, timeout=0.02, backoff=0.001),
+                                 circuit_breaker=breaker)
+        for _ in range(6):
+            future = scheduler.submit(2, [1])
+            self.fail_if(not isinstance(future.exception(5), (TimeoutError, CircuitOpenError)), "No error")
+        self.fail_if(breaker.get_state(2) != CircuitBreaker.STATE_OPEN, "Circuit breaker is not open for slot 2")
+        self.fail_if(scheduler.submit(1, [1]).result(5).ssn != 1, "No response of slot 1")
+        future = scheduler.submit(0xFF, [1], 0.05, detection=True)
+        t = 2
+        while t > 0 and not future.done():
+            table.expire()
+            time.sleep(0.01)
+            t -= 0.01
+        slots = list(map(lambda p: p.ssn, future.result()))
+        scheduler.close()
+        self.fail_if(slots != [1, 3], f"Wrong broadcast responses: {slots}")
+
+    def test_dead_rack(self):
+        # When the broadcast and all known slots fail, the requests for all slots are rejected at once
+        table = RequestTable(1)
+        driver = _Driver(table, 0.001)
+        breaker = CircuitBreaker(failure_threshold=2, reset_time=5, broadcast_key=0xFF)
+        scheduler = BusScheduler(driver, table, self._PID_RANGES, 4,
+                                 retry_policy=RetryPolicy(retries=0, timeout=0.02), circuit_breaker=breaker)
+        for slot in [1, 2]:
+            self.fail_if(scheduler.submit(slot, [1]).result(5).ssn != slot, f"No response of slot {slot}")
+        driver._answer = False
+        for _ in range(2):
+            self.fail_if(scheduler.submit(0xFF, [1], detection=True).result(5) != [], "Broadcast responses")
+        for slot in [1, 2]:
+            self.fail_if(not isinstance(scheduler.submit(slot, [1]).exception(5), TimeoutError), "No time out error")
+        self.fail_if(breaker.get_port_state() != CircuitBreaker.STATE_OPEN, "Circuit breaker is not open for the port")
+        n_sent = len(driver.tx_times)
+        for slot in [1, 3, 0xFF]:
+            future = scheduler.submit(slot, [1])
+            self.fail_if(not isinstance(future.exception(1), CircuitOpenError), f"Request for slot {slot} not rejected")
+        self.fail_if(len(driver.tx_times) != n_sent, "Request sent while the circuit breaker is open")
+        scheduler.close()
+
+
+if __name__ == "__main__":
+
+    TestBusScheduler().run()
@@ -0,0 +1,187 @@
+"""
+Test the connection pool: shared connections, routing of the responses by PID and reconnect.
+"""
+
+import lily_unit_test
+import socket
+import threading
+import time
+
+from application.models.connection_pool import ConnectionPool
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+
+
+class TestConnectionPool(lily_unit_test.TestSuite):
+
+    _HOST = "localhost"
+    _PORT = 17170
+    _TIMEOUT = 2
+
+    _server = None
+    _connections = []
+    _stop_event = None
+
+    def _respond(self, connection):
+        # Responds to each request: same PID, source and destination swapped
+        decoder = FrameDecoder()
+        packet = DataPacket()
+        while not self._stop_event.is_set():
+            try:
+                data = connection.recv(1500)
+            except OSError:
+                break
+            if len(data) == 0:
+                break
+            for frame in decoder.feed(data):
+                if packet.from_data(frame) == DataPacket.STATUS_OK:
+                    packet.dsn, packet.ssn = packet.ssn, packet.dsn
+                    connection.sendall(packet.get_data(True))
+
+    def _serve(self):
+        while not self._stop_event.is_set():
+            try:
+                connection = self._server.accept()[0]
+            except OSError:
+                break
+            self._connections.append(connection)
+            threading.Thread(target=self._respond, args=(connection, ), daemon=True).start()
+
+    def _start_server(self):
+        # A new server for each test case
+        self._stop_event = threading.Event()
+        self._connections = []
+        self._server = socket.create_server((self._HOST, self._PORT))
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _stop_server(self):
+        self._stop_event.set()
+        for connection in self._connections:
+            connection.close()
+        self._close_server()
+
+    def _close_server(self):
+        # Shutdown wakes up the accept
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+
+    @staticmethod
+    def _get_request(pid, data=1):
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.ssn = 0
+        packet.pid = pid
+        packet.data = [data]
+        return packet.get_data()
+
+    def _read_packets(self, client, n_packets):
+        packets = []
+        t = time.perf_counter()
+        while len(packets) < n_packets and time.perf_counter() - t < self._TIMEOUT:
+            data = client.read(1500, 0.1)
+            for frame in FrameDecoder().feed(data):
+                packet = DataPacket()
+                packet.from_data(frame)
+                packets.append(packet)
+        return packets
+
+    def _wait_for(self, condition):
+        t = time.perf_counter()
+        while not condition() and time.perf_counter() - t < self._TIMEOUT:
+            time.sleep(0.01)
+        return condition()
+
+    def test_shared_connection(self):
+        self._start_server()
+        clients = [ConnectionPool.open(self._HOST, self._PORT) for _ in range(3)]
+        try:
+            counters = ConnectionPool.get_counters()[f"{self._HOST}:{self._PORT}"]
+            self.log.debug(f"Counters: {counters}")
+            self.fail_if(counters["clients"] != 3 or counters["connects"] != 1, "Connection not shared")
+            self.fail_if(not self._wait_for(lambda: len(self._connections) == 1), "Not one connection to the server")
+            # Requests with PID with byte stuffing (0x0220) are routed too
+            for pid, client in zip([0x0220, 0x1001, 0x1002], clients):
+                client.write(self._get_request(pid))
+            for pid, client in zip([0x0220, 0x1001, 0x1002], clients):
+                packets = self._read_packets(client, 1)
+                self.fail_if([p.pid for p in packets] != [pid], f"Wrong responses for PID {pid}: {packets}")
+                self.fail_if(client.read(1500, 0.05) != b"", "Response of other client received")
+        finally:
+            for client in clients:
+                client.close()
+            self._stop_server()
+        self.fail_if(f"{self._HOST}:{self._PORT}" in ConnectionPool.get_counters(), "Connection not closed")
+
+    def test_same_pid(self):
+        # Two drivers use the same PIDs at the same time, every client gets its own responses
+        self._start_server()
+        clients = [ConnectionPool.open(self._HOST, self._PORT) for _ in range(2)]
+        try:
+            for pid in range(1, 21):
+                for data, client in enumerate(clients, 1):
+                    client.write(self._get_request(pid, data))
+            for data, client in enumerate(clients, 1):
+                packets = self._read_packets(client, 20)
+                self.fail_if([p.pid for p in packets] != list(range(1, 21)), f"Wrong PIDs for client {data}")
+                self.fail_if(any(p.data != [data] for p in packets), f"Response of other client for client {data}")
+            self.fail_if(clients[0]._connection.get_routes() != 0, "Routes not removed after the response")
+        finally:
+            for client in clients:
+                client.close()
+            self._stop_server()
+
+    def test_unknown_pid(self):
+        self._start_server()
+        clients = [ConnectionPool.open(self._HOST, self._PORT) for _ in range(2)]
+        try:
+            self.fail_if(not self._wait_for(lambda: len(self._connections) == 1), "Not one connection to the server")
+            # Data not requested by a client is received by all clients
+            self._connections[0].sendall(self._get_request(0x2000))
+            for client in clients:
+                self.fail_if([p.pid for p in self._read_packets(client, 1)] != [0x2000], "Data not received")
+        finally:
+            for client in clients:
+                client.close()
+            self._stop_server()
+
+    def test_reconnect(self):
+        self._start_server()
+        client = ConnectionPool.open(self._HOST, self._PORT)
+        try:
+            client.write(self._get_request(1))
+            self.fail_if([p.pid for p in self._read_packets(client, 1)] != [1], "No response before reconnect")
+            # The server drops the connection, the pool connects again
+            self._connections[0].shutdown(socket.SHUT_RDWR)
+            self.fail_if(not self._wait_for(lambda: client.get_counters()["connects"] == 2), "No reconnect")
+            counters = client.get_counters()
+            self.log.debug(f"Counters: {counters}")
+            self.fail_if(counters["disconnects"] != 1, "Disconnect not counted")
+            client.write(self._get_request(2))
+            self.fail_if([p.pid for p in self._read_packets(client, 1)] != [2], "No response after reconnect")
+        finally:
+            client.close()
+            self._stop_server()
+
+    def test_dropped_data(self):
+        self._start_server()
+        client = ConnectionPool.open(self._HOST, self._PORT)
+        try:
+            # No server: the written data is dropped
+            self.fail_if(not self._wait_for(lambda: len(self._connections) == 1), "Not one connection to the server")
+            self._close_server()
+            self._connections[0].shutdown(socket.SHUT_RDWR)
+            self.fail_if(not self._wait_for(lambda: not client.is_connected), "Disconnect not detected")
+            request = self._get_request(3)
+            client.write(request)
+            self.fail_if(client.get_counters()["tx_dropped_bytes"] != len(request), "Dropped data not counted")
+        finally:
+            client.close()
+            self._stop_server()
+
+
+if __name__ == "__main__":
+
+    TestConnectionPool().run()
@@ -4,7 +4,7 @@ Test CRC8 model.
 
 import lily_unit_test
 
-from application.models.crc8 import calculate_crc
+from application.models.crc8 import Crc8, calculate_crc, check_crcs
 
 
 class TestCrc8(lily_unit_test.TestSuite):
@@ -16,6 +16,28 @@ class TestCrc8(lily_unit_test.TestSuite):
             crc = calculate_crc(data[:i])
             self.fail_if(crc != crcs[i - 1], f"Wrong CRC: {crc}, expected: {crcs[i - 1]}")
 
+    def test_data_types(self):
+        data = [76, 105, 108, 121, 84, 114, 111, 110, 105, 99, 115]
+        for data_bytes in [bytes(data), bytearray(data), memoryview(bytes(data))]:
+            crc = calculate_crc(data_bytes)
+            self.fail_if(crc != 42, f"Wrong CRC for {type(data_bytes).__name__}: {crc}, expected: 42")
+
+    def test_incremental(self):
+        data = b"LilyTronics"
+        crc = Crc8()
+        for i in range(0, len(data), 3):
+            crc.update(data[i:i + 3])
+        self.fail_if(crc.digest() != 42, f"Wrong CRC: {crc.digest()}, expected: 42")
+        crc.reset()
+        for byte in data:
+            crc.update_byte(byte)
+        self.fail_if(crc.digest() != 42, f"Wrong CRC: {crc.digest()}, expected: 42")
+
+    def test_check_crcs(self):
+        frames = [b"LilyTronics" + bytes([42]), b"LilyTronics" + bytes([43]), b"Lily" + bytes([237]), b"\x01"]
+        results = check_crcs(frames)
+        self.fail_if(results != [True, False, True, False], f"Wrong results: {results}")
+
 
 if __name__ == "__main__":
 
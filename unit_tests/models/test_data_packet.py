@@ -119,6 +119,84 @@ class TestDataPacket(lily_unit_test.TestSuite):
         crc = calculate_crc(data[1:-2])
         self.fail_if(crc != data[-2], f"Invalid CR found: {data[2]}, expected: {crc}")
 
+    def test_response(self):
+        packet = DataPacket()
+        packet.dsn = 0
+        packet.ssn = 1
+        packet.pid = 1
+        packet.data = [1]
+        # A response to the PC (slot 0) is only valid when encoded as response
+        data = packet.get_data()
+        self.fail_if(len(data) > 0, f"Data generated when DSN = 0: {data}")
+        data = packet.get_data(True)
+        self.fail_if(data != b"\x02\x00\x01\x00\x01\x01\x20\xfb\x04", f"Invalid data generated for response: {data}")
+
+    def test_encode_into(self):
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.ssn = 3
+        packet.pid = 0x0204
+        packet.payload = b"\x02\x04\x20\x01"
+        buffer = bytearray(b"\xff")
+        n_bytes = packet.encode_into(buffer)
+        self.fail_if(n_bytes != len(buffer) - 1, f"Wrong number of bytes: {n_bytes}")
+        self.fail_if(buffer[1:] != packet.get_data(), "Encoded data is not the same as get_data()")
+        n_bytes = packet.encode_into(buffer)
+        self.fail_if(len(buffer) != 2 * n_bytes + 1, "Packet not appended to the buffer")
+        packet.pid = 0
+        self.fail_if(packet.encode_into(buffer) != 0, "Invalid packet encoded")
+
+    def test_decode(self):
+        tx_packet = DataPacket()
+        tx_packet.dsn = 1
+        tx_packet.ssn = 3
+        tx_packet.pid = 0x0204
+        for payload in [b"\x01\x05", b"\x02\x04\x20\x01"]:
+            tx_packet.payload = payload
+            for data in [tx_packet.get_data(), memoryview(tx_packet.get_data())]:
+                packet = DataPacket()
+                status = packet.from_data(data)
+                self.fail_if(status != DataPacket.STATUS_OK, f"Wrong status: {status}")
+                self.fail_if(packet.dsn != 1 or packet.ssn != 3 or packet.pid != 0x0204, "Wrong header decoded")
+                self.fail_if(bytes(packet.payload) != payload, f"Wrong payload: {bytes(packet.payload)}")
+                self.fail_if(packet.data != list(payload), f"Wrong data: {packet.data}")
+
+    def test_decode_copy(self):
+        tx_packet = DataPacket()
+        tx_packet.dsn = 1
+        tx_packet.ssn = 3
+        tx_packet.pid = 0x0204
+        tx_packet.payload = b"\x01\x05"
+        data = tx_packet.get_data()
+        # A list without byte stuffing can be encoded again
+        packet = DataPacket()
+        packet.from_data(list(data))
+        self.fail_if(not isinstance(packet.payload, bytes), f"Payload is not bytes: {packet.payload}")
+        self.fail_if(packet.get_data() != data, "Packet decoded from a list not encoded")
+        # The payload does not change when the buffer of the caller is reused
+        buffer = bytearray(data)
+        packet.from_data(memoryview(buffer))
+        buffer[5] = 0xFF
+        self.fail_if(packet.payload != b"\x01\x05", f"Payload changed with the buffer: {packet.payload}")
+
+    def test_decode_status(self):
+        tx_packet = DataPacket()
+        tx_packet.dsn = 1
+        tx_packet.ssn = 3
+        tx_packet.pid = 5
+        tx_packet.data = [1, 2, 3]
+        data = tx_packet.get_data()
+        packet = DataPacket()
+        for test_data, expected in [(data[:5], DataPacket.STATUS_INVALID_SIZE),
+                                    (data[1:] + b"\x04", DataPacket.STATUS_INVALID_FRAME),
+                                    (data[:-1] + b"\x00", DataPacket.STATUS_INVALID_FRAME),
+                                    (data[:-2] + b"\x20\x04", DataPacket.STATUS_INVALID_STUFFING),
+                                    (data[:-2] + bytes([data[-2] ^ 1]) + b"\x04", DataPacket.STATUS_CRC_ERROR),
+                                    (data, DataPacket.STATUS_OK)]:
+            status = packet.from_data(test_data)
+            self.fail_if(status != expected, f"Wrong status for {test_data}: {status}, expected: {expected}")
+            self.fail_if(packet.status != expected, f"Wrong status property: {packet.status}")
+
     def test_numeric_conversion(self):
         test_data = [212, 112, 34, 141, 131, 138, 202, 4]
         expected_values_unsigned = [212, 54384, 13922338, 3564118669, 912414379395,
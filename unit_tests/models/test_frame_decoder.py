@@ -0,0 +1,80 @@
+"""
+Test frame decoder model.
+"""
+
+import lily_unit_test
+
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+
+
+class TestFrameDecoder(lily_unit_test.TestSuite):
+
+    @staticmethod
+    def _create_frame(pid, data):
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.ssn = 2
+        packet.pid = pid
+        packet.data = data
+        return packet.get_data()
+
+    def test_single_frame(self):
+        frame = self._create_frame(1, [1])
+        decoder = FrameDecoder()
+        frames = decoder.feed(frame)
+        self.fail_if(frames != [frame], f"Wrong frames: {frames}")
+        self.fail_if(decoder.frames != 1, f"Wrong frame count: {decoder.frames}")
+
+    def test_multiple_frames(self):
+        tx_frames = [self._create_frame(i + 1, [i + 1, 2, 3]) for i in range(10)]
+        decoder = FrameDecoder()
+        frames = decoder.feed(b"\x01\x02\x03" + b"".join(tx_frames) + b"\x05")
+        self.fail_if(frames != tx_frames, "Not all frames decoded")
+
+    def test_split_frames(self):
+        # Frames with byte stuffing (PID 0x0202, data with DLE), split at every position
+        tx_frames = [self._create_frame(0x0202, [DataPacket.DLE, 4, 2]), self._create_frame(0x0420, [32])]
+        data = b"".join(tx_frames)
+        for split in range(1, len(data)):
+            decoder = FrameDecoder()
+            frames = decoder.feed(data[:split]) + decoder.feed(memoryview(data)[split:])
+            self.fail_if(frames != tx_frames, f"Frames not decoded when split at position {split}")
+        # Byte by byte
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(len(data)):
+            frames.extend(decoder.feed(data[i:i + 1]))
+        self.fail_if(frames != tx_frames, "Frames not decoded when received byte by byte")
+
+    def test_crc_error(self):
+        frame = bytearray(self._create_frame(1, [1, 2, 3]))
+        frame[-2] ^= 0x01
+        decoder = FrameDecoder()
+        frames = decoder.feed(bytes(frame))
+        self.fail_if(len(frames) > 0, "Frame with CRC error was not dropped")
+        self.fail_if(decoder.crc_errors != 1, f"Wrong CRC error count: {decoder.crc_errors}")
+
+    def test_framing_errors(self):
+        frame = self._create_frame(1, [1, 2, 3])
+        decoder = FrameDecoder()
+        # Lost ETX, the next frame must still be received
+        frames = decoder.feed(frame[:-1] + frame)
+        self.fail_if(frames != [frame], "Frame after a lost ETX not received")
+        # Too short
+        frames = decoder.feed(b"\x02\x01\x03\x04")
+        self.fail_if(len(frames) > 0, "Frame that is too short was not dropped")
+        # Too long, the data must not be buffered
+        frames = decoder.feed(b"\x02" + bytes(range(5, 100)))
+        self.fail_if(len(frames) > 0, "Frame that is too long was not dropped")
+        frames = decoder.feed(b"\x01\x04" + frame)
+        self.fail_if(frames != [frame], "Frame after a too long frame not received")
+        self.fail_if(decoder.framing_errors != 3, f"Wrong framing error count: {decoder.framing_errors}")
+        counters = decoder.get_counters()
+        self.log.debug(f"Counters: {counters}")
+        self.fail_if(counters["frames"] != 2, f"Wrong frame count: {counters['frames']}")
+
+
+if __name__ == "__main__":
+
+    TestFrameDecoder().run()
@@ -0,0 +1,146 @@
+"""
+Test the asyncio Lily bus.
+Same scenarios as for the RS485 driver and the generic commands.
+"""
+
+import asyncio
+import lily_unit_test
+import os
+import random
+
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+from application.models.lily_bus import LilyBus
+from application.models.simulator.lily_module_cm import LilyModuleCM
+from application.models.simulator.tcp_server import TCPServer
+
+
+class TestLilyBus(lily_unit_test.TestSuite):
+
+    _HOST = "localhost"
+    _PORT = 17140
+    _SERIAL = "1A2B3C"
+
+    _tcp_server = None
+    _module = None
+    _decoder = None
+
+    @staticmethod
+    def _loop_back(data):
+        packet = DataPacket()
+        packet.from_data(data)
+        packet.dsn = 0
+        packet.ssn = 2
+        packet.data = [2]
+        return packet.get_data(True)
+
+    def _tcp_callback(self, data):
+        # Multiple requests can be received at once
+        responses = []
+        for frame in self._decoder.feed(data):
+            packet = DataPacket()
+            packet.from_data(frame)
+            if packet.dsn == 2:
+                responses.append(self._loop_back(frame))
+            else:
+                response = self._module.process_packet(frame)
+                if response is not None:
+                    responses.append(response.get_data(True))
+        return responses
+
+    async def _loop_back_test(self, port_name):
+        bus = await LilyBus.open(port_name)
+        try:
+            packet = await bus.request(2, [1])
+        finally:
+            bus.close()
+        self.fail_if(packet.dsn != 0, f"Invalid DSN, received {packet.dsn}, expected 0")
+        self.fail_if(packet.ssn != 2, f"Invalid SSN, received {packet.ssn}, expected 2")
+        self.fail_if(packet.pid != 1, f"Invalid PID, received {packet.pid}, expected 1")
+        self.fail_if(packet.data != [2], f"Invalid data, received {packet.data}, expected [2]")
+
+    async def _random_packets_test(self):
+        async def _request(delay):
+            await asyncio.sleep(delay)
+            return await bus.request(2, [1])
+
+        bus = await LilyBus.open(f"socket://{self._HOST}:{self._PORT}")
+        try:
+            packets = await asyncio.gather(*[_request(random.uniform(0.0, 0.5)) for _ in range(50)])
+        finally:
+            bus.close()
+        pids = sorted(map(lambda p: p.pid, packets))
+        self.fail_if(pids != list(range(1, 51)), f"Not all packets have a response: {pids}")
+
+    async def _generic_commands_test(self):
+        bus = await LilyBus.open(f"socket://{self._HOST}:{self._PORT}")
+        try:
+            packet = await bus.request(1, [1])
+            self.fail_if(packet.convert_data_to_number(2) != 1148, "Wrong manufacturer code")
+            self.log.debug(f"Module ID: {packet.convert_data_to_number(2):04X}-"
+                           f"{packet.convert_data_to_number(2, 2):04X}")
+            packet = await bus.request(1, [2])
+            self.fail_if(not packet.convert_data_to_string().startswith("LS-"), "Invalid module name")
+            packet = await bus.request(1, [3])
+            self.fail_if(packet.convert_data_to_string() != self._SERIAL, "Invalid serial")
+            packet = await bus.request(1, [4])
+            self.fail_if(len(packet.data) != 3, f"Wrong data size: {len(packet.data)}")
+            # No response for an unknown command
+            try:
+                await bus.request(1, [0x31], 0.2)
+                self.fail("Response on an unknown command")
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            bus.close()
+
+    async def _serial_port_test(self):
+        # Use a pseudo terminal as serial port, the master side is looped back
+        master, slave = os.openpty()
+        os.set_blocking(master, False)
+        loop = asyncio.get_running_loop()
+        rx_data = bytearray()
+
+        def _on_master_data():
+            rx_data.extend(os.read(master, 1500))
+            end = rx_data.find(DataPacket.ETX)
+            if end > 0:
+                os.write(master, self._loop_back(bytes(rx_data[:end + 1])))
+                del rx_data[:end + 1]
+
+        loop.add_reader(master, _on_master_data)
+        try:
+            await self._loop_back_test(os.ttyname(slave))
+        finally:
+            loop.remove_reader(master)
+            os.close(slave)
+            os.close(master)
+
+    def setup(self):
+        self._module = LilyModuleCM(1, self._SERIAL)
+        self._decoder = FrameDecoder()
+        self._tcp_server = TCPServer(self._HOST, self._PORT, self._tcp_callback)
+
+    def teardown(self):
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+
+    def test_loop_back(self):
+        asyncio.run(self._loop_back_test(f"socket://{self._HOST}:{self._PORT}"))
+
+    def test_random_packets(self):
+        asyncio.run(self._random_packets_test())
+
+    def test_generic_commands(self):
+        asyncio.run(self._generic_commands_test())
+
+    def test_serial_port(self):
+        if os.name != "posix":
+            self.log.debug("Serial port transport is only supported on POSIX systems")
+        else:
+            asyncio.run(self._serial_port_test())
+
+
+if __name__ == "__main__":
+
+    TestLilyBus().run()
@@ -0,0 +1,114 @@
+"""
+Test the Lily simulator.
+"""
+
+import lily_unit_test
+import socket
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+from application.models.simulator.lily_module_cm import LilyModuleCM
+from application.models.simulator.lily_simulator import LilySimulator
+
+
+class TestLilySimulator(lily_unit_test.TestSuite):
+
+    _HOST = "localhost"
+    _PORT = 17160
+    _N_CLIENTS = 10
+    _N_REQUESTS = 20000
+    _MIN_REQUESTS_PER_SECOND = 5000
+
+    _simulator = None
+
+    @staticmethod
+    def _create_request(pid, dsn=1, command=1):
+        packet = DataPacket()
+        packet.dsn = dsn
+        packet.ssn = 0
+        packet.pid = pid
+        packet.data = [command]
+        return packet.get_data()
+
+    def _connect(self):
+        sock = socket.create_connection((self._HOST, self._PORT))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(2)
+        return sock
+
+    @staticmethod
+    def _receive(sock, n_responses):
+        decoder = FrameDecoder()
+        responses = []
+        while len(responses) < n_responses:
+            data = sock.recv(65536)
+            if len(data) == 0:
+                break
+            for frame in decoder.feed(data):
+                packet = DataPacket()
+                packet.from_data(frame)
+                responses.append(packet)
+        return responses
+
+    def setup(self):
+        self._simulator = LilySimulator(self._PORT, [
+            LilyModuleCM(1, "1A2B3C"),
+            LilyModuleCM(3, "4D5E6F")
+        ])
+
+    def teardown(self):
+        if self._simulator is not None:
+            self._simulator.close()
+
+    def test_persistent_clients(self):
+        clients = [self._connect() for _ in range(self._N_CLIENTS)]
+        try:
+            for pid in range(1, 11):
+                for sock in clients:
+                    sock.sendall(self._create_request(pid))
+                for sock in clients:
+                    responses = self._receive(sock, 1)
+                    self.fail_if(len(responses) != 1 or responses[0].pid != pid, f"No response for PID {pid}")
+        finally:
+            for sock in clients:
+                sock.close()
+
+    def test_multiple_frames(self):
+        # Many frames in one chunk, frames split over multiple chunks
+        data = b"".join(self._create_request(pid, 1, 1 + pid % 4) for pid in range(1, 101))
+        with self._connect() as sock:
+            sock.sendall(data[:-3])
+            time.sleep(0.1)
+            sock.sendall(data[-3:])
+            responses = self._receive(sock, 100)
+        pids = list(map(lambda p: p.pid, responses))
+        self.fail_if(pids != list(range(1, 101)), f"Wrong responses: {pids}")
+
+    def test_broadcast(self):
+        with self._connect() as sock:
+            sock.sendall(self._create_request(1, 0xFF))
+            responses = self._receive(sock, 2)
+            # A request for an empty slot has no response
+            sock.sendall(self._create_request(2, 2) + self._create_request(3, 3))
+            responses += self._receive(sock, 1)
+        slots = list(map(lambda p: p.ssn, responses))
+        self.fail_if(slots != [1, 3, 3], f"Wrong responses: {slots}")
+        self.fail_if(responses[2].pid != 3, "Response for an empty slot")
+
+    def test_throughput(self):
+        requests = b"".join(self._create_request(1 + i % 0xFBFF, 1 + 2 * (i % 2)) for i in range(self._N_REQUESTS))
+        with self._connect() as sock:
+            t = time.perf_counter()
+            sock.sendall(requests)
+            responses = self._receive(sock, self._N_REQUESTS)
+            t = time.perf_counter() - t
+        requests_per_second = self._N_REQUESTS / t
+        self.log.debug(f"Requests per second: {requests_per_second:.0f}")
+        self.fail_if(len(responses) != self._N_REQUESTS, f"Not all requests have a response: {len(responses)}")
+        self.fail_if(requests_per_second < self._MIN_REQUESTS_PER_SECOND, "Simulator is too slow")
+
+
+if __name__ == "__main__":
+
+    TestLilySimulator().run()
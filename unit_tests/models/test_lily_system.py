@@ -0,0 +1,217 @@
+"""
+Test the Lily System on virtual buses (loop://), with faster detection settings.
+"""
+
+import json
+import lily_unit_test
+import os
+import sys
+import tempfile
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.simulator.lily_module_cm import LilyModuleCM
+from application.models.simulator.virtual_bus import VirtualBus
+
+
+class TestLilySystem(lily_unit_test.TestSuite):
+
+    _APPLICATION_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "application"))
+    _TIMEOUT = 3
+    _BUS_NAME = "test_lily_system"
+    _PORT = f"loop://{_BUS_NAME}"
+    _SETTINGS = {
+        "_module_detect_interval": 0.2,
+        "_module_detect_max_interval": 0.8,
+        "_loop_interval": 0.01,
+        "_attempt_timeout": 0.05,
+        "_detection_timeout": 0.1
+    }
+
+    _rack_updates = []
+
+    def setup(self):
+        # The Lily System imports the models like the application (from the application folder)
+        if self._APPLICATION_FOLDER not in sys.path:
+            sys.path.append(self._APPLICATION_FOLDER)
+
+    def _wait_for(self, condition, timeout=_TIMEOUT):
+        t = time.perf_counter()
+        while not condition() and time.perf_counter() - t < timeout:
+            time.sleep(0.01)
+        return condition()
+
+    def _start(self, slots, cache_filename=None, serials=None, **settings):
+        # Starts a Lily System with a rack with modules in the given slots, settings overrule the test settings
+        # Serials: {slot: serial} for other serials than the default
+        from models.lily_system import LilySystem
+
+        serials = {} if serials is None else serials
+        VirtualBus.register(self._BUS_NAME, [LilyModuleCM(slot, serials.get(slot, f"0001{slot:02X}"))
+                                             for slot in slots])
+        self._rack_updates = []
+        lily_system = LilySystem(self._rack_updates.append, cache_filename)
+        for name, value in {**self._SETTINGS, **settings}.items():
+            setattr(lily_system, name, value)
+        lily_system._open_port(self._PORT)
+        lily_system.start()
+        return lily_system
+
+    def _stop(self, lily_system):
+        lily_system.stop()
+        VirtualBus.unregister(self._BUS_NAME)
+
+    @staticmethod
+    def _get_serials(racks):
+        # Returns {slot: serial} of the modules in the racks
+        return {module["slot"]: module["serial"] for rack in racks for module in rack["modules"]}
+
+    @staticmethod
+    def _get_modules(lily_system):
+        # Returns {slot: name} of the modules in the rack
+        for rack in lily_system.get_racks():
+            return {module["slot"]: module["name"] for module in rack["modules"]}
+        return {}
+
+    def _wait_for_modules(self, lily_system, slots):
+        # Waits until the modules in the given slots are detected and have a name
+        return self._wait_for(lambda: (sorted(self._get_modules(lily_system)) == slots and
+                                       "" not in self._get_modules(lily_system).values()))
+
+    def _wait_for_detection(self, lily_system):
+        # Starts a module detection directly and waits until it is done
+        with lily_system._lock:
+            lily_system._detection[self._PORT]["next"] = 0
+        return self._wait_for(lambda: lily_system._detection[self._PORT]["next"] > 0)
+
+    def _get_intervals(self, lily_system, duration):
+        # Returns the detection intervals during the given time (without repeated values)
+        intervals = []
+        t = time.perf_counter()
+        while time.perf_counter() - t < duration:
+            interval = lily_system._detection[self._PORT]["interval"]
+            if len(intervals) == 0 or intervals[-1] != interval:
+                intervals.append(interval)
+            time.sleep(0.005)
+        return intervals
+
+    def test_detection_backoff(self):
+        # Stable rack: the interval is doubled up to the maximum, a change resets the interval
+        lily_system = self._start([1, 2])
+        try:
+            intervals = self._get_intervals(lily_system, 2)
+            self.log.debug(f"Intervals: {intervals}")
+            self.fail_if(intervals != [0.2, 0.4, 0.8], f"Interval not doubled: {intervals}")
+            self.fail_if(not self._wait_for_modules(lily_system, [1, 2]), "Modules not detected")
+            VirtualBus.get(self._BUS_NAME).remove_module(2)
+            intervals = self._get_intervals(lily_system, 1.5)
+            self.log.debug(f"Intervals after removing a module: {intervals}")
+            self.fail_if(intervals[:2] != [0.8, 0.2], f"Interval not reset: {intervals}")
+            self.fail_if(sorted(self._get_modules(lily_system)) != [1], "Module not removed")
+        finally:
+            self._stop(lily_system)
+
+    def test_probe_removed_module(self):
+        # A request that times out starts a probe of the slot, the removed module is removed directly
+        lily_system = self._start([1, 2], _module_detect_interval=10, _module_detect_max_interval=10)
+        try:
+            self.fail_if(not self._wait_for_modules(lily_system, [1, 2]), "Modules not detected")
+            VirtualBus.get(self._BUS_NAME).remove_module(2)
+            t = time.perf_counter()
+            future = lily_system.send_request(self._PORT, 2, [1])
+            self.fail_if(not isinstance(future.exception(self._TIMEOUT), TimeoutError), "No time out")
+            self.fail_if(not self._wait_for(lambda: sorted(self._get_modules(lily_system)) == [1]),
+                         "Module not removed by the probe")
+            self.log.debug(f"Module removed after {1000 * (time.perf_counter() - t):.0f} ms")
+            self.fail_if(not self._wait_for_modules(lily_system, [1]), "Other module removed")
+        finally:
+            self._stop(lily_system)
+
+    def test_unknown_module(self):
+        # A packet from an unknown module starts the module detection directly (not after the interval)
+        lily_system = self._start([1], _module_detect_interval=10, _module_detect_max_interval=10)
+        try:
+            self.fail_if(not self._wait_for_modules(lily_system, [1]), "Module not detected")
+            module = LilyModuleCM(4, "000104")
+            VirtualBus.get(self._BUS_NAME).insert_module(module)
+            # Packet from the new module that is not a response to a request of the Lily System
+            request = DataPacket()
+            request.dsn = 4
+            request.ssn = 0
+            request.pid = 0x1234
+            request.data = [1]
+            response = module.process_request(request)
+            t = time.perf_counter()
+            lily_system._handle_rx_packet(self._PORT, response.get_data(True))
+            self.fail_if(not self._wait_for_modules(lily_system, [1, 4]), "New module not detected")
+            self.log.debug(f"Module detected after {1000 * (time.perf_counter() - t):.0f} ms")
+        finally:
+            self._stop(lily_system)
+
+    def test_dead_slot(self):
+        # Requests to an empty slot do not block the other slots and the module detection
+        lily_system = self._start([1])
+        try:
+            self.fail_if(not self._wait_for_modules(lily_system, [1]), "Module not detected")
+            for _ in range(6):
+                future = lily_system.send_request(self._PORT, 2, [1])
+                self.fail_if(future.exception(self._TIMEOUT) is None, "Response from an empty slot")
+            breaker = lily_system._schedulers[self._PORT]._circuit_breaker
+            self.fail_if(breaker.get_state(2) != breaker.STATE_OPEN, "Circuit breaker not open for the empty slot")
+            future = lily_system.send_request(self._PORT, 1, [1])
+            self.fail_if(future.exception(self._TIMEOUT) is not None, f"Request failed: {future.exception()}")
+            self.fail_if(not self._wait_for_detection(lily_system), "No module detection")
+            self.fail_if(not self._wait_for_modules(lily_system, [1]), "Module removed")
+        finally:
+            self._stop(lily_system)
+
+    def test_circuit_open_detection(self):
+        # When the circuit breaker is open, the module detection does not change the rack
+        lily_system = self._start([1, 3])
+        try:
+            self.fail_if(not self._wait_for_modules(lily_system, [1, 3]), "Modules not detected")
+            n_updates = len(self._rack_updates)
+            breaker = lily_system._schedulers[self._PORT]._circuit_breaker
+            for _ in range(5):
+                breaker.on_failure(0xFF)
+            self.fail_if(not self._wait_for_detection(lily_system), "No module detection")
+            self.fail_if(sorted(self._get_modules(lily_system)) != [1, 3], "Rack changed")
+            self.fail_if(len(self._rack_updates) != n_updates, "Rack update sent")
+        finally:
+            self._stop(lily_system)
+
+    def test_module_cache(self):
+        # The second start shows the cached modules directly, the module with another serial is requested again
+        with tempfile.TemporaryDirectory() as folder:
+            cache_filename = os.path.join(folder, "module_cache.json")
+            lily_system = self._start([1, 2], cache_filename)
+            try:
+                self.fail_if(not self._wait_for_modules(lily_system, [1, 2]), "Modules not detected")
+                # The module is cached when the complete identity is received (not only the name)
+                self.fail_if(not self._wait_for(lambda: all(lily_system._cache.get(self._PORT, slot) is not None
+                                                            for slot in [1, 2])), "Modules not cached")
+            finally:
+                self._stop(lily_system)
+            with open(cache_filename, "r") as fp:
+                self.fail_if(len(json.load(fp)) != 2, "Modules not in the cache")
+
+            lily_system = self._start([1, 2], cache_filename, {2: "ABCDEF"})
+            try:
+                self.fail_if(not self._wait_for(lambda: len(self._rack_updates) > 0), "No rack update")
+                serials = self._get_serials(self._rack_updates[0])
+                self.fail_if(serials != {1: "000101", 2: "000102"}, f"Cached modules not shown first: {serials}")
+                self.fail_if(not self._wait_for(lambda: self._get_serials(lily_system.get_racks()).get(2) == "ABCDEF"),
+                             "Identity of the other module not requested")
+                self.fail_if(not self._wait_for(lambda: (self._PORT, 1) in lily_system._validated),
+                             "Cached module not validated")
+                self.fail_if(not self._wait_for_modules(lily_system, [1, 2]), "Modules not detected")
+            finally:
+                self._stop(lily_system)
+            with open(cache_filename, "r") as fp:
+                serials = {entry["slot"]: entry["serial"] for entry in json.load(fp).values()}
+            self.fail_if(serials != {1: "000101", 2: "ABCDEF"}, f"Cache not updated: {serials}")
+
+
+if __name__ == "__main__":
+
+    TestLilySystem().run()
@@ -3,10 +3,13 @@ Test for listing serial ports
 """
 
 import lily_unit_test
+import os
+import queue
 import serial
+import sys
 import time
 
-from application.models.list_serial_ports import get_available_serial_ports
+from application.models.list_serial_ports import get_available_serial_ports, SerialPortScanner, SerialPortWatcher
 
 
 class TestListSerialPorts(lily_unit_test.TestSuite):
@@ -33,6 +36,77 @@ class TestListSerialPorts(lily_unit_test.TestSuite):
             self.fail_if(len(self._ports) == len(ports), "Port was still detected while being open")
             self.fail_if(self._ports[0] in ports, "The open port is still in the list of available ports")
 
+    def _create_pty(self):
+        # Returns the master file descriptor and the name of the port (slave)
+        master, slave = os.openpty()
+        port_name = os.ttyname(slave)
+        os.close(slave)
+        return master, port_name
+
+    def test_scanner_cache(self):
+        if not sys.platform.startswith("linux"):
+            self.log.debug("Test needs pty devices (Linux)")
+            return
+        master, port_name = self._create_pty()
+        ports = {port_name: "pty-1", "/dev/lily_does_not_exist": "none"}
+        scanner = SerialPortScanner(list_function=lambda: dict(ports))
+        try:
+            self.fail_if(scanner.scan() != [port_name], "Wrong available ports")
+        finally:
+            os.close(master)
+        # Same hardware, the port is not checked again
+        self.fail_if(scanner.scan() != [port_name], "Port was checked again")
+        ports[port_name] = "pty-2"
+        self.fail_if(scanner.scan() != [], "Changed port was not checked again")
+
+    def test_recheck_unavailable(self):
+        # A port that is busy at the first scan is checked again, with a back-off
+        checks = []
+        busy = {"/dev/lily_busy"}
+
+        def _check(port_name):
+            checks.append(port_name)
+            return port_name not in busy
+
+        scanner = SerialPortScanner(list_function=lambda: {"/dev/lily_busy": "busy"}, recheck_interval=0.05,
+                                    max_recheck_interval=0.1, check_function=_check)
+        self.fail_if(scanner.scan() != [], "Busy port is available")
+        self.fail_if(scanner.scan() != [] or len(checks) != 1, "Port checked again before the interval")
+        time.sleep(0.06)
+        self.fail_if(scanner.scan() != [] or len(checks) != 2, "Port not checked again after the interval")
+        # The interval is doubled
+        time.sleep(0.06)
+        self.fail_if(scanner.scan() != [] or len(checks) != 2, "Interval not doubled")
+        busy.clear()
+        time.sleep(0.06)
+        self.fail_if(scanner.scan() != ["/dev/lily_busy"], "Port not available when no longer busy")
+        # An available port is not checked again
+        self.fail_if(scanner.scan() != ["/dev/lily_busy"] or len(checks) != 3, "Available port checked again")
+
+    def test_watcher(self):
+        if not sys.platform.startswith("linux"):
+            self.log.debug("Test needs pty devices (Linux)")
+            return
+        ports = {}
+        events = queue.Queue()
+        watcher = SerialPortWatcher(lambda event, name: events.put((event, name)), 0.02,
+                                    SerialPortScanner(list_function=lambda: dict(ports)))
+        master, port_name = self._create_pty()
+        try:
+            ports[port_name] = "pty"
+            t = time.perf_counter()
+            event = events.get(True, 1)
+            self.log.debug(f"Event: {event} after {1000 * (time.perf_counter() - t):.1f} ms")
+            self.fail_if(event != (SerialPortWatcher.EVENT_ADD, port_name), f"Wrong event: {event}")
+            self.fail_if(watcher.get_ports() != [port_name], f"Wrong ports: {watcher.get_ports()}")
+            del ports[port_name]
+            event = events.get(True, 1)
+            self.fail_if(event != (SerialPortWatcher.EVENT_REMOVE, port_name), f"Wrong event: {event}")
+        finally:
+            watcher.close()
+            os.close(master)
+        self.fail_if(not events.empty(), "Unexpected events")
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,125 @@
+"""
+Test the metrics.
+"""
+
+import json
+import lily_unit_test
+import queue
+import random
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.metrics import LatencyHistogram, Metrics
+from application.models.request_table import RequestTable
+from application.models.rs485_driver import RS485Driver
+from application.models.simulator.virtual_bus import VirtualBus
+
+
+class TestMetrics(lily_unit_test.TestSuite):
+
+    _BUS_NAME = "test_metrics"
+
+    _rx_queue = queue.Queue()
+
+    def _rx_callback(self, data):
+        self._rx_queue.put(data)
+
+    def test_histogram(self):
+        histogram = LatencyHistogram()
+        values = [random.randint(1000, 10000000) for _ in range(10000)]
+        for value in values:
+            histogram.record(value)
+        values.sort()
+        snapshot = histogram.snapshot()
+        self.log.debug(f"Snapshot: {snapshot}")
+        self.fail_if(snapshot["count"] != len(values), f"Wrong count: {snapshot['count']}")
+        self.fail_if(snapshot["min"] != values[0] or snapshot["max"] != values[-1], "Wrong minimum or maximum")
+        for percentile in LatencyHistogram.PERCENTILES:
+            expected = values[min(int(len(values) * percentile / 100), len(values) - 1)]
+            error = abs(snapshot[f"p{percentile:g}"] - expected) / expected
+            self.fail_if(error > 0.07, f"Percentile {percentile} error too large: {100 * error:.1f}%")
+        # Small values are exact
+        histogram.reset()
+        for value in [0, 1, 5, 15]:
+            histogram.record(value)
+        self.fail_if(histogram.get_percentile(50) != 1, f"Wrong median: {histogram.get_percentile(50)}")
+
+    def test_request_table(self):
+        metrics = Metrics()
+        table = RequestTable(0.05, metrics)
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.pid = 1
+        packet.data = [1]
+        table.add("COM1", packet)
+        table.set_tx_time("COM1", 1, 1000)
+        response = DataPacket()
+        response.ssn = 1
+        response.pid = 1
+        table.complete("COM1", response, 501000)
+        packet.pid = 2
+        table.add("COM1", packet)
+        time.sleep(0.1)
+        table.expire()
+        snapshot = metrics.snapshot()["COM1"]
+        self.fail_if(snapshot["timeouts"] != 1, f"Wrong number of time outs: {snapshot['timeouts']}")
+        rtt = snapshot["rtt_ns"]
+        self.fail_if(rtt["count"] != 1 or rtt["max"] != 500000, f"Wrong RTT: {rtt}")
+
+    def test_driver(self):
+        port_name = VirtualBus.register(self._BUS_NAME, [])
+        metrics = Metrics()
+        driver = RS485Driver(port_name, self._rx_callback, True, metrics.get_port(port_name))
+        # Loop back the data
+        driver._serial._bus.process_data = lambda _decoder, data, buffer: buffer.extend(data + b"\x02\x00\x04")
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.pid = 1
+        packet.data = [1]
+        tx_times = []
+        try:
+            driver.send_data(packet.get_data(), tx_times.append)
+            self._rx_queue.get(True, 1)
+        finally:
+            driver.close()
+            VirtualBus.unregister(self._BUS_NAME)
+        snapshot = metrics.snapshot()[port_name]
+        self.log.debug(f"Snapshot: {snapshot}")
+        n_bytes = len(packet.get_data())
+        self.fail_if(len(tx_times) != 1 or driver.rx_time_ns < tx_times[0], "Wrong TX or RX time")
+        self.fail_if(snapshot["tx_frames"] != 1 or snapshot["tx_bytes"] != n_bytes, "Wrong TX counters")
+        self.fail_if(snapshot["rx_frames"] != 1 or snapshot["rx_bytes"] != n_bytes + 3, "Wrong RX counters")
+        self.fail_if(snapshot["framing_errors"] != 1, f"Wrong number of framing errors: {snapshot['framing_errors']}")
+        self.fail_if(snapshot["tx_queue_depth"] != 0, "Wrong TX queue depth")
+
+    def test_exporters(self):
+        metrics = Metrics()
+        port = metrics.get_port("COM1")
+        port.tx_frames = 10
+        port.add_source(lambda: {"tx_queue_depth": 3})
+        for value in [1000000, 2000000, 3000000]:
+            port.rtt.record(value)
+        snapshot = json.loads(metrics.to_json())
+        self.fail_if(snapshot["COM1"]["tx_frames"] != 10, "Wrong JSON output")
+        text = metrics.to_prometheus()
+        self.log.debug(f"Prometheus output:\n{text}")
+        for line in ['lily_tx_frames_total{port="COM1"} 10',
+                     "# TYPE lily_tx_queue_depth gauge",
+                     'lily_tx_queue_depth{port="COM1"} 3',
+                     'lily_request_rtt_seconds_count{port="COM1"} 3',
+                     'lily_request_rtt_seconds_sum{port="COM1"} 0.006000000']:
+            self.fail_if(line not in text.splitlines(), f"Line not in the output: {line}")
+
+    def test_recording_time(self):
+        histogram = LatencyHistogram()
+        n_values = 100000
+        t = time.perf_counter()
+        for value in range(n_values):
+            histogram.record(value)
+        t = time.perf_counter() - t
+        self.log.debug(f"Recording time: {1000000000 * t / n_values:.0f} ns")
+
+
+if __name__ == "__main__":
+
+    TestMetrics().run()
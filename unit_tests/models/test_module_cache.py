@@ -0,0 +1,60 @@
+"""
+Test the module cache.
+"""
+
+import json
+import lily_unit_test
+import os
+import tempfile
+
+from application.models.module_cache import ModuleCache
+
+
+class TestModuleCache(lily_unit_test.TestSuite):
+
+    _MODULE = {"id": "047C-0002", "slot": 3, "name": "Lily System signal generator", "serial": "SG-000123",
+               "version": "1.0.0"}
+
+    def setup(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._filename = os.path.join(self._folder.name, "cache", "module_cache.json")
+
+    def teardown(self):
+        self._folder.cleanup()
+
+    def test_save_load(self):
+        cache = ModuleCache(self._filename)
+        self.fail_if(cache.get_racks() != [], "Cache is not empty")
+        cache.set("COM1", 3, self._MODULE)
+        # Modules without serial are not stored
+        cache.set("COM1", 4, {"id": "047C-0001", "slot": 4, "name": "", "serial": "", "version": ""})
+        self.fail_if(not cache.save(), "Cache not saved")
+        self.fail_if(cache.save(), "Cache saved without changes")
+        racks = ModuleCache(self._filename).get_racks()
+        self.log.debug(f"Racks: {racks}")
+        self.fail_if(racks != [{"port": "COM1", "modules": [self._MODULE]}], "Wrong racks from the cache")
+        self.fail_if(os.path.exists(f"{self._filename}.tmp"), "Temporary file not removed")
+
+    def test_validate(self):
+        cache = ModuleCache(self._filename)
+        cache.set("COM1", 3, self._MODULE)
+        self.fail_if(not cache.validate("COM1", 3, "SG-000123"), "Module not valid")
+        self.fail_if(cache.validate("COM1", 2, "SG-000123"), "Unknown module is valid")
+        # Other serial evicts the entry
+        self.fail_if(cache.validate("COM1", 3, "SG-000124"), "Module with other serial is valid")
+        self.fail_if(cache.get("COM1", 3) is not None, "Entry not evicted")
+        cache.set("COM1", 3, self._MODULE)
+        cache.remove("COM1", 3)
+        self.fail_if(cache.get("COM1", 3) is not None, "Entry not removed")
+
+    def test_corrupt_file(self):
+        os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+        for content in ["{not json", json.dumps([1, 2]), json.dumps({"COM1/3": "module"})]:
+            with open(self._filename, "w") as fp:
+                fp.write(content)
+            self.fail_if(ModuleCache(self._filename).get_racks() != [], f"Wrong racks for content: {content}")
+
+
+if __name__ == "__main__":
+
+    TestModuleCache().run()
@@ -0,0 +1,61 @@
+"""
+Test the payload schemas.
+"""
+
+import lily_unit_test
+import struct
+
+from application.models.data_packet import DataPacket
+from application.models.payload_schema import GENERIC_RESPONSES, PayloadSchema
+
+
+class TestPayloadSchema(lily_unit_test.TestSuite):
+
+    _DEFINITION = "u16 mfg, u16 module, i32 value, str[16] name"
+
+    def test_decode(self):
+        schema = PayloadSchema.compile(self._DEFINITION, "Measurement")
+        self.fail_if(PayloadSchema.compile(self._DEFINITION, "Measurement") is not schema, "Schema compiled again")
+        self.fail_if(schema.size != 24, f"Wrong size: {schema.size}")
+        payload = struct.pack(">HHi16s", 0x047C, 2, -123456, b"Generator\x1f")
+        for data in [payload, bytearray(payload), memoryview(b"\x00\x00" + payload)[2:]]:
+            record = schema.decode(data)
+            self.log.debug(f"Record: {record}")
+            self.fail_if(record != (0x047C, 2, -123456, "Generator."), f"Wrong record: {record}")
+            self.fail_if(record.value != -123456 or record.name != "Generator.", "Wrong fields")
+        try:
+            schema.decode(payload[:-1])
+            self.fail("No error when the payload is too small")
+        except ValueError as e:
+            self.log.debug(f"Error: {e}")
+
+    def test_encode(self):
+        schema = PayloadSchema.compile("u8 command, f32 level, bytes[2] flags, str text")
+        payload = schema.encode(5, level=1.5, flags=b"\x01\x02", text="LilyTronics")
+        self.fail_if(payload != b"\x05\x3f\xc0\x00\x00\x01\x02LilyTronics", f"Wrong payload: {payload}")
+        self.fail_if(tuple(schema.decode(payload)) != (5, 1.5, b"\x01\x02", "LilyTronics"), "Wrong round trip")
+        buffer = bytearray(20)
+        n_bytes = schema.encode_into(memoryview(buffer), 2, 5, 1.5, b"\x01\x02", "Lily")
+        self.fail_if(n_bytes != 11 or buffer[2:13] != payload[:11], f"Wrong buffer: {buffer}")
+
+    def test_invalid_schema(self):
+        for definition in ["u12 value", "u16", "str name, u8 value", "u8[2] values", "u8 value,"]:
+            try:
+                PayloadSchema(definition)
+                self.fail(f"No error for schema: '{definition}'")
+            except ValueError as e:
+                self.log.debug(f"Error: {e}")
+
+    def test_generic_responses(self):
+        packet = DataPacket()
+        packet.data = [0x04, 0x7C, 0x00, 0x01]
+        module_id = packet.decode_payload(GENERIC_RESPONSES[1])
+        self.fail_if((module_id.mfg, module_id.module) != (1148, 1), f"Wrong module ID: {module_id}")
+        packet.data = [ord(c) for c in "LS-CM Communication Module"]
+        name = packet.decode_payload(GENERIC_RESPONSES[2]).name
+        self.fail_if(name != packet.convert_data_to_string(), f"Wrong name: {name}")
+
+
+if __name__ == "__main__":
+
+    TestPayloadSchema().run()
@@ -0,0 +1,97 @@
+"""
+Test the request table.
+"""
+
+import lily_unit_test
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.request_table import RequestTable
+
+
+class TestRequestTable(lily_unit_test.TestSuite):
+
+    _PORT = "COM1"
+
+    @staticmethod
+    def _create_packet(pid, dsn=1, ssn=0):
+        packet = DataPacket()
+        packet.dsn = dsn
+        packet.ssn = ssn
+        packet.pid = pid
+        packet.data = [1]
+        return packet
+
+    def test_response(self):
+        table = RequestTable(1)
+        futures = [table.add(self._PORT, self._create_packet(pid)) for pid in range(1, 101)]
+        self.fail_if(len(table) != 100, f"Wrong number of requests in flight: {len(table)}")
+        # Response from another port must not match
+        self.fail_if(table.complete("COM2", self._create_packet(50, 0, 1)), "Response from other port matched")
+        for pid in range(100, 0, -1):
+            self.fail_if(not table.complete(self._PORT, self._create_packet(pid, 0, 1)),
+                         f"Response for PID {pid} not matched")
+        for pid, future in enumerate(futures, 1):
+            self.fail_if(not future.done(), f"Request with PID {pid} not completed")
+            self.fail_if(future.result().pid != pid, f"Wrong response for PID {pid}")
+        counters = table.get_counters()
+        self.log.debug(f"Counters: {counters}")
+        self.fail_if(counters["in_flight"] != 0, "Requests still in flight")
+        self.fail_if(counters["unknown"] != 1, f"Wrong number of unknown responses: {counters['unknown']}")
+
+    def test_callback(self):
+        results = []
+        table = RequestTable(1)
+        table.add(self._PORT, self._create_packet(1), callback=lambda f: results.append(f.result().pid))
+        table.complete(self._PORT, self._create_packet(1, 0, 1))
+        self.fail_if(results != [1], f"Callback not called: {results}")
+
+    def test_timeout(self):
+        table = RequestTable(0.1)
+        future_1 = table.add(self._PORT, self._create_packet(1))
+        future_2 = table.add(self._PORT, self._create_packet(2), 10)
+        self.fail_if(len(table.expire()) != 0, "Request expired too soon")
+        time.sleep(0.2)
+        expired = table.expire()
+        self.fail_if(len(expired) != 1, f"Wrong number of expired requests: {len(expired)}")
+        self.fail_if(not isinstance(future_1.exception(), TimeoutError), "No time out error")
+        self.fail_if(future_2.done(), "Request with longer time out expired")
+        # Late and duplicate responses
+        table.complete(self._PORT, self._create_packet(1, 0, 1))
+        table.complete(self._PORT, self._create_packet(2, 0, 1))
+        table.complete(self._PORT, self._create_packet(2, 0, 1))
+        counters = table.get_counters()
+        self.log.debug(f"Counters: {counters}")
+        self.fail_if(counters["timeouts"] != 1, f"Wrong number of time outs: {counters['timeouts']}")
+        self.fail_if(counters["late"] != 1, f"Wrong number of late responses: {counters['late']}")
+        self.fail_if(counters["duplicates"] != 1, f"Wrong number of duplicate responses: {counters['duplicates']}")
+
+    def test_broadcast(self):
+        table = RequestTable(0.1)
+        future = table.add(self._PORT, self._create_packet(0xFC00, 0xFF))
+        for slot in range(1, 4):
+            table.complete(self._PORT, self._create_packet(0xFC00, 0, slot))
+        self.fail_if(future.done(), "Broadcast request completed before the time out")
+        time.sleep(0.2)
+        table.expire()
+        slots = list(map(lambda p: p.ssn, future.result()))
+        self.fail_if(slots != [1, 2, 3], f"Wrong responses: {slots}")
+
+    def test_memory(self):
+        # Finished requests must be removed after some time
+        table = RequestTable(0.05)
+        for pid in range(1, 1001):
+            table.add(self._PORT, self._create_packet(pid))
+            if pid % 2 == 0:
+                table.complete(self._PORT, self._create_packet(pid, 0, 1))
+        time.sleep(0.2)
+        table.expire()
+        self.fail_if(len(table) != 0, f"Requests still in flight: {len(table)}")
+        time.sleep(0.1)
+        table.expire()
+        self.fail_if(len(table._retired) != 0 or len(table._deadlines) != 0, "Finished requests are not removed")
+
+
+if __name__ == "__main__":
+
+    TestRequestTable().run()
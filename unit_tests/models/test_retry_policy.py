@@ -0,0 +1,93 @@
+"""
+Test the retry policy and the circuit breaker.
+"""
+
+import lily_unit_test
+import time
+
+from application.models.retry_policy import CircuitBreaker, RetryPolicy
+
+
+class TestRetryPolicy(lily_unit_test.TestSuite):
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=0.01, backoff_factor=2, max_backoff=0.05, jitter=0.5)
+        for attempt, expected in [(1, 0.01), (2, 0.02), (3, 0.04), (4, 0.05), (10, 0.05)]:
+            backoffs = [policy.get_backoff(attempt) for _ in range(100)]
+            self.log.debug(f"Attempt {attempt}: {min(backoffs):.4f} - {max(backoffs):.4f}")
+            self.fail_if(max(backoffs) > expected or min(backoffs) < expected / 2,
+                         f"Backoff for attempt {attempt} out of range")
+            self.fail_if(len(set(backoffs)) < 50, "No jitter")
+        policy.jitter = 0
+        self.fail_if(policy.get_backoff(2) != 0.02, "Wrong backoff without jitter")
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_time=0.1)
+        for _ in range(2):
+            self.fail_if(not breaker.allow_request(), "Request not allowed")
+            breaker.on_failure()
+        breaker.on_success()
+        # Success resets the failures
+        for _ in range(2):
+            breaker.on_failure()
+        self.fail_if(breaker.get_state() != CircuitBreaker.STATE_CLOSED, "Circuit breaker is not closed")
+        breaker.on_failure()
+        self.fail_if(breaker.get_state() != CircuitBreaker.STATE_OPEN, "Circuit breaker is not open")
+        self.fail_if(breaker.allow_request(), "Request allowed while open")
+        time.sleep(0.15)
+        self.fail_if(breaker.get_state() != CircuitBreaker.STATE_HALF_OPEN, "Circuit breaker is not half open")
+        self.fail_if(not breaker.allow_request(), "Trial request not allowed")
+        self.fail_if(breaker.allow_request(), "Second trial request allowed")
+        # Failing trial opens the breaker again
+        breaker.on_failure()
+        self.fail_if(breaker.get_state() != CircuitBreaker.STATE_OPEN, "Circuit breaker is not open")
+        time.sleep(0.15)
+        self.fail_if(not breaker.allow_request(), "Trial request not allowed")
+        breaker.on_success()
+        self.fail_if(breaker.get_state() != CircuitBreaker.STATE_CLOSED, "Circuit breaker is not closed")
+
+    def test_circuit_breaker_keys(self):
+        # The failures of one key do not open the breaker for the other keys
+        breaker = CircuitBreaker(failure_threshold=2, reset_time=0.1)
+        for _ in range(2):
+            breaker.on_failure(2)
+        self.fail_if(breaker.get_state(2) != CircuitBreaker.STATE_OPEN, "Circuit breaker is not open for key 2")
+        self.fail_if(breaker.allow_request(2), "Request allowed for key 2")
+        self.fail_if(breaker.get_state(1) != CircuitBreaker.STATE_CLOSED, "Circuit breaker is not closed for key 1")
+        self.fail_if(not breaker.allow_request(1), "Request not allowed for key 1")
+        breaker.on_success(1)
+        self.fail_if(breaker.get_state(2) != CircuitBreaker.STATE_OPEN, "Success of key 1 closed key 2")
+
+    def test_circuit_breaker_port(self):
+        # When the broadcast is open and all known keys fail, the requests for all keys are rejected
+        breaker = CircuitBreaker(failure_threshold=2, reset_time=0.1, broadcast_key=0xFF)
+        for key in [1, 2]:
+            breaker.on_success(key)
+        for _ in range(2):
+            breaker.on_failure(0xFF)
+        self.fail_if(breaker.get_port_state() != CircuitBreaker.STATE_CLOSED, "Port open while keys are responding")
+        breaker.on_failure(1)
+        self.fail_if(breaker.get_port_state() != CircuitBreaker.STATE_CLOSED, "Port open while key 2 is responding")
+        breaker.on_failure(2)
+        self.fail_if(breaker.get_port_state() != CircuitBreaker.STATE_OPEN, "Port is not open")
+        self.fail_if(breaker.get_state(2) != CircuitBreaker.STATE_CLOSED, "Key 2 is open after one failure")
+        for key in [1, 2, 3, 0xFF]:
+            self.fail_if(breaker.allow_request(key), f"Request allowed for key {key} while the port is open")
+        time.sleep(0.15)
+        self.fail_if(breaker.get_port_state() != CircuitBreaker.STATE_HALF_OPEN, "Port is not half open")
+        self.fail_if(not breaker.allow_request(0xFF), "Trial request not allowed")
+        self.fail_if(breaker.allow_request(1), "Second trial request allowed")
+        # Failing trial opens the port again
+        breaker.on_failure(0xFF)
+        self.fail_if(breaker.get_port_state() != CircuitBreaker.STATE_OPEN, "Port is not open")
+        time.sleep(0.15)
+        self.fail_if(not breaker.allow_request(2), "Trial request not allowed")
+        breaker.on_success(2)
+        self.fail_if(breaker.get_port_state() != CircuitBreaker.STATE_CLOSED, "Port is not closed")
+        self.fail_if(not breaker.allow_request(2), "Request not allowed for key 2")
+        self.fail_if(breaker.get_state(0xFF) != CircuitBreaker.STATE_HALF_OPEN, "State of the broadcast not kept")
+
+
+if __name__ == "__main__":
+
+    TestRetryPolicy().run()
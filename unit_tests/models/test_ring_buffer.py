@@ -0,0 +1,39 @@
+"""
+Test the ring buffer: writing, reading and wrapping around the end of the buffer.
+"""
+
+import lily_unit_test
+
+from application.models.ring_buffer import RingBuffer
+
+
+class TestRingBuffer(lily_unit_test.TestSuite):
+
+    def test_wrap_around(self):
+        ring = RingBuffer(10)
+        self.fail_if(ring.write(b"0123456") != 7, "Not all data written")
+        self.fail_if(ring.read(5) != b"01234", "Wrong data read")
+        # The data wraps around the end of the buffer, the rest does not fit
+        self.fail_if(ring.write(b"abcdefghij") != 8, "Wrong number of bytes written when full")
+        self.fail_if(len(ring) != 10 or len(ring.get_free_space()) != 0, "Buffer not full")
+        buffer = bytearray(4)
+        self.fail_if(ring.readinto(buffer) != 4 or buffer != b"56ab", f"Wrong data read into: {buffer}")
+        self.fail_if(ring.read(100) != b"cdefgh", "Wrong data read after wrap around")
+        self.fail_if(len(ring) != 0 or ring.read(1) != b"", "Buffer not empty")
+
+    def test_commit(self):
+        # Data written in the free space directly (like recv_into)
+        ring = RingBuffer(8)
+        ring.write(b"123456")
+        ring.read(6)
+        space = ring.get_free_space()
+        self.fail_if(len(space) != 2, f"Wrong free space: {len(space)}")
+        space[:] = b"ab"
+        ring.commit(2)
+        self.fail_if(len(ring.get_free_space()) != 6, "Free space does not wrap around")
+        self.fail_if(ring.read(2) != b"ab", "Wrong committed data")
+
+
+if __name__ == "__main__":
+
+    TestRingBuffer().run()
@@ -16,6 +16,7 @@ class TestRS485Driver(lily_unit_test.TestSuite):
 
     _HOST = "localhost"
     _PORT = 17120
+    _EVENT_DRIVEN = False
 
     _tcp_server = None
     _rs485_driver = None
@@ -38,7 +39,8 @@ class TestRS485Driver(lily_unit_test.TestSuite):
 
     def setup(self):
         self._tcp_server = TCPServer(self._HOST, self._PORT, self._tcp_callback)
-        self._rs485_driver = RS485Driver(f"socket://{self._HOST}:{self._PORT}", self._rs485_callback)
+        self._rs485_driver = RS485Driver(f"socket://{self._HOST}:{self._PORT}", self._rs485_callback,
+                                         self._EVENT_DRIVEN)
 
     def teardown(self):
         if self._rs485_driver is not None:
@@ -92,6 +94,19 @@ class TestRS485Driver(lily_unit_test.TestSuite):
             self.fail_if(len(matches) == 0, f"Packet with PID: {tx_packet.pid} has no response")
 
 
+class TestRS485DriverEventDriven(TestRS485Driver):
+
+    _EVENT_DRIVEN = True
+
+    # Test methods must be defined in the class itself
+
+    def test_loop_back(self):
+        super().test_loop_back()
+
+    def test_random_packets(self):
+        super().test_random_packets()
+
+
 if __name__ == "__main__":
 
     TestRS485Driver().run()
@@ -0,0 +1,173 @@
+"""
+Test the RX dispatcher: executors, overflow policies and the RS485 driver with an RX queue.
+"""
+
+import asyncio
+import concurrent.futures
+import lily_unit_test
+import threading
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.rs485_driver import RS485Driver
+from application.models.rx_dispatcher import RxDispatcher
+from application.models.simulator.virtual_bus import VirtualBus
+
+
+class TestRxDispatcher(lily_unit_test.TestSuite):
+
+    _N_FRAMES = 1000
+    _TIMEOUT = 2
+
+    def _wait_for(self, condition):
+        t = time.perf_counter()
+        while not condition() and time.perf_counter() - t < self._TIMEOUT:
+            time.sleep(0.001)
+        return condition()
+
+    def _check_delivery(self, executor):
+        # All frames are delivered in order, returns the threads that called the handler
+        received = []
+        threads = set()
+
+        def _handler(frame, rx_time_ns):
+            received.append((frame, rx_time_ns))
+            threads.add(threading.current_thread())
+
+        dispatcher = RxDispatcher(_handler, 100, RxDispatcher.POLICY_BLOCK, executor)
+        for i in range(self._N_FRAMES):
+            dispatcher.put(i, 1000 + i)
+        self.fail_if(not self._wait_for(lambda: len(received) == self._N_FRAMES), "Not all frames delivered")
+        dispatcher.close()
+        self.fail_if(received != [(i, 1000 + i) for i in range(self._N_FRAMES)], "Frames not delivered in order")
+        counters = dispatcher.get_counters()
+        self.log.debug(f"Counters: {counters}")
+        self.fail_if(counters["delivered"] != self._N_FRAMES or counters["dropped"] != 0, "Wrong counters")
+        self.fail_if(counters["max_queue_depth"] > 100, "Queue larger than the maximum size")
+        return threads
+
+    def test_dedicated_thread(self):
+        threads = self._check_delivery(None)
+        self.fail_if(len(threads) != 1 or threading.current_thread() in threads, "Not a dedicated thread")
+
+    def test_thread_pool(self):
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            self._check_delivery(executor)
+
+    def test_asyncio_loop(self):
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            threads = self._check_delivery(loop)
+            self.fail_if(threads != {thread}, "Handler not called in the event loop")
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+    def _fill_queue(self, policy):
+        # The handler is blocked on the first frame, then 9 more frames are put in a queue of 4
+        # Returns the delivered frames and the counters
+        delivered = []
+        first_frame = threading.Event()
+        release = threading.Event()
+
+        def _handler(frame):
+            first_frame.set()
+            release.wait()
+            delivered.append(frame)
+
+        dispatcher = RxDispatcher(_handler, 4, policy)
+        dispatcher.put(1)
+        first_frame.wait(1)
+        for i in range(2, 11):
+            dispatcher.put(i)
+        release.set()
+        self._wait_for(lambda: dispatcher.get_queue_depth() == 0)
+        dispatcher.close()
+        return delivered, dispatcher.get_counters()
+
+    def test_drop_oldest(self):
+        delivered, counters = self._fill_queue(RxDispatcher.POLICY_DROP_OLDEST)
+        self.log.debug(f"Delivered: {delivered}, counters: {counters}")
+        self.fail_if(delivered != [1, 7, 8, 9, 10] or counters["dropped"] != 5, "Oldest frames not dropped")
+
+    def test_drop_newest(self):
+        delivered, counters = self._fill_queue(RxDispatcher.POLICY_DROP_NEWEST)
+        self.log.debug(f"Delivered: {delivered}, counters: {counters}")
+        self.fail_if(delivered != [1, 2, 3, 4, 5] or counters["dropped"] != 5, "Newest frames not dropped")
+
+    def test_block(self):
+        # The put of the sixth frame waits until there is space in the queue
+        delivered = []
+        release = threading.Event()
+
+        def _handler(frame):
+            release.wait()
+            delivered.append(frame)
+
+        dispatcher = RxDispatcher(_handler, 4, RxDispatcher.POLICY_BLOCK)
+        producer = threading.Thread(target=lambda: [dispatcher.put(i) for i in range(1, 11)])
+        producer.start()
+        self.fail_if(not self._wait_for(lambda: dispatcher.get_counters()["blocked"] > 0), "Producer not blocked")
+        self.fail_if(not producer.is_alive(), "Producer not waiting")
+        release.set()
+        producer.join(1)
+        dispatcher.close()
+        counters = dispatcher.get_counters()
+        self.log.debug(f"Delivered: {delivered}, counters: {counters}")
+        self.fail_if(delivered != list(range(1, 11)) or counters["dropped"] != 0, "Frames not delivered")
+
+    def test_handler_error(self):
+        delivered = []
+
+        def _handler(frame):
+            if frame == 2:
+                raise ValueError("Invalid frame")
+            delivered.append(frame)
+
+        dispatcher = RxDispatcher(_handler)
+        for i in range(1, 4):
+            dispatcher.put(i)
+        dispatcher.close()
+        self.fail_if(delivered != [1, 3] or dispatcher.get_counters()["errors"] != 1, "Error not handled")
+        self.fail_if(dispatcher.put(4), "Frame accepted after close")
+        try:
+            RxDispatcher(print, policy="invalid")
+            self.fail("Invalid policy accepted")
+        except ValueError:
+            pass
+
+    def test_driver_rx_queue(self):
+        # Slow RX callback: the driver keeps receiving, the callback gets the RX time of its frame
+        ports = VirtualBus.create_racks(1, name="test_rx_dispatcher_")
+        received = []
+
+        def _rx_callback(frame):
+            time.sleep(0.001)
+            received.append((frame, driver.rx_time_ns))
+
+        driver = RS485Driver(ports[0], _rx_callback, True, rx_queue_size=16,
+                             rx_overflow_policy=RxDispatcher.POLICY_DROP_NEWEST)
+        try:
+            packet = DataPacket()
+            packet.dsn = 0xFF
+            packet.ssn = 0
+            packet.pid = 1
+            packet.data = [1]
+            driver.send_data(packet.get_data())
+            n_modules = VirtualBus.N_SLOTS
+            self.fail_if(not self._wait_for(lambda: len(received) == n_modules), "Not all responses received")
+            self.fail_if(len(set(rx_time_ns for _frame, rx_time_ns in received)) != 1, "Wrong RX times")
+            metrics = driver.get_metrics().snapshot()
+            self.log.debug(f"Metrics: {metrics}")
+            self.fail_if(metrics["rx_queue_max_depth"] < 1 or metrics["rx_dropped_frames"] != 0, "Wrong RX metrics")
+        finally:
+            driver.close()
+            VirtualBus.unregister("test_rx_dispatcher_1")
+
+
+if __name__ == "__main__":
+
+    TestRxDispatcher().run()
@@ -0,0 +1,91 @@
+"""
+Test the sample stream, with samples from the simulated measurement module LS-MM.
+"""
+
+import lily_unit_test
+import numpy
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.sample_stream import SampleStream
+from application.models.simulator.lily_module_mm import LilyModuleMM
+
+
+class TestSampleStream(lily_unit_test.TestSuite):
+
+    _SAMPLE_RATE = 1000
+
+    def _get_payloads(self, module, n_packets):
+        request = DataPacket()
+        request.dsn = 1
+        request.pid = 1
+        request.data = [LilyModuleMM.COMMAND_GET_SAMPLES]
+        payloads = []
+        for _ in range(n_packets):
+            payloads.append(module.process_packet(request.get_data()).payload)
+        return payloads
+
+    def test_simulator_stream(self):
+        module = LilyModuleMM(1, "000001", self._SAMPLE_RATE, 50, 10000)
+        stream = SampleStream(LilyModuleMM.SAMPLE_TYPE, 1024, self._SAMPLE_RATE)
+        payloads = self._get_payloads(module, 100)
+        n_samples = stream.add_payloads(payloads, [10.0 + i * LilyModuleMM.SAMPLES_PER_PACKET / self._SAMPLE_RATE
+                                                   for i in range(len(payloads))])
+        self.fail_if(n_samples != 1600, f"Wrong number of samples: {n_samples}")
+        self.fail_if(stream.get_count() != 1600 or stream.get_size() != 1024, "Wrong count or size")
+        timestamps, samples = stream.get_samples()
+        # Samples and timestamps in step (wrapped ring buffer)
+        expected = numpy.round(10000 * numpy.sin(2 * numpy.pi * 50 * numpy.arange(576, 1600) / self._SAMPLE_RATE))
+        self.fail_if(not numpy.array_equal(samples, expected), "Wrong samples")
+        self.fail_if(not numpy.allclose(timestamps, 10.0 + numpy.arange(576, 1600) / self._SAMPLE_RATE),
+                     "Timestamps not in step with the samples")
+        statistics = stream.get_statistics()
+        self.log.debug(f"Statistics: {statistics}")
+        self.fail_if(abs(statistics["rms"] - 10000 / numpy.sqrt(2)) > 50, f"Wrong RMS: {statistics['rms']}")
+        self.fail_if(statistics["max"] != 10000 or statistics["min"] != -10000, "Wrong minimum or maximum")
+
+    def test_window_statistics(self):
+        stream = SampleStream(">u2", 100)
+        values = numpy.arange(130, dtype=">u2")
+        stream.add_payload(memoryview(values.tobytes()), 1.0)
+        statistics = stream.get_window_statistics(25)
+        self.log.debug(f"Window statistics: {statistics}")
+        self.fail_if(len(statistics["mean"]) != 4, "Wrong number of windows")
+        expected = values[30:].reshape(4, 25).astype(float)
+        self.fail_if(not numpy.array_equal(statistics["mean"], expected.mean(1)), "Wrong mean")
+        self.fail_if(not numpy.array_equal(statistics["max"], expected.max(1)), "Wrong maximum")
+        self.fail_if(not numpy.allclose(statistics["rms"], numpy.sqrt((expected ** 2).mean(1))), "Wrong RMS")
+        # Without sample rate all samples of a payload have the timestamp of the payload
+        self.fail_if(not numpy.all(statistics["timestamp"] == 1.0), "Wrong timestamps")
+
+    def test_invalid_payload(self):
+        stream = SampleStream(">i4")
+        try:
+            stream.add_payloads([b"\x00\x00\x00\x01", b"\x00\x01"])
+            self.fail("No error for a payload with an incomplete sample")
+        except ValueError as e:
+            self.log.debug(f"Error: {e}")
+        self.fail_if(stream.get_statistics() is not None, "Statistics without samples")
+
+    def test_speed(self):
+        module = LilyModuleMM(1, "000001")
+        stream = SampleStream(LilyModuleMM.SAMPLE_TYPE, 1 << 20, self._SAMPLE_RATE)
+        payloads = self._get_payloads(module, 10000)
+        t = time.perf_counter()
+        stream.add_payloads(payloads)
+        t_bulk = time.perf_counter() - t
+        packet = DataPacket()
+        t = time.perf_counter()
+        for payload in payloads:
+            packet.payload = payload
+            [packet.convert_data_to_number(2, offset, True) for offset in range(0, len(payload), 2)]
+        t_convert = time.perf_counter() - t
+        n_samples = len(payloads) * LilyModuleMM.SAMPLES_PER_PACKET
+        self.log.debug(f"Sample stream           : {n_samples / t_bulk / 1e6:.1f} M samples/s")
+        self.log.debug(f"convert_data_to_number  : {n_samples / t_convert / 1e6:.1f} M samples/s")
+        self.fail_if(t_bulk > t_convert, "Sample stream slower than converting per sample")
+
+
+if __name__ == "__main__":
+
+    TestSampleStream().run()
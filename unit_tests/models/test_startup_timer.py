@@ -0,0 +1,124 @@
+"""
+Test the startup timer and the startup time of the models.
+
+The startup is measured in a new Python process (nothing imported yet), with the simulators on virtual buses.
+The budgets are scaled with the speed of the machine: a fixed baseline workload is timed in the same process and
+compared with the time of the baseline on the machine the budgets are made for (never scaled below 1).
+An extra factor can be set with the environment variable LILY_STARTUP_BUDGET_FACTOR (for example on slow CI).
+"""
+
+import json
+import lily_unit_test
+import os
+import subprocess
+import sys
+import time
+
+from application.models.startup_timer import StartupTimer
+
+
+class TestStartupTimer(lily_unit_test.TestSuite):
+
+    _APPLICATION_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "application"))
+
+    # Startup budget (seconds) and the time of the baseline on the machine the budgets are made for
+    _IMPORT_BUDGET = 0.5
+    _CREATE_BUDGET = 0.05
+    _DETECTION_BUDGET = 1.5
+    _BASELINE_TIME = 0.04
+    _BUDGET_FACTOR_VARIABLE = "LILY_STARTUP_BUDGET_FACTOR"
+
+    _STARTUP_SCRIPT = """
+import json
+import sys
+import threading
+
+from models.startup_timer import StartupTimer
+
+with StartupTimer.phase("baseline"):
+    for _ in range(20):
+        sorted(str(i) for i in range(10000))
+
+with StartupTimer.phase("import models"):
+    from models.lily_system import LilySystem
+
+# The simulators are imported by the application only when used
+simulator_modules = [name for name in sys.modules
+                     if name.startswith(("models.simulator", "application.models.simulator"))]
+
+from models.simulator.simulators import Simulators
+
+Simulators.run(True)
+n_threads = threading.active_count()
+with StartupTimer.phase("create Lily System"):
+    lily_system = LilySystem(lambda racks: None)
+threads_created = threading.active_count() - n_threads
+with StartupTimer.phase("start Lily System"):
+    lily_system.start()
+detected = StartupTimer.wait_for_mark("first module detection", 10)
+print(json.dumps({
+    "wx": "wx" in sys.modules,
+    "simulator_modules": simulator_modules,
+    "threads_created": threads_created,
+    "detected": detected,
+    "report": StartupTimer.get_report()
+}))
+"""
+
+    def _run_startup(self):
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join([self._APPLICATION_FOLDER,
+                                                     os.path.dirname(self._APPLICATION_FOLDER)])
+        result = subprocess.run([sys.executable, "-c", self._STARTUP_SCRIPT], cwd=self._APPLICATION_FOLDER,
+                                env=environment, capture_output=True, text=True, timeout=60)
+        self.fail_if(result.returncode != 0, f"Startup failed:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_phases(self):
+        StartupTimer.clear()
+        with StartupTimer.phase("phase 1"):
+            time.sleep(0.01)
+        StartupTimer.mark("mark 1")
+        StartupTimer.mark("mark 1")
+        with StartupTimer.phase("phase 2"):
+            pass
+        report = StartupTimer.get_report()
+        self.log.debug(StartupTimer.format_report())
+        self.fail_if([r["name"] for r in report] != ["phase 1", "mark 1", "phase 2"], "Wrong phases")
+        self.fail_if(report[0]["duration"] < 0.01, "Wrong duration")
+        self.fail_if(report[1]["duration"] is not None, "Mark has a duration")
+        self.fail_if(StartupTimer.get_time("mark 1") < StartupTimer.get_time("phase 1"), "Wrong time of the mark")
+        self.fail_if(StartupTimer.get_time("phase 3") is not None, "Time of an unknown phase")
+        self.fail_if(not StartupTimer.wait_for_mark("mark 1", 0), "Mark not found")
+        self.fail_if(StartupTimer.wait_for_mark("mark 2", 0.01), "Unknown mark found")
+        self.fail_if(not StartupTimer.is_enabled([StartupTimer.ARGUMENT]), "Startup timing not enabled")
+
+    def test_startup_budget(self):
+        result = self._run_startup()
+        for record in result["report"]:
+            duration = "" if record["duration"] is None else f"{1000 * record['duration']:.1f} ms"
+            self.log.debug(f"{1000 * record['start']:8.1f} ms: {record['name']} {duration}")
+        phases = {record["name"]: record for record in result["report"]}
+        self.fail_if(result["wx"], "The models import wx")
+        self.fail_if(len(result["simulator_modules"]) > 0,
+                     f"The models import the simulator: {result['simulator_modules']}")
+        self.fail_if(result["threads_created"] != 0, "Threads started by the constructor")
+        self.fail_if(not result["detected"], "No module detection")
+        factor = (max(1.0, phases["baseline"]["duration"] / self._BASELINE_TIME) *
+                  float(os.environ.get(self._BUDGET_FACTOR_VARIABLE, "1")))
+        self.log.debug(f"Budget factor: {factor:.2f}")
+        import_budget = factor * self._IMPORT_BUDGET
+        create_budget = factor * self._CREATE_BUDGET
+        detection_budget = factor * self._DETECTION_BUDGET
+        self.fail_if(phases["import models"]["duration"] > import_budget,
+                     f"Import of the models takes more than {import_budget:.3f} s")
+        self.fail_if(phases["create Lily System"]["duration"] > create_budget,
+                     f"Creating the Lily System takes more than {create_budget:.3f} s")
+        detection_time = phases["first module detection"]["start"] - phases["start Lily System"]["start"]
+        self.fail_if(detection_time > detection_budget,
+                     f"First module detection takes more than {detection_budget:.3f} s")
+
+
+if __name__ == "__main__":
+
+    TestStartupTimer().run()
@@ -3,8 +3,12 @@ Test the TCP client/server.
 """
 
 import lily_unit_test
+import socket
+import threading
 import time
 
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
 from application.models.simulator.tcp_server import TCPServer
 from application.models.tcp_client import TCPClient
 
@@ -14,6 +18,7 @@ class TestTCPClientServer(lily_unit_test.TestSuite):
     _HOST = "localhost"
     _PORT = 17120
     _TEST_DATA = b"Lily System TCP server test"
+    _EOF_PORT = 17121
 
     _tcp_server = None
 
@@ -22,8 +27,37 @@ class TestTCPClientServer(lily_unit_test.TestSuite):
         # Loopback
         return [data]
 
+    @staticmethod
+    def _frame_handler(frame):
+        # Response with the same PID, two responses for PID 2
+        packet = DataPacket()
+        packet.from_data(frame)
+        packet.dsn, packet.ssn = packet.ssn, packet.dsn
+        return [packet.get_data(True)] * (2 if packet.pid == 2 else 1)
+
+    @staticmethod
+    def _get_request(pid):
+        packet = DataPacket()
+        packet.dsn = 1
+        packet.ssn = 0
+        packet.pid = pid
+        packet.data = [1]
+        return packet.get_data()
+
+    @staticmethod
+    def _receive(sock, n_bytes):
+        data = b""
+        sock.settimeout(1)
+        while len(data) < n_bytes:
+            chunk = sock.recv(n_bytes - len(data))
+            if len(chunk) == 0:
+                break
+            data += chunk
+        return data
+
     def setup(self):
-        self._tcp_server = TCPServer(self._HOST, self._PORT, self._packet_handler)
+        # Raw data (no frames)
+        self._tcp_server = TCPServer(self._HOST, self._PORT, self._packet_handler, False)
 
     def teardown(self):
         if self._tcp_server is not None:
@@ -45,6 +79,183 @@ class TestTCPClientServer(lily_unit_test.TestSuite):
         self.log.debug(f"RX data: {rx_data}")
         self.fail_if(rx_data != self._TEST_DATA, f"Invalid data received, expected: {self._TEST_DATA}")
 
+    def test_blocking_read(self):
+        c = TCPClient(self._HOST, self._PORT)
+        try:
+            t = time.perf_counter()
+            rx_data = c.read(100, 0.2)
+            t = time.perf_counter() - t
+            self.log.debug(f"Read without data: {rx_data}, {1000 * t:.1f} ms")
+            self.fail_if(rx_data != b"" or t < 0.15, "Read did not wait for the time out")
+            c.write(self._TEST_DATA)
+            rx_data = b""
+            while len(rx_data) < len(self._TEST_DATA):
+                data = c.read(100, 1)
+                self.fail_if(len(data) == 0, "No data received")
+                rx_data += data
+            self.fail_if(rx_data != self._TEST_DATA, f"Invalid data received, expected: {self._TEST_DATA}")
+        finally:
+            c.close()
+
+    def test_ring_buffer(self):
+        # Small ring buffer: the data wraps around and the server waits when the buffer is full
+        tx_data = bytes(range(256)) * 40
+        c = TCPClient(self._HOST, self._PORT, 100)
+        try:
+            c.write(tx_data)
+            rx_data = bytearray()
+            buffer = bytearray(33)
+            while len(rx_data) < len(tx_data):
+                if len(rx_data) % 2 == 0:
+                    data = c.read(37, 1)
+                else:
+                    data = buffer[:c.readinto(buffer, 1)]
+                self.fail_if(len(data) == 0, f"No data received after {len(rx_data)} bytes")
+                self.fail_if(c.in_waiting > 100, "More data than the ring buffer size")
+                rx_data += data
+            self.fail_if(rx_data != tx_data, "Invalid data received")
+        finally:
+            c.close()
+
+    def test_end_of_file(self):
+        # The server sends data and closes the connection, the data can be read after the connection is closed
+        with socket.create_server((self._HOST, self._EOF_PORT)) as server:
+            def _send_and_close():
+                connection = server.accept()[0]
+                connection.sendall(self._TEST_DATA)
+                connection.close()
+
+            thread = threading.Thread(target=_send_and_close)
+            thread.start()
+            c = TCPClient(self._HOST, self._EOF_PORT)
+            thread.join()
+            try:
+                t = time.perf_counter()
+                while c.is_open and time.perf_counter() - t < 1:
+                    time.sleep(0.01)
+                self.fail_if(c.is_open, "Connection not closed")
+                self.fail_if(c.read(100, 1) != self._TEST_DATA, "Invalid data received")
+                t = time.perf_counter()
+                self.fail_if(c.read(100, 1) != b"", "Data received after the end")
+                self.fail_if(time.perf_counter() - t > 0.1, "Read waits after the end")
+                self.log.debug(f"Error: {c.error}")
+            finally:
+                c.close()
+
+
+    def test_concurrent_clients(self):
+        # All clients are connected at the same time, every client gets its response
+        server = TCPServer(self._HOST, 0, self._frame_handler)
+        clients = []
+        try:
+            for i in range(20):
+                clients.append(socket.create_connection((self._HOST, server.get_port())))
+            for pid, client in enumerate(clients, 3):
+                client.sendall(self._get_request(pid))
+            for pid, client in enumerate(clients, 3):
+                packet = DataPacket()
+                response = self._receive(client, len(self._get_request(pid)))
+                self.fail_if(packet.from_data(response) != DataPacket.STATUS_OK or packet.pid != pid,
+                             f"Invalid response for client {pid}: {response}")
+            stats = server.get_stats()
+            self.log.debug(f"Stats: {stats['connections'][0]}")
+            self.fail_if(len(stats["connections"]) != len(clients), "Wrong number of connections")
+        finally:
+            for client in clients:
+                client.close()
+            server.close()
+
+    def test_split_frames(self):
+        # Frames split over multiple chunks and multiple frames in one chunk
+        server = TCPServer(self._HOST, 0, self._frame_handler)
+        client = socket.create_connection((self._HOST, server.get_port()))
+        try:
+            request = self._get_request(1)
+            client.sendall(request[:3])
+            time.sleep(0.05)
+            client.sendall(request[3:] + b"\x55" + self._get_request(2) + self._get_request(3))
+            # Response for PID 2 twice
+            decoder = FrameDecoder()
+            pids = []
+            client.settimeout(1)
+            while len(pids) < 4:
+                data = client.recv(1500)
+                if len(data) == 0:
+                    break
+                for frame in decoder.feed(data):
+                    packet = DataPacket()
+                    packet.from_data(frame)
+                    pids.append(packet.pid)
+            self.log.debug(f"PIDs: {pids}")
+            self.fail_if(pids != [1, 2, 2, 3], "Wrong responses")
+            stats = server.get_stats()["connections"][0]
+            self.log.debug(f"Stats: {stats}")
+            self.fail_if(stats["rx_frames"] != 3 or stats["tx_frames"] != 4, "Wrong number of frames")
+            n_bytes = len(request) + 1 + len(self._get_request(2)) + len(self._get_request(3))
+            self.fail_if(stats["rx_bytes"] != n_bytes, "Wrong number of bytes received")
+        finally:
+            client.close()
+        t = time.perf_counter()
+        while server.get_stats()["closed"]["connections"] == 0 and time.perf_counter() - t < 1:
+            time.sleep(0.01)
+        self.fail_if(server.get_stats()["closed"]["connections"] != 1, "Connection not closed")
+        server.close()
+
+    def test_handler_error(self):
+        # An exception in the packet handler is counted, the connection and the other clients keep working
+        def _handler(frame):
+            packet = DataPacket()
+            if packet.from_data(frame) == DataPacket.STATUS_OK and packet.pid == 5:
+                raise ValueError("Handler error")
+            return self._frame_handler(frame)
+
+        server = TCPServer(self._HOST, 0, _handler)
+        clients = [socket.create_connection((self._HOST, server.get_port())) for _ in range(2)]
+        try:
+            clients[0].sendall(self._get_request(5))
+            for pid, client in enumerate(clients, 6):
+                client.sendall(self._get_request(pid))
+                packet = DataPacket()
+                response = self._receive(client, len(self._get_request(pid)))
+                self.fail_if(packet.from_data(response) != DataPacket.STATUS_OK or packet.pid != pid,
+                             f"Invalid response for PID {pid}: {response}")
+            errors = sorted(stats["handler_errors"] for stats in server.get_stats()["connections"])
+            self.fail_if(errors != [0, 1], f"Wrong number of handler errors: {errors}")
+        finally:
+            for client in clients:
+                client.close()
+            server.close()
+
+    def test_client_not_reading(self):
+        # A client that does not read: the server stops reading, the data waiting to be sent is limited
+        server = TCPServer(self._HOST, 0, self._packet_handler, False)
+        client = socket.create_connection((self._HOST, server.get_port()))
+        try:
+            block = bytes(range(256)) * 256
+            n_sent = 0
+            client.settimeout(0.5)
+            while n_sent < 256 * len(block):
+                try:
+                    n_sent += client.send(block)
+                except socket.timeout:
+                    break
+            stats = server.get_stats()["connections"][0]
+            self.log.debug(f"Sent {n_sent} bytes, waiting in the server: {stats['tx_buffer']} bytes")
+            self.fail_if(n_sent >= 256 * len(block), "Server kept reading")
+            self.fail_if(stats["tx_buffer"] > TCPServer._TX_BUFFER_LIMIT + TCPServer._BUFFER_SIZE,
+                         "Too much data waiting in the server")
+            # When the client reads again, all data is received
+            n_received = 0
+            client.settimeout(1)
+            while n_received < n_sent:
+                data = client.recv(TCPServer._BUFFER_SIZE)
+                self.fail_if(len(data) == 0, "Connection closed")
+                n_received += len(data)
+            self.fail_if(n_received != n_sent, "Not all data received")
+        finally:
+            client.close()
+            server.close()
+
 
 if __name__ == "__main__":
 
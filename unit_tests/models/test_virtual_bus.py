@@ -0,0 +1,128 @@
+"""
+Test the virtual bus and the loop client.
+"""
+
+import lily_unit_test
+import queue
+import time
+
+from application.models.data_packet import DataPacket
+from application.models.frame_decoder import FrameDecoder
+from application.models.loop_client import LoopClient
+from application.models.rs485_driver import RS485Driver
+from application.models.simulator.lily_module_cm import LilyModuleCM
+from application.models.simulator.virtual_bus import VirtualBus
+
+
+class TestVirtualBus(lily_unit_test.TestSuite):
+
+    _N_RACKS = 200
+    _N_REQUESTS = 20000
+
+    _ports = []
+    _rx_queue = queue.Queue()
+
+    @staticmethod
+    def _create_request(pid, dsn=1, command=1):
+        packet = DataPacket()
+        packet.dsn = dsn
+        packet.ssn = 0
+        packet.pid = pid
+        packet.data = [command]
+        return packet.get_data()
+
+    @staticmethod
+    def _decode(data):
+        packets = []
+        for frame in FrameDecoder().feed(data):
+            packet = DataPacket()
+            packet.from_data(frame)
+            packets.append(packet)
+        return packets
+
+    def _rx_callback(self, data):
+        packet = DataPacket()
+        packet.from_data(data)
+        self._rx_queue.put(packet)
+
+    def setup(self):
+        self._ports = VirtualBus.create_racks(self._N_RACKS, name="test_rack")
+
+    def teardown(self):
+        for rack in range(1, self._N_RACKS + 1):
+            VirtualBus.unregister(f"test_rack{rack}")
+
+    def test_driver(self):
+        for event_driven in [False, True]:
+            driver = RS485Driver(self._ports[0], self._rx_callback, event_driven)
+            try:
+                self.fail_if(driver.get_port() != self._ports[0], f"Wrong port name: {driver.get_port()}")
+                driver.send_data(self._create_request(1, 3, 3))
+                packet = self._rx_queue.get(True, 1)
+            finally:
+                driver.close()
+            self.fail_if(packet.ssn != 3 or packet.pid != 1, "Wrong response")
+            self.fail_if(packet.convert_data_to_string() != "000103", f"Wrong serial: {packet.convert_data_to_string()}")
+
+    def test_broadcast(self):
+        client = LoopClient("test_rack2")
+        client.write(self._create_request(1, 0xFF))
+        packets = self._decode(client.read(client.in_waiting))
+        client.close()
+        slots = list(map(lambda p: p.ssn, packets))
+        self.fail_if(slots != list(range(1, VirtualBus.N_SLOTS + 1)), f"Wrong responses: {slots}")
+
+    def test_fileno(self):
+        client = LoopClient("test_rack1")
+        client.write(self._create_request(1))
+        # Data was waiting before the file descriptor was created
+        fileno = client.fileno()
+        self.fail_if(fileno < 0, "Invalid file descriptor")
+        self.fail_if(client._notify_r.recv(1) != b"\x00", "No notification")
+        client.read(client.in_waiting)
+        client.close()
+
+    def test_hot_plug(self):
+        bus = VirtualBus.get("test_rack3")
+        client = LoopClient("test_rack3")
+        bus.remove_module(2)
+        client.write(self._create_request(1, 0xFF))
+        slots = list(map(lambda p: p.ssn, self._decode(client.read(client.in_waiting))))
+        self.fail_if(2 in slots or len(slots) != VirtualBus.N_SLOTS - 1, f"Module not removed: {slots}")
+        bus.insert_module(LilyModuleCM(2, "ABCDEF"))
+        client.write(self._create_request(2, 2, 3))
+        packets = self._decode(client.read(client.in_waiting))
+        client.close()
+        self.fail_if(len(packets) != 1 or packets[0].convert_data_to_string() != "ABCDEF", "Module not inserted")
+
+    def test_many_racks(self):
+        t = time.perf_counter()
+        clients = list(map(lambda p: LoopClient(p[7:]), self._ports))
+        for pid, client in enumerate(clients, 1):
+            client.write(self._create_request(pid, 0xFF))
+        n_modules = sum(map(lambda c: len(self._decode(c.read(c.in_waiting))), clients))
+        t = time.perf_counter() - t
+        self.log.debug(f"Detected {n_modules} modules in {len(clients)} racks in {1000 * t:.0f} ms")
+        self.fail_if(n_modules != self._N_RACKS * VirtualBus.N_SLOTS, f"Wrong number of modules: {n_modules}")
+
+    def test_throughput(self):
+        client = LoopClient("test_rack1")
+        t = time.perf_counter()
+        for pid in range(1, self._N_REQUESTS + 1):
+            client.write(self._create_request(pid, 1 + pid % VirtualBus.N_SLOTS))
+        n_responses = len(self._decode(client.read(client.in_waiting)))
+        t = time.perf_counter() - t
+        self.log.debug(f"Requests per second: {self._N_REQUESTS / t:.0f}")
+        self.fail_if(n_responses != self._N_REQUESTS, f"Not all requests have a response: {n_responses}")
+
+    def test_unknown_bus(self):
+        try:
+            LoopClient("no_rack")
+            self.fail("No error for an unknown bus")
+        except ValueError:
+            pass
+
+
+if __name__ == "__main__":
+
+    TestVirtualBus().run()
@@ -0,0 +1,14 @@
+"""
+Run all the benchmarks.
+"""
+
+
+from lily_unit_test import TestRunner
+
+from unit_tests.lib.benchmark_results import BenchmarkResults
+from unit_tests.test_runner_settings import TestRunnerSettings
+
+
+BenchmarkResults.clear()
+TestRunner.run(TestRunnerSettings.get_test_suites_path("benchmarks"),
+               TestRunnerSettings.get_test_options())
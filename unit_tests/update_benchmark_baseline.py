@@ -0,0 +1,9 @@
+"""
+Update the benchmark baseline with the results of the last benchmark run.
+"""
+
+
+from unit_tests.lib.benchmark_results import BenchmarkResults
+
+
+print("Results in baseline:", BenchmarkResults.update_baseline())